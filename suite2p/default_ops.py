@@ -31,6 +31,14 @@ def default_ops():
         ],  # subfolders you"d like to search through when look_one_level_down is set to True
         "move_bin":
             False,  # if 1, and fast_disk is different than save_disk, binary file is moved to save_disk
+        "prefetch_batches":
+            1,  # number of batches to read ahead from binary files in a background thread (0 to read synchronously)
+        "write_behind_batches":
+            2,  # number of registered batches queued for writing in a background thread (0 to write synchronously)
+        "binary_compression":
+            None,  # if "zlib", "lz4" or "zstd", binary files are written as chunked, compressed binaries with this codec
+        "tiff_workers":
+            0,  # if > 1, tiffs are decoded and written to the binaries in parallel by this many processes
 
         # main settings
         "nplanes": 1,  # each tiff has these many planes in sequence
@@ -43,6 +51,12 @@ def default_ops():
         "force_sktiff": False,  # whether or not to use scikit-image for tiff reading
         "frames_include": -1,
         "multiplane_parallel": False,  # whether or not to run on server
+        "plane_workers":
+            0,  # if > 1, planes are processed in parallel by this many processes on this machine
+        "plane_threads":
+            0,  # number of threads of each plane worker (0 splits the cores evenly across workers)
+        "plane_memory":
+            0.,  # memory budget in GB of the planes processed in parallel (0 uses the free memory)
         "ignore_flyback": [],
 
         # output settings
@@ -62,6 +76,10 @@ def default_ops():
             0,  # Bidirectional Phase offset from line scanning (set by user). Applied to all frames in recording.
         "bidi_corrected":
             False,  # Whether to do bidirectional correction during registration
+        "bidi_subpixel":
+            False,  # if True, the bidiphase offset is estimated with 1/subpixel precision
+        "bidi_per_batch":
+            False,  # if True, the bidiphase offset is re-estimated on each batch (e.g. for scanner drifts in long recordings)
 
         # registration settings
         "do_registration": True,  # whether to register data (2 forces re-registration)
@@ -78,6 +96,8 @@ def default_ops():
         "reg_tif": False,  # whether to save registered tiffs
         "reg_tif_chan2": False,  # whether to save channel 2 registered tiffs
         "subpixel": 10,  # precision of subpixel registration (1/subpixel steps)
+        "rigid_subpixel":
+            False,  # if True, rigid shifts are also estimated and applied with subpixel precision
         "smooth_sigma_time": 0,  # gaussian smoothing in time
         "smooth_sigma":
             1.15,  # ~1 good for 2P recordings, recommend 3-5 for 1P recordings
@@ -86,6 +106,16 @@ def default_ops():
         "norm_frames": True,  # normalize frames when detecting shifts
         "force_refImg": False,  # if True, use refImg stored in ops if available
         "pad_fft": False,  # if True, pads image during FFT part of registration
+        "fft_threads":
+            0,  # number of threads used for registration FFTs (0 uses the default number of threads)
+        "fft_backend":
+            "",  # registration FFTs with "torch", "scipy", "mkl_fft" or "auto" (fastest in a quick benchmark); "" uses SUITE2P_FFT_BACKEND or the default
+        "reg_cache":
+            False,  # if True, registration offsets are cached in save_path and reused when the same frames are registered again with the same settings
+        "online_ref_update":
+            0,  # in online registration, the reference image is updated from every this many registered frames (0 keeps the initial reference)
+        "reg_metrics_batched":
+            False,  # if True, the PCs of the registration metrics are computed from batches of frames (lower memory use, a few passes over the frames)
 
         # non rigid registration settings
         "nonrigid": True,  # whether to use nonrigid registration
@@ -114,6 +144,12 @@ def default_ops():
         "connected":
             True,  # whether or not to keep ROIs fully connected (set to 0 for dendrites)
         "nbinned": 5000,  # max number of binned frames for cell detection
+        "bin_workers":
+            0,  # number of threads binning the registered movie for cell detection (0 uses all cores)
+        "bin_memmap":
+            False,  # if True, the binned movie is written to mov_binned.npy in save_path and memory-mapped instead of held in memory
+        "detect_cache":
+            False,  # if True, the binned and denoised movies are saved in save_path and reused when detection is rerun on the same registered frames
         "max_iterations": 20,  # maximum number of iterations to do cell detection
         "threshold_scaling":
             1.0,  # adjust the automatically determined threshold by this scalar multiplier
@@ -124,6 +160,10 @@ def default_ops():
         "spatial_hp_detect":
             25,  # window for spatial high-pass filtering for neuropil subtraction before detection
         "denoise": False,  # denoise binned movie for cell detection in sparse_mode
+        "sparse_tile_size":
+            0,  # if > 0, sparse_mode ROIs are extracted from tiles of this many pixels in parallel
+        "sparse_workers":
+            0,  # number of processes extracting ROIs from the tiles (0 uses all cores)
 
         # cell detection settings with cellpose (used if anatomical_only > 0)
         "anatomical_only":
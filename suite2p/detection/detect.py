@@ -1,7 +1,11 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+import hashlib
+import os
 import time
+from warnings import warn
+
 import numpy as np
 from pathlib import Path
 from typing import Dict, Any
@@ -9,77 +13,77 @@ from typing import Dict, Any
 from . import sourcery, sparsedetect, chan2detect, utils
 from .stats import roi_stats
 from .denoise import pca_denoise
-from ..io.binary import BinaryFile
+from ..io.binary import BinaryFile, frames_hash
+from ..io.binary import bin_movie as io_bin_movie
 from ..classification import classify, user_classfile
 from .. import default_ops
 
+# ops that change the binned movie, part of the detection cache key
+BINNING_CACHE_OPS = ("nbinned", "tau", "fs", "yrange", "xrange")
+# ops that also change the denoised movie
+DENOISING_CACHE_OPS = ("inverted_activity", "block_size")
+
 
 def detect(ops, classfile=None):
 
-    t0 = time.time()
-    bin_size = int(
-        max(1, ops["nframes"] // ops["nbinned"], np.round(ops["tau"] * ops["fs"])))
-    print("Binning movie in chunks of length %2.2d" % bin_size)
     with BinaryFile(filename=ops["reg_file"], Ly=ops["Ly"], Lx=ops["Lx"]) as f:
-        mov = f.bin_movie(
-            bin_size=bin_size,
-            bad_frames=ops.get("badframes"),
-            y_range=ops["yrange"],
-            x_range=ops["xrange"],
-        )
-        print("Binned movie [%d,%d,%d] in %0.2f sec." %
-              (mov.shape[0], mov.shape[1], mov.shape[2], time.time() - t0))
-
-        ops, stat = detection_wrapper(f, mov=mov, ops=ops, classfile=classfile)
+        ops, stat = detection_wrapper(f, ops=ops, classfile=classfile)
 
     return ops, stat
 
 
-def bin_movie(f_reg, bin_size, yrange=None, xrange=None, badframes=None):
-    """ bin registered movie """
-    n_frames = f_reg.shape[0]
-    good_frames = ~badframes if badframes is not None else np.ones(n_frames, dtype=bool)
-    batch_size = min(good_frames.sum(), 500)
-    Lyc = yrange[1] - yrange[0]
-    Lxc = xrange[1] - xrange[0]
+def bin_workers(ops):
+    """ number of threads binning the movie (ops["bin_workers"], 0 uses all cores) """
+    return ops.get("bin_workers", 0) or os.cpu_count() or 1
 
-    # Number of binned frames is rounded down when binning frames
-    num_binned_frames = n_frames // bin_size
-    mov = np.zeros((num_binned_frames, Lyc, Lxc), np.float32)
-    curr_bin_number = 0
-    t0 = time.time()
 
-    # Iterate over n_frames to maintain binning over TIME
-    for k in np.arange(0, n_frames, batch_size):
-        data = f_reg[k:min(k + batch_size, n_frames)]
-
-        # exclude badframes
-        good_indices = good_frames[k:min(k + batch_size, n_frames)]
-        if good_indices.mean() > 0.5:
-            data = data[good_indices]
-
-        # crop to valid region
-        if yrange is not None and xrange is not None:
-            data = data[:, slice(*yrange), slice(*xrange)]
-
-        # bin in time
-        if data.shape[0] > bin_size:
-            # Downsample by binning via reshaping and taking mean of each bin
-            # only if current batch size exceeds or matches bin_size
-            n_d = data.shape[0]
-            data = data[:(n_d // bin_size) * bin_size]
-            data = data.reshape(-1, bin_size, Lyc, Lxc).astype(np.float32).mean(axis=1)
-        else:
-            # Current batch size is below bin_size (could have many bad frames in this batch)
-            # Downsample taking the mean of batch to get a single bin
-            data = data.mean(axis=0)[np.newaxis, :, :]
-        # Only fill in binned data if not exceeding the number of bins mov has
-        if mov.shape[0] > curr_bin_number:
-            # Fill in binned data
-            n_bins = data.shape[0]
-            mov[curr_bin_number:curr_bin_number + n_bins] = data
-            curr_bin_number += n_bins
+def binned_filename(ops):
+    """ .npy file of the binned movie in ops["save_path"] if ops["bin_memmap"] or
+    ops["detect_cache"], else None """
+    if (ops.get("bin_memmap", False) or ops.get("detect_cache", False)) and ops.get(
+            "save_path"):
+        return os.path.join(ops["save_path"], "mov_binned.npy")
+    return None
+
 
+def detection_cache_keys(f_reg, ops):
+    """ keys of the binned and of the denoised movies of f_reg in the detection cache
+
+    the binned movie depends on the registered frames (see io.frames_hash), the ops
+    in BINNING_CACHE_OPS and the bad frames, and the denoised movie also on the ops in
+    DENOISING_CACHE_OPS
+    """
+    h = hashlib.sha1()
+    for key in BINNING_CACHE_OPS:
+        h.update(("%s=%r;" % (key, np.asarray(ops.get(key)).tolist())).encode())
+    if ops.get("badframes") is not None:
+        h.update(np.asarray(ops["badframes"], bool).tobytes())
+    h.update(frames_hash(f_reg).encode())
+    binned_key = h.hexdigest()
+    for key in DENOISING_CACHE_OPS:
+        h.update(("%s=%r;" % (key, np.asarray(ops.get(key)).tolist())).encode())
+    return binned_key, h.hexdigest()
+
+
+def load_detection_cache(cache_file):
+    """ returns the keys of the movies in the detection cache (empty if it does not exist) """
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        return np.load(cache_file, allow_pickle=True).item()
+    except (OSError, ValueError, EOFError):
+        warn("could not read detection cache %s, ignoring it" % cache_file)
+        return {}
+
+
+def bin_movie(f_reg, bin_size, yrange=None, xrange=None, badframes=None, n_workers=1,
+              filename=None):
+    """ bin registered movie (see io.bin_movie), frames are read by the n_workers threads
+    binning them
+    """
+    t0 = time.time()
+    mov = io_bin_movie(f_reg, bin_size, y_range=yrange, x_range=xrange,
+                       bad_frames=badframes, n_workers=n_workers, filename=filename)
     print("Binned movie of size [%d,%d,%d] created in %0.2f sec." %
           (mov.shape[0], mov.shape[1], mov.shape[2], time.time() - t0))
     return mov
@@ -128,12 +132,34 @@ def detection_wrapper(f_reg, mov=None, yrange=None, xrange=None, ops=default_ops
     ops["yrange"] = yrange
     ops["xrange"] = xrange
 
+    # reuse the binned and denoised movies of a previous detection of the same frames
+    cache_file, cache = None, {}
+    if mov is None and ops.get("detect_cache", False) and ops.get("save_path"):
+        cache_file = os.path.join(ops["save_path"], "detect_cache.npy")
+        binned_key, denoised_key = detection_cache_keys(f_reg, ops)
+        cache = load_detection_cache(cache_file)
+
     if mov is None:
-        bin_size = int(
-            max(1, n_frames // ops["nbinned"], np.round(ops["tau"] * ops["fs"])))
-        print("Binning movie in chunks of length %2.2d" % bin_size)
-        mov = bin_movie(f_reg, bin_size, yrange=yrange, xrange=xrange,
-                        badframes=ops.get("badframes", None))
+        filename = binned_filename(ops)
+        if cache_file is not None and cache.get("binned") == binned_key and os.path.isfile(
+                filename):
+            print("NOTE: using cached binned movie %s" % filename)
+        else:
+            if cache_file is not None:
+                cache = {}
+                np.save(cache_file, cache)
+            bin_size = int(
+                max(1, n_frames // ops["nbinned"], np.round(ops["tau"] * ops["fs"])))
+            print("Binning movie in chunks of length %2.2d" % bin_size)
+            mov = bin_movie(f_reg, bin_size, yrange=yrange, xrange=xrange,
+                            badframes=ops.get("badframes", None),
+                            n_workers=bin_workers(ops), filename=filename)
+            if cache_file is not None:
+                cache["binned"] = binned_key
+                np.save(cache_file, cache)
+        if filename is not None:
+            # copy-on-write, the movie is modified in place below (but not the file)
+            mov = np.load(filename, mmap_mode="c")
     else:
         if mov.shape[1] != yrange[-1] - yrange[0]:
             raise ValueError("mov.shape[1] is not same size as yrange")
@@ -150,9 +176,20 @@ def detection_wrapper(f_reg, mov=None, yrange=None, xrange=None, ops=default_ops
         mov -= mov.min()
 
     if ops.get("denoise", 1):
-        mov = pca_denoise(
-            mov, block_size=[ops["block_size"][0] // 2, ops["block_size"][1] // 2],
-            n_comps_frac=0.5)
+        denoised_file = os.path.join(ops["save_path"],
+                                     "mov_denoised.npy") if cache_file else None
+        if cache_file is not None and cache.get(
+                "denoised") == denoised_key and os.path.isfile(denoised_file):
+            print("NOTE: using cached denoised movie %s" % denoised_file)
+            mov = np.load(denoised_file, mmap_mode="c")
+        else:
+            mov = pca_denoise(
+                mov, block_size=[ops["block_size"][0] // 2, ops["block_size"][1] // 2],
+                n_comps_frac=0.5)
+            if cache_file is not None:
+                np.save(denoised_file, mov)
+                cache["denoised"] = denoised_key
+                np.save(cache_file, cache)
 
     if ops.get("anatomical_only", 0):
         try:
@@ -240,6 +277,8 @@ def select_rois(ops: Dict[str, Any], mov: np.ndarray, sparse_mode: bool = True,
             threshold_scaling=ops["threshold_scaling"],
             max_iterations=250 * ops["max_iterations"],
             percentile=ops.get("active_percentile", 0.0),
+            tile_size=ops.get("sparse_tile_size", 0),
+            n_workers=ops.get("sparse_workers", 0),
         )
         ops.update(new_ops)
     else:
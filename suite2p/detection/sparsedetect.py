@@ -1,12 +1,17 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
-from typing import Tuple, Dict, List, Any
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from copy import deepcopy
+from multiprocessing import get_context
+from typing import Tuple, Dict, List, Any
 from enum import Enum
 from warnings import warn
 
+import numba
 import numpy as np
+from numba import njit, prange
 from numpy.linalg import norm
 
 from scipy.interpolate import RectBivariateSpline
@@ -16,6 +21,25 @@ from scipy.stats import mode
 from . import utils
 
 
+def pixel_major(mov: np.ndarray) -> np.ndarray:
+    """Returns movie (nImg x Ly x Lx) as a contiguous Ly x Lx x nImg array."""
+    nimg, Ly, Lx = mov.shape
+    movT = np.empty((Ly, Lx, nimg), mov.dtype)
+    transpose_tiles(mov.reshape(nimg, -1), movT.reshape(-1, nimg))
+    return movT
+
+
+@njit(parallel=True, cache=True)
+def transpose_tiles(X, XT, tile=64):
+    """ XT = X.T, copied in tiles that fit in cache """
+    n, m = X.shape
+    for ib in prange((n + tile - 1) // tile):
+        for jb in range(0, m, tile):
+            for i in range(ib * tile, min(n, (ib + 1) * tile)):
+                for j in range(jb, min(m, jb + tile)):
+                    XT[j, i] = X[i, j]
+
+
 def neuropil_subtraction(mov: np.ndarray, filter_size: int) -> None:
     """Returns movie subtracted by a low-pass filtered version of itself to help ignore neuropil."""
     nbinned, Ly, Lx = mov.shape
@@ -36,6 +60,52 @@ def square_convolution_2d(mov: np.ndarray, filter_size: int) -> np.ndarray:
     return movt
 
 
+def multiscale_pyramid(mov: np.ndarray, nscales: int = 5,
+                       batch_size: int = 500) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Returns the movie convolved by a 3 x 3 square (see square_convolution_2d) at nscales
+    spatial scales, each downsampled by 2 from the previous one (see utils.downsample),
+    and their max over frames.
+
+    The scales are computed in one pass over batches of frames and written to
+    preallocated pixel-major arrays (see pixel_major), so that memory use is that of the
+    pyramid (about 4/3 of the movie) and of one batch.
+
+    Parameters
+    ----------
+    mov: nImg x Ly x Lx
+        The frames to filter
+    nscales: int
+        The number of spatial scales
+    batch_size: int
+        The number of frames filtered at once
+
+    Returns
+    -------
+    movu: list of Lyp x Lxp x nImg
+        The filtered movie at each scale, pixel-major
+    max_maps: list of Lyp x Lxp
+        The max over frames of the filtered movie at each scale
+    """
+    nimg, Ly, Lx = mov.shape
+    shapes = [(Ly, Lx)]
+    for j in range(1, nscales):
+        shapes.append(((shapes[-1][0] + 1) // 2, (shapes[-1][1] + 1) // 2))
+    movu = [np.empty((Lyp, Lxp, nimg), "float32") for Lyp, Lxp in shapes]
+    max_maps = [np.full((Lyp, Lxp), -np.inf, "float32") for Lyp, Lxp in shapes]
+    for k in range(0, nimg, batch_size):
+        dmov = mov[k:k + batch_size]
+        for j in range(nscales):
+            movu0 = square_convolution_2d(dmov, 3)
+            np.maximum(max_maps[j], movu0.max(axis=0), out=max_maps[j])
+            transpose_tiles(movu0.reshape(len(movu0), -1),
+                            movu[j].reshape(-1, nimg)[:, k:k + len(movu0)])
+            if j < nscales - 1:
+                dmov = utils.downsample(dmov)
+                dmov *= 2
+    return movu, max_maps
+
+
 def multiscale_mask(ypix0, xpix0, lam0, Lyp, Lxp):
     # given a set of masks on the raw image, this functions returns the downsampled masks for all spatial scales
     xs = [xpix0]
@@ -117,7 +187,7 @@ def iter_extend(ypix, xpix, mov, Lyc, Lxc, active_frames):
         pixels in x
     
     mov : 2D array
-        binned residual movie [nbinned x Lyc*Lxc]
+        binned residual movie, pixel-major [Lyc*Lxc x nbinned]
 
     active_frames : 1D array
         list of active frames
@@ -139,8 +209,7 @@ def iter_extend(ypix, xpix, mov, Lyc, Lxc, active_frames):
         # extend ROI by 1 pixel on each side
         ypix, xpix = extendROI(ypix, xpix, Lyc, Lxc, 1)
         # activity in proposed ROI on ACTIVE frames
-        usub = mov[np.ix_(active_frames, ypix * Lxc + xpix)]
-        lam = np.mean(usub, axis=0)
+        lam = active_mean(mov, ypix * Lxc + xpix, active_frames)
         ix = lam > max(0, lam.max() / 5.0)
         if ix.sum() == 0:
             break
@@ -156,6 +225,42 @@ def iter_extend(ypix, xpix, mov, Lyc, Lxc, active_frames):
     return ypix, xpix, lam
 
 
+@njit(parallel=True, cache=True)
+def active_mean(mov, ipix, active_frames):
+    """ mean of the pixels ipix of the pixel-major movie mov over active_frames """
+    lam = np.zeros(len(ipix), mov.dtype)
+    for i in prange(len(ipix)):
+        s = 0.
+        for t in active_frames:
+            s += mov[ipix[i], t]
+        lam[i] = s / len(active_frames)
+    return lam
+
+
+@njit(parallel=True, cache=True)
+def subtract_outer(mov, ipix, active_frames, tproj, lam):
+    """ mov[ipix, active_frames] -= lam x tproj[active_frames] on the pixel-major movie mov
+    (ipix are unique) """
+    for i in prange(len(ipix)):
+        for t in active_frames:
+            mov[ipix[i], t] = mov[ipix[i], t] - tproj[t] * lam[i]
+
+
+@njit(parallel=True, cache=True)
+def thresholded_norm(mov, ipix, threshold):
+    """ norm over frames of the pixels ipix of the pixel-major movie mov, counting only
+    values above threshold (see utils.threshold_reduce) """
+    V = np.zeros(len(ipix), np.float32)
+    for i in prange(len(ipix)):
+        s = np.float32(0.)
+        for t in range(mov.shape[1]):
+            x = mov[ipix[i], t]
+            if x > threshold:
+                s += x * x
+        V[i] = np.sqrt(s)
+    return V
+
+
 def extendROI(ypix, xpix, Ly, Lx, niter=1):
     """ extend ypix and xpix by niter pixel(s) on each side """
     for k in range(niter):
@@ -290,9 +395,14 @@ def find_best_scale(I: np.ndarray, spatial_scale: int) -> Tuple[int, EstimateMod
 
 
 def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_size: int,
-             spatial_scale: int, threshold_scaling, max_iterations: int,
-             percentile=0) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
-    """Returns stats and ops from "mov" using correlations in time."""
+             spatial_scale: int, threshold_scaling, max_iterations: int, percentile=0,
+             tile_size: int = 0,
+             n_workers: int = 0) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Returns stats and ops from "mov" using correlations in time.
+
+    If tile_size > 0, ROIs are extracted from overlapping tiles of the field of view in
+    parallel by n_workers processes (see extract_rois_tiled).
+    """
 
     mean_img = mov.mean(axis=0)
     mov = utils.temporal_high_pass_filter(mov=mov, width=int(high_pass))
@@ -305,23 +415,16 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
     _, Lyc, Lxc = mov.shape
     LL = np.meshgrid(np.arange(Lxc), np.arange(Lyc))
     gxy = [np.array(LL).astype("float32")]
-    dmov = mov
-    movu = []
-
-    # downsample movie at various spatial scales
-    Lyp, Lxp = np.zeros(5, "int32"), np.zeros(5, "int32")  # downsampled sizes
     for j in range(5):
-        movu0 = square_convolution_2d(dmov, 3)
-        dmov = 2 * utils.downsample(dmov)
-        gxy0 = utils.downsample(gxy[j], False)
-        gxy.append(gxy0)
-        _, Lyp[j], Lxp[j] = movu0.shape
-        movu.append(movu0)
+        gxy.append(utils.downsample(gxy[j], False))
+
+    # movie at various spatial scales, pixel-major (see pixel_major)
+    movu, max_maps = multiscale_pyramid(mov, nscales=5, batch_size=batch_size)
 
     # spline over scales
     I = np.zeros((len(gxy), gxy[0].shape[1], gxy[0].shape[2]))
-    for movu0, gxy0, I0 in zip(movu, gxy, I):
-        gmodel = RectBivariateSpline(gxy0[1, :, 0], gxy0[0, 0, :], movu0.max(axis=0),
+    for max_map, gxy0, I0 in zip(max_maps, gxy, I):
+        gmodel = RectBivariateSpline(gxy0[1, :, 0], gxy0[0, 0, :], max_map,
                                      kx=min(3, gxy0.shape[1] - 1),
                                      ky=min(3, gxy0.shape[2] - 1))
         I0[:] = gmodel(gxy[0][1, :, 0], gxy[0][0, 0, :])
@@ -342,10 +445,75 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
           (estimate_mode.value, spatscale_pix, vmultiplier, vmultiplier * Th2))
 
     # get standard deviation for pixels for all values > Th2
-    v_map = [utils.threshold_reduce(movu0, Th2) for movu0 in movu]
-    movu = [movu0.reshape(movu0.shape[0], -1) for movu0 in movu]
+    v_map = [
+        thresholded_norm(movu0.reshape(-1, movu0.shape[-1]),
+                         np.arange(movu0.shape[0] * movu0.shape[1]),
+                         Th2).reshape(movu0.shape[:2]) for movu0 in movu
+    ]
+    # pixel-major movie, so that the time series of the pixels of an ROI are contiguous
+    mov = pixel_major(mov)
+
+    if tile_size > 0:
+        v_max, ihop, v_split, stats = extract_rois_tiled(
+            mov, movu, v_map, gxy, sdmov, Th2, vmultiplier, max_iterations, percentile,
+            tile_size=tile_size, halo=2 * spatscale_pix, n_workers=n_workers)
+    else:
+        v_max, ihop, v_split, stats = extract_rois(mov, movu, v_map, gxy, sdmov, Th2,
+                                                   vmultiplier, max_iterations,
+                                                   percentile, mask_window=mask_window)
+
+    new_ops = {
+        "max_proj": max_proj,
+        "Vmax": v_max,
+        "ihop": ihop,
+        "Vsplit": v_split,
+        "Vcorr": v_corr,
+        "Vmap": np.asanyarray(
+            v_map, dtype="object"
+        ),  # needed so that scipy.io.savemat doesn"t fail in runpipeline with latest numpy (v1.24.3). dtype="object" is needed to have numpy array with elements having diff sizes
+        "spatscale_pix": spatscale_pix,
+    }
+
+    return new_ops, stats
+
 
-    mov = np.reshape(mov, (-1, Lyc * Lxc))
+def extract_rois(mov: np.ndarray, movu: List[np.ndarray], v_map: List[np.ndarray],
+                 gxy: List[np.ndarray], sdmov: np.ndarray, Th2: float, vmultiplier: float,
+                 max_iterations: int, percentile=0, mask_window=0):
+    """Returns ROIs extracted one by one from the peaks of v_map (see sparsery).
+
+    Parameters
+    ----------
+    mov: Lyc x Lxc x nbinned
+        normalized movie, pixel-major (see pixel_major)
+    movu: list of Lyp x Lxp x nbinned
+        movie filtered at each spatial scale, pixel-major
+    v_map: list of Lyp x Lxp
+        thresholded norm of movu at each spatial scale
+    gxy: list of 2 x Lyp x Lxp
+        x and y positions in mov of the pixels at each spatial scale
+    sdmov: Lyc x Lxc
+        standard deviation of the movie, to scale the ROI weights
+    Th2: float
+        threshold for the active frames of the ROIs
+    vmultiplier: float
+        multiplier of the threshold for the peaks
+    max_iterations: int
+        maximum number of ROIs
+
+    Returns
+    -------
+    v_max, ihop, v_split: max_iterations
+        peak, spatial scale and split ratio of each ROI
+    stats: list of dicts
+        "ypix", "xpix", "lam", "med", "footprint" of each ROI
+    """
+    Lyc, Lxc, nbinned = mov.shape
+    Lyp = [movu0.shape[0] for movu0 in movu]
+    Lxp = [movu0.shape[1] for movu0 in movu]
+    # frames of each pixel in rows (the movies are modified in place)
+    movu = [movu0.reshape(-1, nbinned) for movu0 in movu]
+    mov = mov.reshape(-1, nbinned)
     lxs = 3 * 2**np.arange(5)
     nscales = len(lxs)
 
@@ -380,7 +548,7 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
         ypix0, xpix0, lam0 = add_square(yi, xi, ls, Lyc, Lxc)
 
         # project movie into square to get time series
-        tproj = (mov[:, ypix0 * Lxc + xpix0] * lam0[0]).sum(axis=-1)
+        tproj = (mov[ypix0 * Lxc + xpix0] * lam0[0]).sum(axis=0)
         if percentile > 0:
             threshold = min(Th2, np.percentile(tproj, percentile))
         else:
@@ -389,31 +557,26 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
 
         # get square around seed
         if extract_patches:
-            mask = mov[active_frames].mean(axis=0).reshape(Lyc, Lxc)
+            mask = mov[:, active_frames].mean(axis=1).reshape(Lyc, Lxc)
             patches.append(utils.square_mask(mask, mask_window, yi, xi))
             seeds.append([yi, xi])
 
         # extend mask based on activity similarity
         for j in range(3):
             ypix0, xpix0, lam0 = iter_extend(ypix0, xpix0, mov, Lyc, Lxc, active_frames)
-            tproj = mov[:, ypix0 * Lxc + xpix0] @ lam0
+            tproj = lam0 @ mov[ypix0 * Lxc + xpix0]
             active_frames = np.nonzero(tproj > threshold)[0]
             if len(active_frames) < 1:
-                if tj < nmasks:
-                    continue
-                else:
-                    break
-        if len(active_frames) < 1:
-            if tj < nmasks:
-                continue
-            else:
                 break
+        if len(active_frames) < 1:
+            break
 
         # check if ROI should be split
-        v_split[tj], ipack = two_comps(mov[:, ypix0 * Lxc + xpix0], lam0, threshold)
+        v_split[tj], ipack = two_comps(mov[ypix0 * Lxc + xpix0].T, lam0, threshold)
         if v_split[tj] > 1.25:
             lam0, xp, active_frames = ipack
             tproj[active_frames] = xp
+            active_frames = np.nonzero(active_frames)[0]
             ix = lam0 > lam0.max() / 5
             xpix0 = xpix0[ix]
             ypix0 = ypix0[ix]
@@ -424,15 +587,13 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
             med = [ypix0[imin], xpix0[imin]]
 
         # update residual on raw movie
-        mov[np.ix_(active_frames,
-                   ypix0 * Lxc + xpix0)] -= tproj[active_frames][:, np.newaxis] * lam0
-        # update filtered movie
+        subtract_outer(mov, ypix0 * Lxc + xpix0, active_frames, tproj, lam0)
+        # update filtered movie, and its norm at the pixels of the ROI
         ys, xs, lms = multiscale_mask(ypix0, xpix0, lam0, Lyp, Lxp)
         for j in range(nscales):
-            movu[j][np.ix_(active_frames, xs[j] + Lxp[j] * ys[j])] -= np.outer(
-                tproj[active_frames], lms[j])
-            Mx = movu[j][:, xs[j] + Lxp[j] * ys[j]]
-            V1[j][ys[j], xs[j]] = (Mx**2 * np.float32(Mx > threshold)).sum(axis=0)**.5
+            ipix = xs[j] + Lxp[j] * ys[j]
+            subtract_outer(movu[j], ipix, active_frames, tproj, lms[j])
+            V1[j][ys[j], xs[j]] = thresholded_norm(movu[j], ipix, threshold)
 
         stats.append({
             "ypix": ypix0.astype(int),
@@ -445,16 +606,143 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
         if tj % 1000 == 0:
             print("%d ROIs, score=%2.2f" % (tj, v_max[tj]))
 
-    new_ops = {
-        "max_proj": max_proj,
-        "Vmax": v_max,
-        "ihop": ihop,
-        "Vsplit": v_split,
-        "Vcorr": v_corr,
-        "Vmap": np.asanyarray(
-            v_map, dtype="object"
-        ),  # needed so that scipy.io.savemat doesn"t fail in runpipeline with latest numpy (v1.24.3). dtype="object" is needed to have numpy array with elements having diff sizes
-        "spatscale_pix": spatscale_pix,
-    }
+    return v_max, ihop, v_split, stats
+
+
+def tile_ranges(L: int, tile_size: int, halo: int, align: int = 16):
+    """Returns the core and tile (core with a halo on each side) ranges of the tiles along
+    a dimension of size L. Tile sizes, halos and starts are multiples of align, so that
+    the tiles of the downsampled movies line up with the tiles of the movie."""
+    tile_size = align * max(1, int(np.ceil(tile_size / align)))
+    halo = align * int(np.ceil(halo / align))
+    return [((c0, min(L, c0 + tile_size)), (max(0, c0 - halo), min(L, c0 + tile_size + halo)))
+            for c0 in range(0, L, tile_size)]
+
+
+def duplicate_rois(stats0: List[Dict[str, Any]], stats1: List[Dict[str, Any]]):
+    """Returns the pairs (i, j) of ROIs of stats0 and stats1 matched with an IoU >= 0.5.
+
+    The IoU is computed from the pixels of each pair of ROIs, so that overlapping ROIs of
+    the same tile are compared with all of their pixels."""
+    if len(stats0) == 0 or len(stats1) == 0:
+        return []
+    Lx = 1 + max(s["xpix"].max(initial=0) for s in stats0 + stats1)
+    ipix0, ipix1 = [[np.unique(s["ypix"] * Lx + s["xpix"]) for s in stats]
+                    for stats in [stats0, stats1]]
+    iou = np.zeros((len(stats0), len(stats1)))
+    for i, p0 in enumerate(ipix0):
+        for j, p1 in enumerate(ipix1):
+            if p0.size == 0 or p1.size == 0 or p0[0] > p1[-1] or p1[0] > p0[-1]:
+                continue
+            n = np.intersect1d(p0, p1, assume_unique=True).size
+            iou[i, j] = n / (p0.size + p1.size - n)
+    iout, preds = utils.match_masks(iou)
+    return [(i, preds[i] - 1) for i in np.nonzero(iout >= 0.5)[0]]
 
-    return new_ops, stats
+
+def _init_tile_worker(nthreads: int):
+    numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))
+
+
+def _extract_tile_rois(args):
+    return extract_rois(*args)
+
+
+def extract_rois_tiled(mov: np.ndarray, movu: List[np.ndarray], v_map: List[np.ndarray],
+                       gxy: List[np.ndarray], sdmov: np.ndarray, Th2: float,
+                       vmultiplier: float, max_iterations: int, percentile=0,
+                       tile_size: int = 256, halo: int = 12, n_workers: int = 0):
+    """Returns ROIs extracted from overlapping tiles of the field of view in parallel.
+
+    The field of view is split into tiles of tile_size pixels, and ROIs are extracted (see
+    extract_rois) from each tile extended by halo pixels on each side, on a pool of
+    n_workers processes (0 uses all cores). An ROI is kept if its median pixel is in the
+    core of its tile, and if an ROI of a neighboring tile matches it (see match_masks),
+    only the one with the larger peak is kept. ROIs are sorted by peak, and the
+    max_iterations ROIs with the largest peaks are returned.
+
+    Parameters and returns are as in extract_rois.
+    """
+    Lyc, Lxc, _ = mov.shape
+    tiles = [(yr, xr) for yr in tile_ranges(Lyc, tile_size, halo)
+             for xr in tile_ranges(Lxc, tile_size, halo)]
+
+    def tile_args(yr, xr):
+        (y0, y1), (x0, x1) = yr[1], xr[1]
+        sl = [(slice(y0 >> j, -(-y1 // 2**j)), slice(x0 >> j, -(-x1 // 2**j)))
+              for j in range(len(movu))]
+        origin = np.array([x0, y0], np.float32)[:, np.newaxis, np.newaxis]
+        return (np.ascontiguousarray(mov[y0:y1, x0:x1]),
+                [np.ascontiguousarray(movu0[sy, sx]) for movu0, (sy, sx) in zip(movu, sl)],
+                [v_map0[sy, sx].copy() for v_map0, (sy, sx) in zip(v_map, sl)],
+                [gxy0[:, sy, sx] - origin for gxy0, (sy, sx) in zip(gxy, sl)],
+                sdmov[y0:y1, x0:x1], Th2, vmultiplier, max_iterations, percentile)
+
+    n_workers = min(len(tiles), n_workers or os.cpu_count() or 1)
+    print("extracting ROIs from %d tiles on %d workers" % (len(tiles), n_workers))
+    outputs = [None] * len(tiles)
+    if n_workers > 1:
+        nthreads = max(1, (os.cpu_count() or 1) // n_workers)
+        # tiles are copied to the workers as they are submitted, one per worker
+        with ProcessPoolExecutor(n_workers, mp_context=get_context("spawn"),
+                                 initializer=_init_tile_worker,
+                                 initargs=(nthreads,)) as pool:
+            pending, running = list(range(len(tiles))), {}
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < n_workers:
+                    i = pending.pop(0)
+                    running[pool.submit(_extract_tile_rois, tile_args(*tiles[i]))] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outputs[running.pop(future)] = future.result()
+    else:
+        for i, (yr, xr) in enumerate(tiles):
+            outputs[i] = _extract_tile_rois(tile_args(yr, xr))
+
+    # ROIs with their median in the core of their tile, in the coordinates of mov
+    rois = []
+    for (yr, xr), (v_max, ihop, v_split, stats) in zip(tiles, outputs):
+        (cy0, cy1), (y0, _) = yr
+        (cx0, cx1), (x0, _) = xr
+        rois.append([])
+        for k, stat in enumerate(stats):
+            stat["ypix"] += y0
+            stat["xpix"] += x0
+            stat["med"] = [stat["med"][0] + y0, stat["med"][1] + x0]
+            if cy0 <= stat["med"][0] < cy1 and cx0 <= stat["med"][1] < cx1:
+                rois[-1].append((v_max[k], ihop[k], v_split[k], stat))
+
+    # remove ROIs found in the overlap of neighboring tiles
+    for i0, (yr0, xr0) in enumerate(tiles):
+        for i1 in range(i0 + 1, len(tiles)):
+            (yr1, xr1) = tiles[i1]
+            y0, y1 = max(yr0[1][0], yr1[1][0]), min(yr0[1][1], yr1[1][1])
+            x0, x1 = max(xr0[1][0], xr1[1][0]), min(xr0[1][1], xr1[1][1])
+            if y0 >= y1 or x0 >= x1:
+                continue
+            # ROIs with pixels in the overlap of the tiles
+            inds = [[
+                k for k, roi in enumerate(rois[i]) if np.any(
+                    (roi[3]["ypix"] >= y0) & (roi[3]["ypix"] < y1) &
+                    (roi[3]["xpix"] >= x0) & (roi[3]["xpix"] < x1))
+            ] for i in [i0, i1]]
+            drop = [set(), set()]
+            for k0, k1 in duplicate_rois([rois[i0][k][3] for k in inds[0]],
+                                         [rois[i1][k][3] for k in inds[1]]):
+                k0, k1 = inds[0][k0], inds[1][k1]
+                if rois[i0][k0][0] >= rois[i1][k1][0]:
+                    drop[1].add(k1)
+                else:
+                    drop[0].add(k0)
+            for i, d in zip([i0, i1], drop):
+                rois[i] = [roi for k, roi in enumerate(rois[i]) if k not in d]
+
+    rois = sorted([roi for tile_rois in rois for roi in tile_rois],
+                  key=lambda roi: -roi[0])[:max_iterations]
+    v_max = np.zeros(max_iterations)
+    ihop = np.zeros(max_iterations)
+    v_split = np.zeros(max_iterations)
+    for k, roi in enumerate(rois):
+        v_max[k], ihop[k], v_split[k] = roi[:3]
+    print("%d ROIs in tiles" % len(rois))
+    return v_max, ihop, v_split, [roi[3] for roi in rois]
@@ -234,15 +234,19 @@ def downsample(mov: np.ndarray, taper_edge: bool = True) -> np.ndarray:
     """
     n_frames, Ly, Lx = mov.shape
 
-    # bin along Y
+    # bin along Y (averaging pairs of rows in place)
     movd = np.zeros((n_frames, int(np.ceil(Ly / 2)), Lx), "float32")
-    movd[:, :Ly // 2, :] = np.mean([mov[:, 0:-1:2, :], mov[:, 1::2, :]], axis=0)
+    movd[:, :Ly // 2, :] = mov[:, 0:-1:2, :]
+    movd[:, :Ly // 2, :] += mov[:, 1::2, :]
+    movd[:, :Ly // 2, :] /= 2
     if Ly % 2 == 1:
         movd[:, -1, :] = mov[:, -1, :] / 2 if taper_edge else mov[:, -1, :]
 
     # bin along X
     mov2 = np.zeros((n_frames, int(np.ceil(Ly / 2)), int(np.ceil(Lx / 2))), "float32")
-    mov2[:, :, :Lx // 2] = np.mean([movd[:, :, 0:-1:2], movd[:, :, 1::2]], axis=0)
+    mov2[:, :, :Lx // 2] = movd[:, :, 0:-1:2]
+    mov2[:, :, :Lx // 2] += movd[:, :, 1::2]
+    mov2[:, :, :Lx // 2] /= 2
     if Lx % 2 == 1:
         mov2[:, :, -1] = movd[:, :, -1] / 2 if taper_edge else movd[:, :, -1]
 
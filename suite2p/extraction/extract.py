@@ -9,11 +9,11 @@ from numba import prange, njit, jit, int64, float32
 from numba.typed import List
 from scipy import stats, signal
 from .masks import create_masks
-from ..io import BinaryFile
+from ..io import BinaryFile, iter_batches
 from .. import default_ops
 
 
-def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500):
+def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500, prefetch=1):
     """ extracts activity from f_in using masks in stat and neuropil_masks
     
     computes fluorescence F as sum of pixels weighted by "lam"
@@ -41,6 +41,9 @@ def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500):
 
     batch_size : int
         function will run with at most batch size of 1000
+
+    prefetch : int
+        number of batches to read ahead from f_in if it is an io.BinaryFile
     
     Returns
     ----------------
@@ -91,8 +94,7 @@ def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500):
         neuropil_ipix = None
 
     ix = 0
-    for k in np.arange(0, n_frames, batch_size):
-        data = f_in[k:min(k + batch_size, n_frames)].astype("float32")
+    for k, data in iter_batches(f_in, batch_size, prefetch=prefetch):
         nimg = data.shape[0]
         if nimg == 0:
             break
@@ -141,14 +143,17 @@ def extract_traces_from_masks(ops, cell_masks, neuropil_masks):
     
     """
     batch_size = ops["batch_size"]
+    prefetch = ops.get("prefetch_batches", 1)
     F_chan2, Fneu_chan2 = [], []
     with BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"], filename=ops["reg_file"]) as f:
-        F, Fneu = extract_traces(f, cell_masks, neuropil_masks, batch_size=batch_size)
+        F, Fneu = extract_traces(f, cell_masks, neuropil_masks, batch_size=batch_size,
+                                 prefetch=prefetch)
     if "reg_file_chan2" in ops:
         with BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
                         filename=ops["reg_file_chan2"]) as f:
             F_chan2, Fneu_chan2 = extract_traces(f, cell_masks, neuropil_masks,
-                                                 batch_size=batch_size)
+                                                 batch_size=batch_size,
+                                                 prefetch=prefetch)
     return F, Fneu, F_chan2, Fneu_chan2
 
 
@@ -187,6 +192,7 @@ def extraction_wrapper(stat, f_reg, f_reg_chan2=None, cell_masks=None,
     """
     n_frames, Ly, Lx = f_reg.shape
     batch_size = ops["batch_size"]
+    prefetch = ops.get("prefetch_batches", 1)
     if cell_masks is None:
         t10 = time.time()
         cell_masks, neuropil_masks0 = create_masks(stat, Ly, Lx, ops)
@@ -194,10 +200,11 @@ def extraction_wrapper(stat, f_reg, f_reg_chan2=None, cell_masks=None,
             neuropil_masks = neuropil_masks0
         print("Masks created, %0.2f sec." % (time.time() - t10))
 
-    F, Fneu = extract_traces(f_reg, cell_masks, neuropil_masks, batch_size=batch_size)
+    F, Fneu = extract_traces(f_reg, cell_masks, neuropil_masks, batch_size=batch_size,
+                             prefetch=prefetch)
     if f_reg_chan2 is not None:
         F_chan2, Fneu_chan2 = extract_traces(f_reg_chan2, cell_masks, neuropil_masks,
-                                             batch_size=batch_size)
+                                             batch_size=batch_size, prefetch=prefetch)
     else:
         F_chan2, Fneu_chan2 = [], []
 
@@ -17,6 +17,7 @@ import json
 
 from . import masks, views, graphics, traces, classgui, utils
 from .. import registration
+from ..io import BinaryFile
 from ..io.save import compute_dydx
 
 
@@ -244,39 +245,20 @@ class BinaryPlayer(QMainWindow):
         self.cframe += 1
         if self.cframe > self.nframes - 1:
             self.cframe = 0
-            if self.LY > 0:
-                for n in range(len(self.reg_file)):
-                    self.reg_file[n].seek(0, 0)
-            else:
-                self.reg_file.seek(0, 0)
-                if self.wraw:
-                    self.reg_file_raw.seek(0, 0)
-                if self.wred:
-                    self.reg_file_chan2.seek(0, 0)
-                if self.wraw_wred:
-                    self.reg_file_raw_chan2.seek(0, 0)
         self.img = np.zeros((self.LY, self.LX), dtype=np.int16)
         for n in range(len(self.reg_loc)):
-            buff = self.reg_file[n].read(self.nbytesread[n])
-            img = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),
-                             (self.Ly[n], self.Lx[n]))
+            img = self.reg_file[n][self.cframe]
             self.img[self.dy[n]:self.dy[n] + self.Ly[n],
                      self.dx[n]:self.dx[n] + self.Lx[n]] = img
 
         if self.wred and self.red_on:
-            buff = self.reg_file_chan2.read(self.nbytesread[0])
-            imgred = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),
-                                (self.Ly[0], self.Lx[0]))[:, :, np.newaxis]
+            imgred = self.reg_file_chan2[self.cframe][:, :, np.newaxis]
             self.img = np.concatenate(
                 (self.img[:, :, np.newaxis], imgred, np.zeros_like(imgred)), axis=-1)
         if self.wraw and self.raw_on:
-            buff = self.reg_file_raw.read(self.nbytesread[0])
-            self.imgraw = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),
-                                     (self.Ly[0], self.Lx[0]))
+            self.imgraw = self.reg_file_raw[self.cframe]
             if self.wraw_wred:
-                buff = self.reg_file_raw_chan2.read(self.nbytesread[0])
-                imgred_raw = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),
-                                        (self.Ly[0], self.Lx[0]))[:, :, np.newaxis]
+                imgred_raw = self.reg_file_raw_chan2[self.cframe][:, :, np.newaxis]
                 self.imgraw = np.concatenate((self.imgraw[:, :, np.newaxis], imgred_raw,
                                               np.zeros_like(imgred_raw)), axis=-1)
             self.iside.setImage(self.imgraw, levels=self.srange)
@@ -403,7 +385,8 @@ class BinaryPlayer(QMainWindow):
                                      "data.bin"))
                 print(reg_file, os.path.isfile(reg_file))
                 self.reg_loc.append(reg_file)
-                self.reg_file.append(open(self.reg_loc[-1], "rb"))
+                self.reg_file.append(
+                    BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"], filename=self.reg_loc[-1]))
                 self.Ly.append(ops["Ly"])
                 self.Lx.append(ops["Lx"])
                 self.dy.append(dy[ipl])
@@ -441,8 +424,9 @@ class BinaryPlayer(QMainWindow):
                 ops["Lx"] = ops["Lxs"] if isinstance(ops["Lxs"], int) else ops["Lxs"][0]
                 dirname = os.path.join(os.path.dirname(filename), "suite2p/plane0/")
                 ops["reg_file"] = os.path.join(dirname, "data.bin")
-                nbytesread = np.int64(2 * ops["Ly"] * ops["Lx"])
-                ops["nframes"] = os.path.getsize(ops["reg_file"]) // nbytesread
+                with BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
+                                filename=ops["reg_file"]) as f:
+                    ops["nframes"] = f.n_frames
             self.LY = ops["Ly"]
             self.LX = ops["Lx"]
             self.Ly = [ops["Ly"]]
@@ -456,7 +440,9 @@ class BinaryPlayer(QMainWindow):
                 self.reg_loc = [
                     os.path.abspath(os.path.join(dirname, "data.bin"))
                 ]
-            self.reg_file = [open(self.reg_loc[-1], "rb")]
+            self.reg_file = [
+                BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"], filename=self.reg_loc[-1])
+            ]
             self.wraw = False
             self.wred = False
             self.wraw_wred = False
@@ -470,7 +456,8 @@ class BinaryPlayer(QMainWindow):
                     self.reg_loc_raw = os.path.abspath(
                         os.path.join(os.path.dirname(filename), "data_raw.bin"))
                 try:
-                    self.reg_file_raw = open(self.reg_loc_raw, "rb")
+                    self.reg_file_raw = BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
+                                                   filename=self.reg_loc_raw)
                     self.wraw = True
                 except:
                     self.wraw = False
@@ -480,7 +467,8 @@ class BinaryPlayer(QMainWindow):
                 else:
                     self.reg_loc_red = os.path.abspath(
                         os.path.join(os.path.dirname(filename), "data_chan2.bin"))
-                self.reg_file_chan2 = open(self.reg_loc_red, "rb")
+                self.reg_file_chan2 = BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
+                                                 filename=self.reg_loc_red)
                 self.wred = True
             if "reg_file_raw_chan2" in ops or "raw_file_chan2" in ops:
                 if self.reg_loc == ops["reg_file"]:
@@ -492,7 +480,8 @@ class BinaryPlayer(QMainWindow):
                     self.reg_loc_raw_chan2 = os.path.abspath(
                         os.path.join(os.path.dirname(filename), "data_raw_chan2.bin"))
                 try:
-                    self.reg_file_raw_chan2 = open(self.reg_loc_raw_chan2, "rb")
+                    self.reg_file_raw_chan2 = BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
+                                                         filename=self.reg_loc_raw_chan2)
                     self.wraw_wred = True
                 except:
                     self.wraw_wred = False
@@ -547,9 +536,6 @@ class BinaryPlayer(QMainWindow):
         self.srange = frames.mean() + frames.std() * np.array([-2, 5])
 
         self.movieLabel.setText(self.reg_loc[-1])
-        self.nbytesread = []
-        for n in range(len(self.reg_loc)):
-            self.nbytesread.append(2 * self.Ly[n] * self.Lx[n])
 
         #aspect ratio
         if "aspect" in ops:
@@ -812,15 +798,6 @@ class BinaryPlayer(QMainWindow):
         if self.playButton.isEnabled():
             self.cframe = np.maximum(0, np.minimum(self.nframes - 1, self.cframe))
             self.cframe = int(self.cframe)
-            # seek to absolute position
-            for n in range(len(self.reg_file)):
-                self.reg_file[n].seek(self.nbytesread[n] * self.cframe, 0)
-            if self.wraw:
-                self.reg_file_raw.seek(self.nbytesread[-1] * self.cframe, 0)
-            if self.wred:
-                self.reg_file_chan2.seek(self.nbytesread[-1] * self.cframe, 0)
-            if self.wraw_wred:
-                self.reg_file_raw_chan2.seek(self.nbytesread[-1] * self.cframe, 0)
             self.cframe -= 1
             self.next_frame()
 
@@ -842,7 +819,7 @@ class BinaryPlayer(QMainWindow):
     def compute_z(self, parent):
         ops, zcorr = registration.compute_zpos(self.zstack, self.ops[0])
         parent.ops = ops
-        self.zmax = np.argmax(gaussian_filter1d(zcorr.T.copy(), 2, axis=1), axis=1)
+        self.zmax = ops["zpos"]
         np.save(self.filename, ops)
         self.plot_zcorr()
 
@@ -858,19 +835,9 @@ class BinaryPlayer(QMainWindow):
 
 def subsample_frames(ops, nsamps, reg_loc):
     nFrames = ops["nframes"]
-    Ly = ops["Ly"]
-    Lx = ops["Lx"]
-    frames = np.zeros((nsamps, Ly, Lx), dtype="int16")
-    nbytesread = 2 * Ly * Lx
     istart = np.linspace(0, nFrames, 1 + nsamps).astype("int64")
-    reg_file = open(reg_loc, "rb")
-    for j in range(0, nsamps):
-        reg_file.seek(nbytesread * istart[j], 0)
-        buff = reg_file.read(nbytesread)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0)
-        buff = []
-        frames[j, :, :] = np.reshape(data, (Ly, Lx))
-    reg_file.close()
+    with BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"], filename=reg_loc) as reg_file:
+        frames = reg_file[istart[:nsamps]]
     return frames
 
 
@@ -10,5 +10,6 @@ from .movie import movie_to_binary
 from .tiff import mesoscan_to_binary, ome_to_binary, tiff_to_binary, generate_tiff_filename, save_tiff
 from .nd2 import nd2_to_binary
 from .dcam import dcimg_to_binary
-from .binary import BinaryFile, BinaryFileCombined
+from .binary import BinaryFile, BinaryFileCombined, ChunkedBinaryFile, bin_movie, iter_batches, write_behind
+from .binary import frames_hash, move_binary, remove_binary
 from .server import send_jobs
@@ -2,46 +2,184 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 from typing import Optional, Tuple, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from tifffile import TiffWriter
 
+import hashlib
+import json
 import os
+import queue
+import shutil
+import sys
+import threading
+import zlib
 
 import numpy as np
 
+from .chunked import ChunkedArray, ChunkedStore, header_filename, is_chunked_file
+
+# number of frames per checksummed chunk in the BinaryFile header
+CHECKSUM_FRAMES = 100
+# number of frames sampled from each binary by frames_hash
+HASH_SAMPLE_FRAMES = 64
+
+
+def read_header(filename: str) -> Optional[dict]:
+    """ returns the sidecar header of binary filename, or None if it has no header """
+    try:
+        with open(header_filename(filename), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_header(filename: str, Ly: int, Lx: int, dtype: str, n_frames: int,
+                 fs: Optional[float] = None, checksums: Optional[list] = None) -> None:
+    """
+    Writes the sidecar header of binary filename with its shape, dtype, byte order,
+    frame rate and the crc32 checksums of each chunk of CHECKSUM_FRAMES frames.
+    """
+    dtype = np.dtype(dtype)
+    byteorder = dtype.byteorder
+    if byteorder in "=|":
+        byteorder = "<" if sys.byteorder == "little" else ">"
+    header = {
+        "Ly": int(Ly),
+        "Lx": int(Lx),
+        "n_frames": int(n_frames),
+        "dtype": dtype.name,
+        "byteorder": byteorder,
+        "fs": None if fs is None else float(fs),
+        "chunk_frames": CHECKSUM_FRAMES,
+        "checksums": checksums if checksums is not None else [],
+    }
+    # write to a temporary file first so that a crash never leaves a partial header
+    tmp_filename = header_filename(filename) + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(header, f)
+    os.replace(tmp_filename, header_filename(filename))
+
+
+def move_binary(src: str, dst: str) -> None:
+    """ moves binary src to dst, together with its sidecar header if it has one """
+    shutil.move(src, dst)
+    if os.path.exists(header_filename(src)):
+        shutil.move(header_filename(src), header_filename(dst))
+
+
+def remove_binary(filename: str) -> None:
+    """ removes binary filename, together with its sidecar header if it has one """
+    os.remove(filename)
+    if os.path.exists(header_filename(filename)):
+        os.remove(header_filename(filename))
+
+
+def frames_hash(*fs) -> str:
+    """ hash of the shape, dtype and of frames sampled evenly in time from each of fs
+    (None entries are skipped), used as key of the registration and detection caches """
+    h = hashlib.sha1()
+    for f in fs:
+        if f is None:
+            continue
+        n_frames = f.shape[0]
+        inds = np.linspace(0, n_frames, 1 + min(HASH_SAMPLE_FRAMES, n_frames),
+                           dtype=int)[:-1]
+        frames = np.ascontiguousarray(f[inds])
+        h.update(repr((tuple(f.shape), str(frames.dtype))).encode())
+        h.update(frames.tobytes())
+    return h.hexdigest()
+
 
 class BinaryFile:
 
-    def __init__(self, Ly: int, Lx: int, filename: str, n_frames: int = None,
-                 dtype: str = "int16"):
+    def __new__(cls, Ly: Optional[int] = None, Lx: Optional[int] = None,
+                filename: str = None, n_frames: int = None, dtype: str = "int16",
+                compression: Optional[str] = None, fs: Optional[float] = None):
+        # chunked, compressed binaries are opened behind the same interface
+        if cls is BinaryFile and filename is not None and (
+                is_chunked_file(filename) or
+            (compression and not os.path.exists(filename))):
+            cls = ChunkedBinaryFile
+        return super().__new__(cls)
+
+    def __init__(self, Ly: Optional[int] = None, Lx: Optional[int] = None,
+                 filename: str = None, n_frames: int = None, dtype: str = "int16",
+                 compression: Optional[str] = None, fs: Optional[float] = None):
         """
         Creates/Opens a Suite2p BinaryFile for reading and/or writing image data that acts like numpy array
 
+        The shape, dtype and frame rate of the file, and a checksum of each chunk of
+        frames, are kept in a sidecar header (filename + ".json"), so files with a
+        header can be opened from their filename alone.
+
         Parameters
         ----------
         Ly: int
-            The height of each frame
+            The height of each frame (read from the header if None)
         Lx: int
-            The width of each frame
+            The width of each frame (read from the header if None)
         filename: str
             The filename of the file to read from or write to
+        n_frames: int
+            The number of frames, required when creating a file
+        dtype: str
+            The data type of the frames when creating a file
+        compression: str
+            If not None, new files are created as chunked, compressed binaries with
+            this codec ('zlib', 'lz4' or 'zstd'). Existing files are opened in the
+            format they were written in.
+        fs: float
+            The frame rate, stored in the header
         """
-        self.Ly = Ly
-        self.Lx = Lx
+        if filename is None:
+            raise ValueError("need to provide filename")
         self.filename = filename
-        self.dtype = dtype
         write = (not os.path.exists(self.filename))
+        header = None if write else read_header(self.filename)
+        if header is not None:
+            if (Ly, Lx) != (None, None) and (Ly, Lx) != (header["Ly"], header["Lx"]):
+                raise ValueError("Ly, Lx = %s do not match the header of %s (%d, %d)" %
+                                 ((Ly, Lx), self.filename, header["Ly"], header["Lx"]))
+            Ly, Lx, dtype = header["Ly"], header["Lx"], header["dtype"]
+            fs = header.get("fs") if fs is None else fs
+        elif Ly is None or Lx is None:
+            raise ValueError("need to provide Ly and Lx for files without a header")
+        self.Ly = int(Ly)
+        self.Lx = int(Lx)
+        self.dtype = dtype
+        self.fs = fs
 
         if write and n_frames is None:
             raise ValueError(
                 "need to provide number of frames n_frames when writing file")
         elif not write:
-            n_frames = self.n_frames
+            n_frames = header["n_frames"] if header is not None else self.n_frames
+        self._n_frames = n_frames
         shape = (n_frames, self.Ly, self.Lx)
         mode = "w+" if write else "r+"
-        self.file = np.memmap(self.filename, mode=mode, dtype=self.dtype, shape=shape)
+        byteorder = header.get("byteorder", "=") if header is not None else "="
+        self.file = np.memmap(self.filename, mode=mode,
+                              dtype=np.dtype(self.dtype).newbyteorder(byteorder),
+                              shape=shape)
         self._index = 0
         self._can_read = True
+        self._writer = None
+        self._write_queue = None
+        self._free_buffers = None
+        self._write_error = None
+
+        n_chunks = -(-n_frames // CHECKSUM_FRAMES)
+        if header is not None and len(header.get("checksums", [])) == n_chunks:
+            self._checksums = list(header["checksums"])
+        else:
+            self._checksums = [None] * n_chunks
+        self._dirty_chunks = set()
+        self._checksum_lock = threading.Lock()
+        # header is (re)written for new or modified files
+        self._modified = write
+        if write:
+            self._write_header()
 
     @staticmethod
     def convert_numpy_file_to_suite2p_binary(from_filename: str,
@@ -61,7 +199,7 @@ class BinaryFile:
     @property
     def nbytesread(self):
         """number of bytes per frame (FIXED for given file)"""
-        return np.int64(2 * self.Ly * self.Lx)
+        return np.int64(np.dtype(self.dtype).itemsize * self.Ly * self.Lx)
 
     @property
     def nbytes(self):
@@ -71,6 +209,8 @@ class BinaryFile:
     @property
     def n_frames(self) -> int:
         """total number of frames in the file."""
+        if getattr(self, "_n_frames", None) is not None:
+            return self._n_frames
         return int(self.nbytes // self.nbytesread)
 
     @property
@@ -102,10 +242,156 @@ class BinaryFile:
 
     def close(self) -> None:
         """
-        Closes the file.
+        Closes the file, flushing any pending write-behind writes and the header to disk
+        first.
         """
+        self.stop_write_behind()
+        if self._modified:
+            self._write_header()
         self.file._mmap.close()
 
+    def _write_header(self) -> None:
+        """ checksums the chunks partially written since the last call and writes the header """
+        with self._checksum_lock:
+            dirty, self._dirty_chunks = self._dirty_chunks, set()
+        for ichunk in dirty:
+            self._checksums[ichunk] = self._chunk_checksum(ichunk)
+        write_header(self.filename, Ly=self.Ly, Lx=self.Lx, dtype=self.dtype,
+                     n_frames=self.n_frames, fs=self.fs, checksums=self._checksums)
+
+    def _chunk_checksum(self, ichunk: int) -> int:
+        frames = self.file[ichunk * CHECKSUM_FRAMES:(ichunk + 1) * CHECKSUM_FRAMES]
+        return zlib.crc32(np.ascontiguousarray(frames))
+
+    def verify(self) -> np.ndarray:
+        """
+        Checks the frames against the chunk checksums in the header, e.g. to find the
+        frames that were not completely written before a crash.
+
+        Returns
+        -------
+        bad_frames: bool array
+            True for frames in chunks whose checksum is missing or does not match
+        """
+        bad_frames = np.zeros(self.n_frames, dtype=bool)
+        for ichunk, checksum in enumerate(self._checksums):
+            if checksum is None or checksum != self._chunk_checksum(ichunk):
+                bad_frames[ichunk * CHECKSUM_FRAMES:(ichunk + 1) * CHECKSUM_FRAMES] = True
+        return bad_frames
+
+    def start_write_behind(self, max_pending: int = 2) -> None:
+        """
+        Starts a background writer thread, after which frames assigned to the file are
+        written to disk asynchronously.
+
+        Assigned data is clipped and cast to the dtype of the file (int16) in one pass into
+        one of (max_pending + 1) buffers owned by the writer, so the caller can reuse its
+        buffers straight away. At most max_pending batches are queued, further assignments
+        block until the writer frees a buffer.
+
+        Parameters
+        ----------
+        max_pending: int
+            The maximum number of batches waiting to be written
+        """
+        if self._writer is not None:
+            return
+        self._write_queue = queue.Queue(maxsize=max(1, max_pending))
+        # buffers are allocated on first use, for the size of the assigned batches
+        self._free_buffers = queue.Queue()
+        for _ in range(max(1, max_pending) + 1):
+            self._free_buffers.put(None)
+        self._write_error = None
+        self._writer = threading.Thread(target=self._write_worker, daemon=True)
+        self._writer.start()
+
+    def stop_write_behind(self) -> None:
+        """
+        Waits for all pending writes, flushes them to disk and stops the writer thread.
+        """
+        if self._writer is None:
+            return
+        self._write_queue.put(None)
+        self._writer.join()
+        self._writer, self._write_queue, self._free_buffers = None, None, None
+        self.file.flush()
+        self._raise_write_error()
+
+    def flush(self) -> None:
+        """
+        Waits for all pending writes and flushes the file and its header to disk.
+        """
+        self._wait_for_writes()
+        self.file.flush()
+        if self._modified:
+            self._write_header()
+
+    def _wait_for_writes(self) -> None:
+        if self._writer is not None:
+            self._write_queue.join()
+            self._raise_write_error()
+
+    def _raise_write_error(self) -> None:
+        if self._write_error is not None:
+            error, self._write_error = self._write_error, None
+            raise error
+
+    def _write_worker(self) -> None:
+        while True:
+            item = self._write_queue.get()
+            try:
+                if item is None:
+                    return
+                indices, data, buffer = item
+                if self._write_error is None:
+                    self._write(indices, data)
+            except Exception as e:
+                self._write_error = e
+            finally:
+                if item is not None:
+                    self._free_buffers.put(buffer)
+                self._write_queue.task_done()
+
+    def _write(self, indices, data) -> None:
+        if data.dtype != self.dtype and np.dtype(self.dtype) == np.int16:
+            data = np.minimum(data, 2**15 - 2).astype("int16")
+        self.file[indices] = data
+        self._modified = True
+        self._update_checksums(indices, data)
+
+    def _update_checksums(self, indices, data) -> None:
+        """
+        Checksums the chunks entirely written by data (in the writer thread with
+        write-behind), and marks the partially written chunks to be checksummed from the
+        file when the header is written.
+        """
+        findices = indices[0] if isinstance(indices, tuple) else indices
+        crop = indices[1:] if isinstance(indices, tuple) else ()
+        checksums, dirty = {}, set()
+        if isinstance(findices, slice):
+            start, stop, step = findices.indices(self.n_frames)
+            chunks = range(start // CHECKSUM_FRAMES, -(-stop // CHECKSUM_FRAMES))
+            whole_frames = (step == 1 and all(c == slice(None) for c in crop) and
+                            np.shape(data) == (stop - start, self.Ly, self.Lx))
+            if whole_frames:
+                data = np.ascontiguousarray(data, dtype=self.file.dtype)
+            for ichunk in chunks:
+                c0 = ichunk * CHECKSUM_FRAMES
+                c1 = min(c0 + CHECKSUM_FRAMES, self.n_frames)
+                if whole_frames and start <= c0 and c1 <= stop:
+                    checksums[ichunk] = zlib.crc32(data[c0 - start:c1 - start])
+                else:
+                    dirty.add(ichunk)
+        else:
+            dirty.update(
+                np.unique(np.atleast_1d(np.arange(self.n_frames)[findices]) //
+                          CHECKSUM_FRAMES).tolist())
+        with self._checksum_lock:
+            for ichunk, checksum in checksums.items():
+                self._checksums[ichunk] = checksum
+                self._dirty_chunks.discard(ichunk)
+            self._dirty_chunks.update(dirty)
+
     def __enter__(self):
         return self
 
@@ -114,13 +400,25 @@ class BinaryFile:
 
     def __setitem__(self, *items):
         indices, data = items
-        if data.dtype != "int16":
-            self.file[indices] = np.minimum(data, 2**15 - 2).astype("int16")
+        if self._writer is not None:
+            self._raise_write_error()
+            data = np.asarray(data)
+            buffer = self._free_buffers.get()
+            if buffer is None or buffer.size < data.size:
+                buffer = np.empty(data.shape, self.dtype)
+            out = buffer.reshape(-1)[:data.size].reshape(data.shape)
+            if data.dtype != self.dtype and np.dtype(self.dtype) == np.int16:
+                np.minimum(data, 2**15 - 2, out=out, casting="unsafe")
+            else:
+                np.copyto(out, data, casting="unsafe")
+            self._write_queue.put((indices, out, buffer))
         else:
-            self.file[indices] = data
+            self._write(indices, data)
 
     def __getitem__(self, *items):
         indices, *crop = items
+        # make sure reads see all frames written so far
+        self._wait_for_writes()
         return self.file[indices]
 
     def sampled_mean(self) -> float:
@@ -133,6 +431,82 @@ class BinaryFile:
         frames = self.file[inds].astype(np.float32)
         return frames.mean(axis=0)
 
+    def iter_batches(self, batch_size: int, prefetch: int = 1, n_frames: Optional[int] = None,
+                     crop: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None):
+        """
+        Iterates over the file in batches of frames, reading ahead in a background thread.
+
+        The reader thread fills a bounded pool of (prefetch + 1) preallocated buffers, so
+        disk reads of the next batches overlap with computation on the current one. The
+        yielded frames are a view into one of these buffers and are only valid until the
+        next batch is requested (copy them if they need to be kept).
+
+        Parameters
+        ----------
+        batch_size: int
+            The number of frames in each batch
+        prefetch: int
+            The number of batches to read ahead (0 reads synchronously in the calling thread)
+        n_frames: int
+            The number of frames to iterate over, from the start of the file (default all)
+        crop: (int, int), (int, int)
+            Crops the frames to y_range, x_range while reading
+
+        Yields
+        ------
+        k: int
+            The index of the first frame in the batch
+        frames: nImg x Ly x Lx
+            The frames in the batch
+        """
+        n_frames = self.n_frames if n_frames is None else min(n_frames, self.n_frames)
+        y_range, x_range = crop if crop is not None else ((0, self.Ly), (0, self.Lx))
+        ysl, xsl = slice(*y_range), slice(*x_range)
+        if prefetch < 1:
+            for k in range(0, n_frames, batch_size):
+                yield k, self.file[k:min(k + batch_size, n_frames), ysl, xsl]
+            return
+
+        Lyc, Lxc = y_range[1] - y_range[0], x_range[1] - x_range[0]
+        buffers = [
+            np.empty((batch_size, Lyc, Lxc), self.dtype) for _ in range(prefetch + 1)
+        ]
+        free, ready = queue.Queue(), queue.Queue()
+        for ibuf in range(len(buffers)):
+            free.put(ibuf)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for k in range(0, n_frames, batch_size):
+                    ibuf = free.get()
+                    if stop.is_set():
+                        return
+                    nimg = min(batch_size, n_frames - k)
+                    np.copyto(buffers[ibuf][:nimg], self.file[k:k + nimg, ysl, xsl])
+                    ready.put((k, ibuf, nimg))
+                ready.put(None)
+            except Exception as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                k, ibuf, nimg = item
+                yield k, buffers[ibuf][:nimg]
+                free.put(ibuf)
+        finally:
+            # wake up the reader if it is waiting on a buffer so that it can exit
+            stop.set()
+            free.put(0)
+            thread.join()
+
     @property
     def data(self) -> np.ndarray:
         """
@@ -148,10 +522,13 @@ class BinaryFile:
     def bin_movie(self, bin_size: int, x_range: Optional[Tuple[int, int]] = None,
                   y_range: Optional[Tuple[int, int]] = None,
                   bad_frames: Optional[np.ndarray] = None,
-                  reject_threshold: float = 0.5) -> np.ndarray:
+                  reject_threshold: float = 0.5, n_workers: int = 1,
+                  filename: Optional[str] = None) -> np.ndarray:
         """
         Returns binned movie that rejects bad_frames (bool array) and crops to (y_range, x_range).
 
+        See bin_movie.
+
         Parameters
         ----------
         bin_size: int
@@ -163,35 +540,20 @@ class BinaryFile:
         bad_frames: int array
             The indices to *not* include.
         reject_threshold: float
+            bad_frames are only excluded if the fraction of good frames is above this
+        n_workers: int
+            The number of threads binning the frames
+        filename: str
+            If given, the binned movie is written to this .npy file and returned as a memmap
 
         Returns
         -------
         frames: nImg x Ly x Lx
             The frames
         """
-
-        good_frames = ~bad_frames if bad_frames is not None else np.ones(
-            self.n_frames, dtype=bool)
-
-        batch_size = min(np.sum(good_frames), 500)
-        batches = []
-        for k in np.arange(0, self.n_frames, batch_size):
-            indices = slice(k, min(k + batch_size, self.n_frames))
-            data = self.file[indices]
-
-            if x_range is not None and y_range is not None:
-                data = data[:, slice(*y_range), slice(*x_range)]  # crop
-
-            good_indices = good_frames[indices]
-            if np.mean(good_indices) > reject_threshold:
-                data = data[good_indices]
-
-            if data.shape[0] > bin_size:
-                data = binned_mean(mov=data, bin_size=bin_size)
-                batches.extend(data)
-
-        mov = np.stack(batches)
-        return mov
+        return bin_movie(self, bin_size, y_range=y_range, x_range=x_range,
+                         bad_frames=bad_frames, reject_threshold=reject_threshold,
+                         n_workers=n_workers, filename=filename)
 
     def write_tiff(self, fname, range_dict={}):
         "Writes BinaryFile's contents using selected ranges from range_dict into a tiff file."
@@ -212,6 +574,148 @@ class BinaryFile:
                 f.write(curr_frame, contiguous=True)
         print('Tiff has been saved to {}'.format(fname))
 
+
+class ChunkedBinaryFile(BinaryFile):
+
+    def __init__(self, Ly: Optional[int] = None, Lx: Optional[int] = None,
+                 filename: str = None, n_frames: int = None, dtype: str = "int16",
+                 compression: Optional[str] = None, fs: Optional[float] = None):
+        """
+        A BinaryFile stored as independently compressed chunks with a chunk index, so that
+        any frame can be read or written by (de)compressing only the chunks it overlaps.
+        The shape and dtype are kept in the file's own header rather than a sidecar.
+
+        Created by BinaryFile(...) when compression is given or the file is chunked.
+        """
+        self.filename = filename
+        write = (not os.path.exists(self.filename))
+
+        if write and n_frames is None:
+            raise ValueError(
+                "need to provide number of frames n_frames when writing file")
+        store = ChunkedStore(self.filename, codec=compression, Ly=Ly or 0, Lx=Lx or 0,
+                             dtype=dtype)
+        if store.Ly == 0:
+            raise ValueError("need to provide Ly and Lx for files without a header")
+        self.Ly, self.Lx, self.dtype, self.fs = store.Ly, store.Lx, store.dtype, fs
+        self.file = ChunkedArray(store, Ly=self.Ly, Lx=self.Lx, dtype=self.dtype)
+        if write:
+            store.resize(n_frames * self.file.frame_bytes)
+        self._n_frames = None
+        self._index = 0
+        self._can_read = True
+        self._writer = None
+        self._write_queue = None
+        self._free_buffers = None
+        self._write_error = None
+        self._modified = False
+
+    @property
+    def nbytes(self):
+        """total number of (uncompressed) bytes in the file."""
+        return self.file.store.nbytes
+
+    def close(self) -> None:
+        """
+        Closes the file, flushing any pending writes and the chunk index to disk first.
+        """
+        self.stop_write_behind()
+        self.file.store.close()
+
+    def _write_header(self) -> None:
+        self.file.store.flush()
+
+    def _update_checksums(self, indices, data) -> None:
+        # chunks are checked by decompressing them (see verify)
+        pass
+
+    def verify(self) -> np.ndarray:
+        """
+        Checks that every chunk was written and can be decompressed.
+
+        Returns
+        -------
+        bad_frames: bool array
+            True for frames overlapping chunks that are missing or corrupt
+        """
+        store = self.file.store
+        frame_bytes = self.file.frame_bytes
+        bad_frames = np.zeros(self.n_frames, dtype=bool)
+        for ichunk in range(len(store.index)):
+            try:
+                bad = store.index[ichunk, 1] == 0 or store.read_chunk(ichunk) is None
+            except Exception:
+                bad = True
+            if bad:
+                start = ichunk * store.chunk_bytes // frame_bytes
+                stop = -(-(ichunk + 1) * store.chunk_bytes // frame_bytes)
+                bad_frames[start:stop] = True
+        return bad_frames
+
+
+def iter_batches(f, batch_size: int, n_frames: Optional[int] = None, prefetch: int = 1,
+                 crop: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None):
+    """
+    Iterates over frames of a BinaryFile or any slice-indexable array in batches.
+
+    BinaryFiles are read ahead in a background thread (see BinaryFile.iter_batches),
+    other arrays are sliced synchronously.
+
+    Parameters
+    ----------
+    f: BinaryFile or array
+        n_frames x Ly x Lx
+    batch_size: int
+        The number of frames in each batch
+    n_frames: int
+        The number of frames to iterate over, from the start of f (default all)
+    prefetch: int
+        The number of batches to read ahead for BinaryFiles
+    crop: (int, int), (int, int)
+        Crops the frames to y_range, x_range
+
+    Yields
+    ------
+    k: int
+        The index of the first frame in the batch
+    frames: nImg x Ly x Lx
+        The frames in the batch
+    """
+    if isinstance(f, BinaryFile):
+        yield from f.iter_batches(batch_size, prefetch=prefetch, n_frames=n_frames,
+                                  crop=crop)
+        return
+    n_frames = f.shape[0] if n_frames is None else min(n_frames, f.shape[0])
+    y_range, x_range = crop if crop is not None else ((0, f.shape[1]), (0, f.shape[2]))
+    for k in range(0, n_frames, batch_size):
+        yield k, f[k:min(k + batch_size, n_frames), slice(*y_range), slice(*x_range)]
+
+
+@contextmanager
+def write_behind(f, max_pending: int = 2):
+    """
+    Context manager writing to f asynchronously while it is active, if f is a BinaryFile.
+
+    All pending writes are flushed to disk on exit (see BinaryFile.start_write_behind).
+    Other arrays (and max_pending < 1) are written synchronously.
+
+    Parameters
+    ----------
+    f: BinaryFile or array
+        n_frames x Ly x Lx
+    max_pending: int
+        The maximum number of batches waiting to be written
+    """
+    if not isinstance(f, BinaryFile) or max_pending < 1 or f._writer is not None:
+        yield f
+        return
+    f.start_write_behind(max_pending=max_pending)
+    try:
+        yield f
+    finally:
+        f.stop_write_behind()
+
+
 def from_slice(s: slice) -> Optional[np.ndarray]:
     """Creates an np.arange() array from a Python slice object.  Helps provide numpy-like slicing interfaces."""
     return np.arange(s.start, s.stop, s.step) if any([s.start, s.stop, s.step
@@ -225,6 +729,96 @@ def binned_mean(mov: np.ndarray, bin_size) -> np.ndarray:
     return mov.reshape(-1, bin_size, Ly, Lx).astype(np.float32).mean(axis=1)
 
 
+def bin_movie(f, bin_size: int, y_range: Optional[Tuple[int, int]] = None,
+              x_range: Optional[Tuple[int, int]] = None,
+              bad_frames: Optional[np.ndarray] = None, reject_threshold: float = 0.5,
+              batch_size: int = 500, n_workers: int = 1,
+              filename: Optional[str] = None) -> np.ndarray:
+    """
+    Returns the mean of each bin of bin_size consecutive good frames of f, cropped to
+    (y_range, x_range).
+
+    Bad frames are removed before binning, so bins span batch boundaries and the bad
+    frames in between. If the fraction of good frames is not above reject_threshold, all
+    frames are binned. Frames that do not fill a last bin are dropped (if there are fewer
+    good frames than bin_size, they are all averaged into one bin).
+
+    The bins are split into tasks of about batch_size / n_workers frames, which are read
+    and averaged by n_workers threads, so at most about batch_size frames are in memory.
+
+    Parameters
+    ----------
+    f: BinaryFile or array
+        n_frames x Ly x Lx
+    bin_size: int
+        The size of each bin
+    y_range: int, int
+        Crops the data to a minimum and maximum y range.
+    x_range: int, int
+        Crops the data to a minimum and maximum x range.
+    bad_frames: bool array
+        The frames to *not* include.
+    reject_threshold: float
+        bad_frames are only excluded if the fraction of good frames is above this
+    batch_size: int
+        The number of frames read at a time (by all workers)
+    n_workers: int
+        The number of threads binning the frames
+    filename: str
+        If given, the binned movie is written to this .npy file and returned as a memmap
+
+    Returns
+    -------
+    mov: nbins x Lyc x Lxc, float32
+        The binned movie
+    """
+    n_frames, Ly, Lx = f.shape
+    y_range = (0, Ly) if y_range is None or x_range is None else y_range
+    x_range = (0, Lx) if x_range is None or y_range is None else x_range
+    Lyc, Lxc = y_range[1] - y_range[0], x_range[1] - x_range[0]
+
+    good_frames = ~np.asarray(bad_frames, dtype=bool) if bad_frames is not None else None
+    if good_frames is None or good_frames.mean() <= reject_threshold:
+        good_frames = np.ones(n_frames, dtype=bool)
+    igood = np.nonzero(good_frames)[0]
+    bin_size = max(1, min(bin_size, len(igood)))
+    nbins = len(igood) // bin_size
+    igood = igood[:nbins * bin_size]
+
+    if filename is not None:
+        mov = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32,
+                                        shape=(nbins, Lyc, Lxc))
+    else:
+        mov = np.zeros((nbins, Lyc, Lxc), np.float32)
+
+    n_workers = max(1, n_workers)
+    bins_per_task = max(1, batch_size // (n_workers * bin_size))
+
+    def bin_task(ibin):
+        nb = min(bins_per_task, nbins - ibin)
+        inds = igood[ibin * bin_size:(ibin + nb) * bin_size]
+        # read only the good frames, one run of consecutive frames at a time
+        breaks = np.nonzero(np.diff(inds) > 1)[0] + 1
+        starts = inds[np.r_[0, breaks]]
+        ends = inds[np.r_[breaks - 1, len(inds) - 1]] + 1
+        data = np.concatenate([
+            f[start:end][:, y_range[0]:y_range[1], x_range[0]:x_range[1]]
+            for start, end in zip(starts, ends)
+        ])
+        mov[ibin:ibin + nb] = binned_mean(data, bin_size)
+
+    tasks = range(0, nbins, bins_per_task)
+    if n_workers > 1:
+        with ThreadPoolExecutor(n_workers) as pool:
+            list(pool.map(bin_task, tasks))
+    else:
+        for ibin in tasks:
+            bin_task(ibin)
+    if filename is not None:
+        mov.flush()
+    return mov
+
+
 @contextmanager
 def temporary_pointer(file):
     """context manager that resets file pointer location to its original place upon exit."""
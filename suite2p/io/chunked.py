@@ -0,0 +1,428 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+from typing import Optional, Tuple
+
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import lz4.frame
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+# file layout: fixed-size header, compressed chunks of the (uncompressed) movie bytes,
+# and a chunk index of (offset, nbytes, capacity) per chunk. Chunks and the index are
+# written copy-on-write into free space of the file, and the header only points to a new
+# index once the chunks it references are on disk, so the file is always readable
+MAGIC = b"S2PCHUNK"
+VERSION = 1
+HEADER_FORMAT = "<8sIII8s8sQQQQ"
+HEADER_SIZE = 128
+DEFAULT_CHUNK_BYTES = 4 * 2**20
+# number of chunks written between two commits of the chunk index and header
+COMMIT_CHUNKS = 16
+
+
+def _codec(name: str):
+    """ returns (compress, decompress) functions for codec name """
+    if name == "zlib":
+        return (lambda b: zlib.compress(b, 1)), zlib.decompress
+    elif name == "lz4":
+        if not HAS_LZ4:
+            raise ImportError("lz4 is required for this codec, please 'pip install lz4'")
+        return lz4.frame.compress, lz4.frame.decompress
+    elif name == "zstd":
+        if not HAS_ZSTD:
+            raise ImportError(
+                "zstandard is required for this codec, please 'pip install zstandard'")
+        return (zstandard.ZstdCompressor(level=1).compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError("unknown compression codec '%s' (use 'zlib', 'lz4' or 'zstd')" %
+                     name)
+
+
+def header_filename(filename: str) -> str:
+    """ returns the filename of the sidecar header of raw binary filename """
+    return str(filename) + ".json"
+
+
+def is_chunked_file(filename: str) -> bool:
+    """ returns True if filename exists and is a chunked, compressed suite2p binary """
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class ChunkedStore:
+
+    def __init__(self, filename: str, codec: Optional[str] = None,
+                 chunk_bytes: int = DEFAULT_CHUNK_BYTES, Ly: int = 0, Lx: int = 0,
+                 dtype: str = "int16"):
+        """
+        Byte-addressable storage of an uncompressed stream of frames in chunks of
+        chunk_bytes, each compressed independently, so that any byte range can be read or
+        overwritten by (de)compressing only the chunks it overlaps.
+
+        Opens filename if it exists, otherwise creates it with the given codec.
+
+        Parameters
+        ----------
+        filename: str
+            The filename of the file to read from or write to
+        codec: str
+            The compression codec for new files ('zlib', 'lz4' or 'zstd')
+        chunk_bytes: int
+            The number of uncompressed bytes in each chunk for new files
+        Ly: int
+            The height of each frame (0 if unknown)
+        Lx: int
+            The width of each frame (0 if unknown)
+        dtype: str
+            The data type of the frames
+        """
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._cache = (-1, None)
+        if os.path.exists(filename):
+            self._fid = open(filename, "r+b")
+            self._read_header()
+            if self.Ly == 0 and Ly > 0:
+                # streamed files do not know the frame size until they are opened
+                self.Ly, self.Lx = Ly, Lx
+                self._dirty = True
+        else:
+            self._fid = open(filename, "w+b")
+            self.Ly, self.Lx, self.dtype = Ly, Lx, str(np.dtype(dtype))
+            self.codec = codec or "zlib"
+            self.chunk_bytes = int(chunk_bytes)
+            self.nbytes = 0
+            self.index = np.zeros((0, 3), np.int64)
+            self._index_extent = (HEADER_SIZE, 0)
+            self._free, self._pending_free = [], []
+            self._end = HEADER_SIZE
+            self._dirty = True
+        # offsets of the chunks written since the last commit
+        self._uncommitted = set()
+        self._compress, self._decompress = _codec(self.codec)
+        self.flush()
+
+    def _read_header(self) -> None:
+        self._fid.seek(0)
+        (magic, version, self.Ly, self.Lx, dtype, codec, self.chunk_bytes, self.nbytes,
+         index_offset, n_chunks) = struct.unpack(
+             HEADER_FORMAT, self._fid.read(struct.calcsize(HEADER_FORMAT)))
+        if magic != MAGIC:
+            raise ValueError("%s is not a chunked suite2p binary" % self.filename)
+        if version > VERSION:
+            raise ValueError("%s has unsupported chunked binary version %d" %
+                             (self.filename, version))
+        self.dtype = dtype.rstrip(b"\0").decode()
+        self.codec = codec.rstrip(b"\0").decode()
+        self._fid.seek(index_offset)
+        self.index = np.frombuffer(self._fid.read(24 * n_chunks),
+                                   np.int64).reshape(-1, 3).copy()
+        self._index_extent = (index_offset, 24 * n_chunks)
+
+        # free space is the space between the chunks and the index
+        extents = sorted([(o, c) for o, n, c in self.index if n > 0] +
+                         [self._index_extent])
+        self._free, self._pending_free = [], []
+        self._end = HEADER_SIZE
+        for offset, size in extents:
+            if offset > self._end:
+                self._free.append([self._end, offset - self._end])
+            self._end = max(self._end, offset + size)
+        self._dirty = False
+
+    def _allocate(self, size: int) -> int:
+        """ returns the offset of size bytes of free space, first fit or at the end """
+        for extent in self._free:
+            if extent[1] >= size:
+                offset = extent[0]
+                extent[0] += size
+                extent[1] -= size
+                if extent[1] == 0:
+                    self._free.remove(extent)
+                return offset
+        offset = self._end
+        self._end += size
+        return offset
+
+    def flush(self) -> None:
+        """
+        Commits the chunks written so far: writes a new chunk index, syncs the chunks and
+        index to disk and then points the header to the new index. The space of the
+        previous index and of overwritten chunks is reused by the following writes.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            index = self.index.astype("<i8").tobytes()
+            index_offset = self._allocate(len(index))
+            self._fid.seek(index_offset)
+            self._fid.write(index)
+            self._fid.flush()
+            os.fsync(self._fid.fileno())
+            header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.Ly, self.Lx,
+                                 self.dtype.encode(), self.codec.encode(),
+                                 self.chunk_bytes, self.nbytes, index_offset,
+                                 len(self.index))
+            self._fid.seek(0)
+            self._fid.write(header.ljust(HEADER_SIZE, b"\0"))
+            self._fid.flush()
+            os.fsync(self._fid.fileno())
+
+            # the previous index and overwritten chunks are no longer referenced
+            self._pending_free.append(list(self._index_extent))
+            self._index_extent = (index_offset, len(index))
+            free = sorted(e for e in self._free + self._pending_free if e[1] > 0)
+            self._free, self._pending_free = [], []
+            for offset, size in free:
+                if len(self._free) > 0 and self._free[-1][0] + self._free[-1][1] == offset:
+                    self._free[-1][1] += size
+                else:
+                    self._free.append([offset, size])
+            if len(self._free) > 0 and self._free[-1][0] + self._free[-1][1] >= self._end:
+                self._end = self._free.pop()[0]
+            self._fid.truncate(max(self._end, HEADER_SIZE))
+            self._dirty = False
+            self._uncommitted = set()
+
+    def close(self) -> None:
+        """ flushes and closes the file """
+        if self._fid.closed:
+            return
+        self.flush()
+        self._fid.close()
+
+    def resize(self, nbytes: int) -> None:
+        """ sets the size of the uncompressed stream, new bytes read as zeros """
+        with self._lock:
+            n_chunks = -(-nbytes // self.chunk_bytes)
+            if n_chunks > len(self.index):
+                self.index = np.concatenate(
+                    (self.index, np.zeros((n_chunks - len(self.index), 3), np.int64)))
+            self.nbytes = nbytes
+            self._cache = (-1, None)
+            self._dirty = True
+
+    def _chunk_len(self, ichunk: int) -> int:
+        return min(self.chunk_bytes, self.nbytes - ichunk * self.chunk_bytes)
+
+    def read_chunk(self, ichunk: int) -> bytes:
+        """ returns the uncompressed bytes of chunk ichunk """
+        with self._lock:
+            if self._cache[0] == ichunk:
+                return self._cache[1]
+            offset, nbytes, _ = self.index[ichunk]
+            if nbytes == 0:
+                # chunk never written
+                data = bytes(self._chunk_len(ichunk))
+            else:
+                self._fid.seek(offset)
+                data = self._decompress(self._fid.read(nbytes))
+            if len(data) < self._chunk_len(ichunk):
+                # the stream has grown since this chunk was written
+                data = bytes(data) + bytes(self._chunk_len(ichunk) - len(data))
+            self._cache = (ichunk, data)
+            return data
+
+    def _write_chunk(self, ichunk: int, data: bytes) -> None:
+        cdata = self._compress(data)
+        # never overwrite a chunk in place, the committed index may still point to it
+        offset = self._allocate(len(cdata))
+        self._fid.seek(offset)
+        self._fid.write(cdata)
+        old_offset, old_nbytes, old_capacity = self.index[ichunk]
+        if old_nbytes > 0:
+            if old_offset in self._uncommitted:
+                # written since the last commit, so not referenced on disk
+                self._uncommitted.remove(old_offset)
+                self._free.append([int(old_offset), int(old_capacity)])
+            else:
+                self._pending_free.append([int(old_offset), int(old_capacity)])
+        self._uncommitted.add(offset)
+        self.index[ichunk] = offset, len(cdata), len(cdata)
+        self._cache = (ichunk, data)
+        self._dirty = True
+        if len(self._uncommitted) >= COMMIT_CHUNKS:
+            self.flush()
+
+    def read(self, start: int, stop: int) -> bytearray:
+        """ returns the uncompressed bytes from start to stop """
+        with self._lock:
+            stop = min(stop, self.nbytes)
+            out = bytearray(max(0, stop - start))
+            pos = start
+            while pos < stop:
+                ichunk, ioff = divmod(pos, self.chunk_bytes)
+                data = self.read_chunk(ichunk)
+                n = min(len(data) - ioff, stop - pos)
+                out[pos - start:pos - start + n] = data[ioff:ioff + n]
+                pos += n
+            return out
+
+    def write(self, start: int, data: bytes) -> None:
+        """ overwrites the uncompressed bytes from start with data, growing if needed """
+        with self._lock:
+            data = memoryview(data).cast("B")
+            stop = start + len(data)
+            if stop > self.nbytes:
+                self.resize(stop)
+            pos = start
+            while pos < stop:
+                ichunk, ioff = divmod(pos, self.chunk_bytes)
+                n = min(self._chunk_len(ichunk) - ioff, stop - pos)
+                if n == self._chunk_len(ichunk):
+                    chunk = bytes(data[pos - start:pos - start + n])
+                else:
+                    chunk = bytearray(self.read_chunk(ichunk))
+                    chunk[ioff:ioff + n] = data[pos - start:pos - start + n]
+                    chunk = bytes(chunk)
+                self._write_chunk(ichunk, chunk)
+                pos += n
+
+
+class ChunkedArray:
+
+    def __init__(self, store: ChunkedStore, Ly: int, Lx: int, dtype: str = "int16"):
+        """
+        Numpy-like n_frames x Ly x Lx view of a ChunkedStore, used in place of the
+        np.memmap of a raw suite2p binary.
+        """
+        self.store = store
+        self.Ly, self.Lx = Ly, Lx
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = Ly * Lx * self.dtype.itemsize
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.store.nbytes // self.frame_bytes, self.Ly, self.Lx
+
+    def _split_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return key[0], key[1:]
+
+    def _read_frames(self, start: int, stop: int) -> np.ndarray:
+        buff = self.store.read(start * self.frame_bytes, stop * self.frame_bytes)
+        return np.frombuffer(buff, self.dtype).reshape(-1, self.Ly, self.Lx)
+
+    def __getitem__(self, key):
+        fkey, rest = self._split_key(key)
+        n_frames = self.shape[0]
+        if isinstance(fkey, (int, np.integer)):
+            ind = fkey + n_frames if fkey < 0 else fkey
+            if not 0 <= ind < n_frames:
+                raise IndexError("frame index %d out of range" % fkey)
+            return self._read_frames(ind, ind + 1)[0][rest]
+        if isinstance(fkey, slice) and fkey.step in (None, 1):
+            start, stop, _ = fkey.indices(n_frames)
+            frames = self._read_frames(start, max(start, stop))
+        else:
+            inds, inverse = np.unique(np.arange(n_frames)[fkey], return_inverse=True)
+            frames = np.empty((len(inds), self.Ly, self.Lx), self.dtype)
+            # frames are read in file order and runs of consecutive frames at once, so
+            # each chunk is decompressed once (the store keeps the last chunk read)
+            breaks = np.nonzero(np.diff(inds) != 1)[0] + 1
+            for run in np.split(np.arange(len(inds)), breaks) if len(inds) > 0 else []:
+                frames[run] = self._read_frames(inds[run[0]], inds[run[-1]] + 1)
+            frames = frames[inverse.reshape(-1)]
+        return frames[(slice(None),) + rest]
+
+    def __setitem__(self, key, data):
+        fkey, rest = self._split_key(key)
+        if any(r != slice(None) for r in rest):
+            raise IndexError("chunked binaries can only be written in whole frames")
+        if isinstance(fkey, (int, np.integer)):
+            fkey = slice(fkey, fkey + 1)
+        inds = np.arange(self.shape[0])[fkey]
+        data = np.broadcast_to(np.asarray(data, self.dtype),
+                               (len(inds), self.Ly, self.Lx))
+        if len(inds) > 0 and np.all(np.diff(inds) == 1):
+            self.store.write(inds[0] * self.frame_bytes, np.ascontiguousarray(data))
+        else:
+            for ind, frame in zip(inds, data):
+                self.store.write(ind * self.frame_bytes, np.ascontiguousarray(frame))
+
+    def flush(self) -> None:
+        self.store.flush()
+
+
+class ChunkedWriter:
+
+    def __init__(self, filename: str, codec: str = "zlib",
+                 chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        """
+        Streaming writer for chunked binaries with the same write/close interface as a
+        file opened with open(filename, "wb"), used by the *_to_binary converters.
+        """
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.store = ChunkedStore(filename, codec=codec, chunk_bytes=chunk_bytes)
+        # bytes of the last, incomplete chunk, which starts at _offset
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data) -> None:
+        # like a file, accepts any C-contiguous buffer (bytes, bytearray or numpy array)
+        self._buffer += memoryview(data).cast("B")
+        chunk_bytes = self.store.chunk_bytes
+        n = (len(self._buffer) // chunk_bytes) * chunk_bytes
+        if n > 0:
+            self.store.write(self._offset, self._buffer[:n])
+            self._offset += n
+            del self._buffer[:n]
+
+    def flush(self) -> None:
+        """ writes the buffered bytes as a partial last chunk and commits the file """
+        if len(self._buffer) > 0:
+            # the partial chunk stays buffered and is rewritten once completed
+            self.store.write(self._offset, self._buffer)
+        self.store.flush()
+
+    def close(self) -> None:
+        if len(self._buffer) > 0:
+            self.store.write(self._offset, self._buffer)
+            self._buffer = bytearray()
+        self.store.close()
+
+
+def open_binary_for_writing(filename: str, ops: dict):
+    """
+    Opens filename for streaming frames into, as a chunked, compressed binary if
+    ops["binary_compression"] is set and as a raw binary otherwise.
+    """
+    # a header left over from a previous binary would describe the wrong file
+    if os.path.exists(header_filename(filename)):
+        os.remove(header_filename(filename))
+    codec = ops.get("binary_compression")
+    if codec:
+        return ChunkedWriter(filename, codec=codec,
+                             chunk_bytes=ops.get("binary_chunk_bytes",
+                                                 DEFAULT_CHUNK_BYTES))
+    return open(filename, "wb")
+
+
+def append_to_binary(filename: str, data: np.ndarray) -> None:
+    """ appends frames in data to the existing raw or chunked binary filename """
+    if is_chunked_file(filename):
+        store = ChunkedStore(filename)
+        store.write(store.nbytes, np.ascontiguousarray(data))
+        store.close()
+    else:
+        with open(filename, "ab") as f:
+            f.write(bytearray(data))
@@ -11,7 +11,7 @@ except:
 import numpy as np
 import os
 
-from .utils import init_ops, find_files_open_binaries
+from .utils import init_ops, find_files_open_binaries, deinterleave_to_binaries
 
 
 def h5py_to_binary(ops):
@@ -47,6 +47,9 @@ def h5py_to_binary(ops):
     if isinstance(keys, str):
         keys = [keys]
     iall = 0
+    mean_imgs = None
+    # frames of each channel and plane, the mean images are divided by them
+    nframes_chan = 0
     for j in range(ops["nplanes"]):
         ops1[j]["nframes_per_folder"] = np.zeros(len(h5list), np.int32)
 
@@ -63,7 +66,6 @@ def h5py_to_binary(ops):
                 nframes_all = f[key].shape[
                     0] if hdims == 3 else f[key].shape[0] * f[key].shape[1]
                 nbatch = min(nbatch, nframes_all)
-                nfunc = ops["functional_chan"] - 1 if nchannels > 1 else 0
                 # loop over all tiffs
                 ik = 0
                 while 1:
@@ -86,43 +88,29 @@ def h5py_to_binary(ops):
                     nframes = im.shape[0]
                     if type(im[0, 0, 0]) == np.uint16:
                         im = im / 2
-                    for j in range(0, nplanes):
-                        if iall == 0:
-                            ops1[j]["meanImg"] = np.zeros((im.shape[1], im.shape[2]),
-                                                          np.float32)
-                            if nchannels > 1:
-                                ops1[j]["meanImg_chan2"] = np.zeros(
-                                    (im.shape[1], im.shape[2]), np.float32)
+                    if iall == 0:
+                        for j in range(0, nplanes):
                             ops1[j]["nframes"] = 0
-                        i0 = nchannels * ((j) % nplanes)
-                        im2write = im[np.arange(int(i0) +
-                                                nfunc, nframes, ncp), :, :].astype(
-                                                    np.int16)
-                        reg_file[j].write(bytearray(im2write))
-                        ops1[j]["meanImg"] += im2write.astype(np.float32).sum(axis=0)
-                        if nchannels > 1:
-                            im2write = im[np.arange(int(i0) + 1 -
-                                                    nfunc, nframes, ncp), :, :].astype(
-                                                        np.int16)
-                            reg_file_chan2[j].write(bytearray(im2write))
-                            ops1[j]["meanImg_chan2"] += im2write.astype(
-                                np.float32).sum(axis=0)
-                        ops1[j]["nframes"] += im2write.shape[0]
-                        ops1[j]["nframes_per_folder"][ih5] += im2write.shape[0]
+                    counts, mean_imgs = deinterleave_to_binaries(
+                        im, reg_file, reg_file_chan2, nplanes, nchannels,
+                        functional_chan=ops["functional_chan"], mean_imgs=mean_imgs)
+                    nframes_chan = nframes_chan + counts
+                    for j in range(0, nplanes):
+                        ops1[j]["nframes"] += counts[0, j]
+                        ops1[j]["nframes_per_folder"][ih5] += counts[0, j]
                     ik += nframes
                     iall += nframes
 
     # write ops files
     do_registration = ops1[0]["do_registration"]
-    for ops in ops1:
-        ops["Ly"] = im2write.shape[1]
-        ops["Lx"] = im2write.shape[2]
+    for j, ops in enumerate(ops1):
+        ops["Ly"], ops["Lx"] = mean_imgs.shape[-2:]
         if not do_registration:
             ops["yrange"] = np.array([0, ops["Ly"]])
             ops["xrange"] = np.array([0, ops["Lx"]])
-        ops["meanImg"] /= ops["nframes"]
+        ops["meanImg"] = (mean_imgs[0, j] / ops["nframes"]).astype(np.float32)
         if nchannels > 1:
-            ops["meanImg_chan2"] /= ops["nframes"]
+            ops["meanImg_chan2"] = (mean_imgs[1, j] / nframes_chan[1, j]).astype(np.float32)
         np.save(ops["ops_path"], ops)
     # close all binary files and write ops files
     for j in range(nplanes):
@@ -43,6 +43,9 @@ def nd2_to_binary(ops):
     # loop over all nd2 files
     iall = 0
     ik = 0
+    mean_imgs = None
+    # frames of each channel and plane, the mean images are divided by them
+    nframes_chan = 0
     for file_name in fs:
         # open nd2
         nd2_file = nd2.ND2File(file_name)
@@ -70,40 +73,24 @@ def nd2_to_binary(ops):
         if iblocks[-1] < nframes:
             iblocks = np.append(iblocks, nframes)
 
-        if nchannels > 1:
-            nfunc = ops1[0]["functional_chan"] - 1
-        else:
-            nfunc = 0
-
         assert im.max() < 32768 and im.min() >= -32768, "image data is out of range"
-        im = im.astype(np.int16)
 
         # loop over all frames
         for ichunk, onset in enumerate(iblocks[:-1]):
             offset = iblocks[ichunk + 1]
             im_p = np.array(im[onset:offset, :, :, :, :])
-            im2mean = im_p.mean(axis=0).astype(np.float32) / len(iblocks)
-            for ichan in range(nchannels):
-                nframes = im_p.shape[0]
-                im2write = im_p[:, :, ichan, :, :]
+            nframes = im_p.shape[0]
+            if iall == 0:
                 for j in range(0, nplanes):
-                    if iall == 0:
-                        ops1[j]["meanImg"] = np.zeros((im_p.shape[3], im_p.shape[4]),
-                                                      np.float32)
-                        if nchannels > 1:
-                            ops1[j]["meanImg_chan2"] = np.zeros(
-                                (im_p.shape[3], im_p.shape[4]), np.float32)
-                        ops1[j]["nframes"] = 0
-                    if ichan == nfunc:
-                        ops1[j]["meanImg"] += np.squeeze(im2mean[j, ichan, :, :])
-                        reg_file[j].write(
-                            bytearray(im2write[:, j, :, :].astype("int16")))
-                    else:
-                        ops1[j]["meanImg_chan2"] += np.squeeze(im2mean[j, ichan, :, :])
-                        reg_file_chan2[j].write(
-                            bytearray(im2write[:, j, :, :].astype("int16")))
-
-                    ops1[j]["nframes"] += im2write.shape[0]
+                    ops1[j]["nframes"] = 0
+            # frames are interleaved as (time, plane, channel)
+            counts, mean_imgs = utils.deinterleave_to_binaries(
+                im_p.reshape(-1, im_p.shape[3], im_p.shape[4]), reg_file,
+                reg_file_chan2, nplanes, nchannels,
+                functional_chan=ops1[0]["functional_chan"], mean_imgs=mean_imgs)
+            nframes_chan = nframes_chan + counts
+            for j in range(0, nplanes):
+                ops1[j]["nframes"] += counts[0, j]
             ik += nframes
             iall += nframes
 
@@ -111,12 +98,14 @@ def nd2_to_binary(ops):
 
     # write ops files
     do_registration = ops1[0]["do_registration"]
-    for ops in ops1:
-        ops["Ly"] = im.shape[3]
-        ops["Lx"] = im.shape[4]
+    for j, ops in enumerate(ops1):
+        ops["Ly"], ops["Lx"] = mean_imgs.shape[-2:]
         if not do_registration:
             ops["yrange"] = np.array([0, ops["Ly"]])
             ops["xrange"] = np.array([0, ops["Lx"]])
+        ops["meanImg"] = (mean_imgs[0, j] / ops["nframes"]).astype(np.float32)
+        if nchannels > 1:
+            ops["meanImg_chan2"] = (mean_imgs[1, j] / nframes_chan[1, j]).astype(np.float32)
         np.save(ops["ops_path"], ops)
     # close all binary files and write ops files
     for j in range(0, nplanes):
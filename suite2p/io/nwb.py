@@ -14,6 +14,7 @@ from natsort import natsorted
 from .. import run_s2p
 from ..detection.stats import roi_stats
 from . import utils
+from .chunked import open_binary_for_writing
 from .. import run_s2p, default_ops
 
 try:
@@ -71,13 +72,13 @@ def nwb_to_binary(ops):
 
     # open reg_file (and when available reg_file_chan2)
     if "keep_movie_raw" in ops and ops["keep_movie_raw"]:
-        reg_file = open(ops["raw_file"], "wb")
+        reg_file = open_binary_for_writing(ops["raw_file"], ops)
         if nchannels > 1:
-            reg_file_chan2 = open(ops["raw_file_chan2"], "wb")
+            reg_file_chan2 = open_binary_for_writing(ops["raw_file_chan2"], ops)
     else:
-        reg_file = open(ops["reg_file"], "wb")
+        reg_file = open_binary_for_writing(ops["reg_file"], ops)
         if nchannels > 1:
-            reg_file_chan2 = open(ops["reg_file_chan2"], "wb")
+            reg_file_chan2 = open_binary_for_writing(ops["reg_file_chan2"], ops)
 
     nwb_driver = None
     if ops.get("nwb_driver") and isinstance(nwb_driver, str):
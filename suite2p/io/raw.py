@@ -7,6 +7,9 @@ import numpy as np
 from os import makedirs, listdir
 from os.path import isdir, isfile, getsize, join
 
+from .chunked import open_binary_for_writing, append_to_binary
+from .utils import deinterleave
+
 try:
     from xmltodict import parse
     HAS_XML = True
@@ -104,10 +107,10 @@ def _initialize_destination_files(ops, raw_file_configurations, use_recorded_def
         ops['reg_file'] = join(ops['fast_disk'], 'data.bin')
         isdir(ops['fast_disk']) or makedirs(ops['fast_disk'])
         isdir(ops['save_path']) or makedirs(ops['save_path'])
-        open(ops['reg_file'], 'wb').close()
+        open_binary_for_writing(ops['reg_file'], ops).close()
         if nchannels > 1:
             ops['reg_file_chan2'] = join(ops['fast_disk'], 'data_chan2.bin')
-            open(ops['reg_file_chan2'], 'wb').close()
+            open_binary_for_writing(ops['reg_file_chan2'], ops).close()
 
         ops['meanImg'] = np.zeros((cfg.xpx, cfg.ypx), np.float32)
         ops['nframes'] = 0
@@ -144,32 +147,22 @@ def _raw2bin(all_ops, cfg):
             current_frames = int(len(data) / cfg.xpx / cfg.ypx / cfg.recorded_planes)
 
             if cfg.channel > 1:
-                channel_a, channel_b = _split_into_2_channels(data.reshape(
-                    current_frames * cfg.recorded_planes, cfg.xpx, cfg.ypx))
-                reshaped_data = []
-                for i in range(cfg.recorded_planes):
-                    channel_a_plane = channel_a[i::cfg.recorded_planes]
-                    channel_b_plane = channel_b[i::cfg.recorded_planes]
-                    reshaped_data.append([channel_a_plane, channel_b_plane])
+                # frames are interleaved as (time, plane, channel)
+                frames, counts, mean_imgs = deinterleave(
+                    data.reshape(-1, cfg.xpx, cfg.ypx), cfg.recorded_planes, cfg.channel)
+                for plane in range(0, cfg.zplanes):
+                    ops = all_ops[plane]
+                    append_to_binary(ops['reg_file'], frames[0, plane, :counts[0, plane]])
+                    append_to_binary(ops['reg_file_chan2'], frames[1, plane, :counts[1, plane]])
+                    ops['meanImg'] += mean_imgs[0, plane].astype(np.float32)
+                    ops['meanImg_chan2'] = ops['meanImg_chan2'] + mean_imgs[1, plane].astype(np.float32)
 
             else:
                 reshaped_data = data.reshape(cfg.recorded_planes, current_frames, cfg.xpx, cfg.ypx)
-
-            for plane in range(0, cfg.zplanes):
-                ops = all_ops[plane]
-                plane_data = reshaped_data[plane]
-
-                if cfg.channel > 1:
-                    with open(ops['reg_file'], 'ab') as bin_file:
-                        bin_file.write(bytearray(plane_data[0].astype(np.int16)))
-                    with open(ops['reg_file_chan2'], 'ab') as bin_file2:
-                        bin_file2.write(bytearray(plane_data[1].astype(np.int16)))
-                    ops['meanImg'] += plane_data[0].astype(np.float32).sum(axis=0)
-                    ops['meanImg_chan2'] = ops['meanImg_chan2'] + plane_data[1].astype(np.float32).sum(axis=0)
-
-                else:
-                    with open(ops['reg_file'], 'ab') as bin_file:
-                        bin_file.write(bytearray(plane_data.astype(np.int16)))
+                for plane in range(0, cfg.zplanes):
+                    ops = all_ops[plane]
+                    plane_data = reshaped_data[plane]
+                    append_to_binary(ops['reg_file'], plane_data.astype(np.int16))
                     ops['meanImg'] = ops['meanImg'] + plane_data.astype(np.float32).sum(axis=0)
 
             raw_data_chunk = raw_file.read(chunk)
@@ -181,22 +174,15 @@ def _raw2bin(all_ops, cfg):
         np.save(ops['ops_path'], ops)
 
 
-def _split_into_2_channels(data):
-
-    """ Utility function, used during conversion - splits given raw data into 2 separate channels """
-
-    frames = data.shape[0]
-    channel_a_index = list(filter(lambda x: x % 2 == 0, range(frames)))
-    channel_b_index = list(filter(lambda x: x % 2 != 0, range(frames)))
-    return data[channel_a_index], data[channel_b_index]
-
-
 def _update_mean(ops_loaded):
 
     """ Adjusts all "meanImg" values at the end of raw-to-binary conversion. """
 
     for ops in ops_loaded:
         ops['meanImg'] /= ops['nframes']
+        if 'meanImg_chan2' in ops:
+            # raw frames hold all channels, so both channels have nframes frames
+            ops['meanImg_chan2'] /= ops['nframes']
         np.save(ops['ops_path'], ops)
 
 
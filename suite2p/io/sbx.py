@@ -5,7 +5,7 @@ import os
 
 import numpy as np
 
-from .utils import init_ops, find_files_open_binaries
+from .utils import init_ops, find_files_open_binaries, deinterleave_to_binaries
 
 try:
     from sbxreader import sbx_memmap
@@ -42,6 +42,9 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
     for j in range(ops1[0]["nplanes"]):
         ops1[j]["nframes_per_folder"] = np.zeros(len(sbxlist), np.int32)
     ik = 0
+    mean_imgs = None
+    # frames of each channel and plane, the mean images are divided by them
+    nframes_chan = 0
     if "sbx_ndeadcols" in ops1[0].keys():
         ndeadcols = int(ops1[0]["sbx_ndeadcols"])
     if "sbx_ndeadrows" in ops1[0].keys():
@@ -81,53 +84,37 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
             iblocks = np.append(iblocks, nframes)
 
         # data = nframes x nplanes x nchannels x pixels x pixels
-        if nchannels > 1:
-            nfunc = ops1[0]["functional_chan"] - 1
-        else:
-            nfunc = 0
         # loop over all frames
         for ichunk, onset in enumerate(iblocks[:-1]):
             offset = iblocks[ichunk + 1]
             im = np.array(f[onset:offset, :, :, ndeadrows:, ndeadcols:]) // 2
-            im = im.astype(np.int16)
-            im2mean = im.mean(axis=0).astype(np.float32) / len(iblocks)
-            for ichan in range(nchannels):
-                nframes = im.shape[0]
-                im2write = im[:, :, ichan, :, :]
+            nframes = im.shape[0]
+            if iall == 0:
                 for j in range(0, nplanes):
-                    if iall == 0:
-                        ops1[j]["meanImg"] = np.zeros((im.shape[3], im.shape[4]),
-                                                      np.float32)
-                        if nchannels > 1:
-                            ops1[j]["meanImg_chan2"] = np.zeros(
-                                (im.shape[3], im.shape[4]), np.float32)
-                        ops1[j]["nframes"] = 0
-                    if ichan == nfunc:
-                        ops1[j]["meanImg"] += np.squeeze(im2mean[j, ichan, :, :])
-                        reg_file[j].write(
-                            bytearray(im2write[:, j, :, :].astype("int16")))
-                    else:
-                        ops1[j]["meanImg_chan2"] += np.squeeze(im2mean[j, ichan, :, :])
-                        reg_file_chan2[j].write(
-                            bytearray(im2write[:, j, :, :].astype("int16")))
-
-                    ops1[j]["nframes"] += im2write.shape[0]
-                    ops1[j]["nframes_per_folder"][ifile] += im2write.shape[0]
+                    ops1[j]["nframes"] = 0
+            # frames are interleaved as (time, plane, channel)
+            counts, mean_imgs = deinterleave_to_binaries(
+                im.reshape(-1, im.shape[3], im.shape[4]), reg_file, reg_file_chan2,
+                nplanes, nchannels, functional_chan=ops1[0]["functional_chan"],
+                mean_imgs=mean_imgs)
+            nframes_chan = nframes_chan + counts
+            for j in range(0, nplanes):
+                ops1[j]["nframes"] += counts[0, j]
+                ops1[j]["nframes_per_folder"][ifile] += counts[0, j]
             ik += nframes
             iall += nframes
 
     # write ops files
     do_registration = ops1[0]["do_registration"]
     do_nonrigid = ops1[0]["nonrigid"]
-    for ops in ops1:
-        ops["Ly"] = im.shape[3]
-        ops["Lx"] = im.shape[4]
+    for j, ops in enumerate(ops1):
+        ops["Ly"], ops["Lx"] = mean_imgs.shape[-2:]
         if not do_registration:
             ops["yrange"] = np.array([0, ops["Ly"]])
             ops["xrange"] = np.array([0, ops["Lx"]])
-        #ops["meanImg"] /= ops["nframes"]
-        #if nchannels>1:
-        #    ops["meanImg_chan2"] /= ops["nframes"]
+        ops["meanImg"] = (mean_imgs[0, j] / ops["nframes"]).astype(np.float32)
+        if nchannels > 1:
+            ops["meanImg_chan2"] = (mean_imgs[1, j] / nframes_chan[1, j]).astype(np.float32)
         np.save(ops["ops_path"], ops)
     # close all binary files and write ops files
     for j in range(0, nplanes):
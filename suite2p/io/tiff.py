@@ -7,12 +7,14 @@ import json
 import math
 import os
 import time
+from multiprocessing import get_all_start_methods, get_context
 from typing import Union, Tuple, Optional
 
 import numpy as np
 from tifffile import imread, TiffFile, TiffWriter
 
 from . import utils
+from .chunked import ChunkedWriter
 
 try:
     from ScanImageTiffReader import ScanImageTiffReader
@@ -174,9 +176,19 @@ def tiff_to_binary(ops):
     batch_size = ops["batch_size"]
     batch_size = nplanes * nchannels * math.ceil(batch_size / (nplanes * nchannels))
 
+    if ops.get("tiff_workers", 0) > 1:
+        if isinstance(reg_file[0], ChunkedWriter):
+            print("NOTE: parallel tiff conversion needs raw binaries, converting serially")
+        else:
+            return _tiff_to_binary_parallel(ops1, fs, reg_file, reg_file_chan2,
+                                            use_sktiff, batch_size, t0)
+
     # loop over all tiffs
     which_folder = -1
     ntotal = 0
+    mean_imgs = None
+    # frames of each channel and plane, the mean images are divided by them
+    nframes_chan = 0
     for ik, file in enumerate(fs):
         # open tiff
         tif, Ltif = open_tiff(file, use_sktiff) #returns tif and its length
@@ -190,32 +202,20 @@ def tiff_to_binary(ops):
             if im is None:
                 break
             nframes = im.shape[0]
-            for j in range(0, nplanes):
-                if ik == 0 and ix == 0:
+            if ik == 0 and ix == 0:
+                for j in range(0, nplanes):
                     ops1[j]["nframes"] = 0
                     ops1[j]["frames_per_file"] = np.zeros((len(fs),), dtype=int)
-                    ops1[j]["meanImg"] = np.zeros((im.shape[1], im.shape[2]),
-                                                  np.float32)
-                    if nchannels > 1:
-                        ops1[j]["meanImg_chan2"] = np.zeros((im.shape[1], im.shape[2]),
-                                                            np.float32)
-                i0 = nchannels * ((iplane + j) % nplanes)
-                if nchannels > 1:
-                    nfunc = ops["functional_chan"] - 1
-                else:
-                    nfunc = 0
-                im2write = im[int(i0) + nfunc:nframes:nplanes * nchannels]
-
-                reg_file[j].write(bytearray(im2write))
-                ops1[j]["meanImg"] += im2write.astype(np.float32).sum(axis=0)
-                ops1[j]["nframes"] += im2write.shape[0]
-                ops1[j]["frames_per_file"][ik] += im2write.shape[0]
-                ops1[j]["frames_per_folder"][which_folder] += im2write.shape[0]
-                #print(ops1[j]["frames_per_folder"][which_folder])
-                if nchannels > 1:
-                    im2write = im[int(i0) + 1 - nfunc:nframes:nplanes * nchannels]
-                    reg_file_chan2[j].write(bytearray(im2write))
-                    ops1[j]["meanImg_chan2"] += im2write.mean(axis=0)
+            # split planes and channels, write to binaries and sum for mean images
+            counts, mean_imgs = utils.deinterleave_to_binaries(
+                im, reg_file, reg_file_chan2, nplanes, nchannels,
+                functional_chan=ops["functional_chan"], iplane=iplane,
+                mean_imgs=mean_imgs)
+            nframes_chan = nframes_chan + counts
+            for j in range(0, nplanes):
+                ops1[j]["nframes"] += counts[0, j]
+                ops1[j]["frames_per_file"][ik] += counts[0, j]
+                ops1[j]["frames_per_folder"][which_folder] += counts[0, j]
             iplane = (iplane - nframes / nchannels) % nplanes
             ix += nframes
             ntotal += nframes
@@ -224,14 +224,13 @@ def tiff_to_binary(ops):
                       (ntotal, time.time() - t0))
         gc.collect()
     # write ops files
-    do_registration = ops["do_registration"]
-    for ops in ops1:
-        ops["Ly"], ops["Lx"] = ops["meanImg"].shape
+    for j, ops in enumerate(ops1):
+        ops["Ly"], ops["Lx"] = mean_imgs.shape[-2:]
         ops["yrange"] = np.array([0, ops["Ly"]])
         ops["xrange"] = np.array([0, ops["Lx"]])
-        ops["meanImg"] /= ops["nframes"]
+        ops["meanImg"] = (mean_imgs[0, j] / ops["nframes"]).astype(np.float32)
         if nchannels > 1:
-            ops["meanImg_chan2"] /= ops["nframes"]
+            ops["meanImg_chan2"] = (mean_imgs[1, j] / nframes_chan[1, j]).astype(np.float32)
         np.save(ops["ops_path"], ops)
     # close all binary files and write ops files
     for j in range(0, nplanes):
@@ -241,6 +240,131 @@ def tiff_to_binary(ops):
     return ops1[0]
 
 
+def _tiff_batches(Ltif, iplane, batch_size, nplanes, nchannels):
+    """ returns the (ix, nframes, iplane) of each batch read from a tiff by tiff_to_binary,
+    and the plane identity of the first frame of the next tiff """
+    batches = []
+    ix = 0
+    while ix < Ltif:
+        nframes = min(Ltif - ix, batch_size)
+        batches.append((ix, nframes, iplane))
+        iplane = (iplane - nframes / nchannels) % nplanes
+        ix += nframes
+    return batches, iplane
+
+
+def _tiff_to_binary_worker(args):
+    """ de-interleaves one tiff into the per-plane binaries at precomputed frame offsets """
+    (file, iplane, use_sktiff, batch_size, nplanes, nchannels, nfunc, Ly, Lx, filenames,
+     offsets, counts) = args
+    tif, Ltif = open_tiff(file, use_sktiff)
+    batches, _ = _tiff_batches(Ltif, iplane, batch_size, nplanes, nchannels)
+    nchan_out = len(filenames)
+    mmaps = [[
+        np.memmap(filenames[ichan][j], mode="r+", dtype=np.int16,
+                  offset=int(offsets[ichan, j]) * Ly * Lx * 2,
+                  shape=(int(counts[ichan, j]), Ly, Lx)) if counts[ichan, j] > 0 else None
+        for j in range(nplanes)
+    ] for ichan in range(nchan_out)]
+    mean_imgs = np.zeros((nchan_out, nplanes, Ly, Lx), np.float64)
+    written = np.zeros((nchan_out, nplanes), int)
+    for ix, nframes, iplane in batches:
+        im = read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff)
+        frames, counts, mean_imgs = utils.deinterleave(im, nplanes, nchannels,
+                                                       functional_chan=nfunc + 1,
+                                                       iplane=iplane,
+                                                       mean_imgs=mean_imgs,
+                                                       parallel=False)
+        for ichan in range(nchan_out):
+            for j in range(nplanes):
+                k, n = written[ichan, j], counts[ichan, j]
+                if n > 0:
+                    mmaps[ichan][j][k:k + n] = frames[ichan, j, :n]
+        written += counts
+    for mmaps_chan in mmaps:
+        for mmap in mmaps_chan:
+            if mmap is not None:
+                mmap.flush()
+    tif.close()
+    return mean_imgs
+
+
+def _tiff_to_binary_parallel(ops1, fs, reg_file, reg_file_chan2, use_sktiff, batch_size,
+                             t0):
+    """ tiff_to_binary decoding the tiffs on a process pool
+
+    The de-interleaving of tiff_to_binary is replayed on the page counts of the tiffs to
+    find where the frames of each tiff go in each plane's binary, so the workers write
+    directly into the preallocated binaries and the output is identical to the serial
+    conversion.
+    """
+    ops = ops1[0]
+    nplanes, nchannels = ops["nplanes"], ops["nchannels"]
+    nfunc = ops["functional_chan"] - 1 if nchannels > 1 else 0
+    nchan_out = 2 if nchannels > 1 else 1
+
+    # count frames in each tiff and plane
+    Ltifs = []
+    for file in fs:
+        tif, Ltif = open_tiff(file, use_sktiff)
+        if len(Ltifs) == 0:
+            Ly, Lx = read_tiff(file, tif, Ltif, 0, 1, use_sktiff).shape[1:]
+        tif.close()
+        Ltifs.append(Ltif)
+    iplanes = np.zeros(len(fs))
+    nframes_file = np.zeros((len(fs), nchan_out, nplanes), int)
+    iplane = 0
+    for ik, Ltif in enumerate(Ltifs):
+        if ops["first_tiffs"][ik]:
+            iplane = 0
+        iplanes[ik] = iplane
+        batches, iplane = _tiff_batches(Ltif, iplane, batch_size, nplanes, nchannels)
+        for ix, nframes, ipl in batches:
+            for j in range(nplanes):
+                i0 = nchannels * ((ipl + j) % nplanes)
+                for ichan in range(nchan_out):
+                    ioff = nfunc if ichan == 0 else 1 - nfunc
+                    nframes_file[ik, ichan, j] += len(
+                        range(int(i0) + ioff, nframes, nplanes * nchannels))
+    offsets = np.cumsum(nframes_file, axis=0) - nframes_file
+    nframes_plane = nframes_file.sum(axis=0)
+
+    # preallocate binaries
+    filenames = [[f.name for f in reg_file]]
+    if nchannels > 1:
+        filenames.append([f.name for f in reg_file_chan2])
+    for ichan in range(nchan_out):
+        for j in range(nplanes):
+            f = reg_file[j] if ichan == 0 else reg_file_chan2[j]
+            f.truncate(int(nframes_plane[ichan, j]) * Ly * Lx * 2)
+            f.close()
+
+    args = [(file, iplanes[ik], use_sktiff, batch_size, nplanes, nchannels, nfunc, Ly, Lx,
+             filenames, offsets[ik], nframes_file[ik]) for ik, file in enumerate(fs)]
+    # workers are not forked from this process, which may already be running numba threads
+    method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+    with get_context(method).Pool(ops["tiff_workers"]) as p:
+        mean_imgs = p.map(_tiff_to_binary_worker, args)
+    print("%d frames of binary, time %0.2f sec." % (sum(Ltifs), time.time() - t0))
+
+    which_folder = np.cumsum(ops["first_tiffs"][:len(fs)]) - 1
+    for j, ops in enumerate(ops1):
+        ops["nframes"] = int(nframes_plane[0, j])
+        ops["frames_per_file"] = nframes_file[:, 0, j].astype(int)
+        for ik in range(len(fs)):
+            ops["frames_per_folder"][which_folder[ik]] += nframes_file[ik, 0, j]
+        ops["Ly"], ops["Lx"] = Ly, Lx
+        ops["yrange"] = np.array([0, ops["Ly"]])
+        ops["xrange"] = np.array([0, ops["Lx"]])
+        mean_img = (np.sum(mean_imgs, axis=0)[:, j] /
+                    nframes_plane[:, j, np.newaxis, np.newaxis])
+        ops["meanImg"] = mean_img[0].astype(np.float32)
+        if nchannels > 1:
+            ops["meanImg_chan2"] = mean_img[1].astype(np.float32)
+        np.save(ops["ops_path"], ops)
+    return ops1[0]
+
+
 def mesoscan_to_binary(ops):
     """ finds mesoscope tiff files and writes them to binaries
 
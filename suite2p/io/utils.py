@@ -7,6 +7,9 @@ from pathlib import Path
 
 import numpy as np
 from natsort import natsorted
+from numba import njit, prange
+
+from .chunked import open_binary_for_writing
 
 
 def search_for_ext(rootdir, extension="tif", look_one_level_down=False):
@@ -269,13 +272,13 @@ def find_files_open_binaries(ops1, ish5=False):
     for ops in ops1:
         nchannels = ops["nchannels"]
         if "keep_movie_raw" in ops and ops["keep_movie_raw"]:
-            reg_file.append(open(ops["raw_file"], "wb"))
+            reg_file.append(open_binary_for_writing(ops["raw_file"], ops))
             if nchannels > 1:
-                reg_file_chan2.append(open(ops["raw_file_chan2"], "wb"))
+                reg_file_chan2.append(open_binary_for_writing(ops["raw_file_chan2"], ops))
         else:
-            reg_file.append(open(ops["reg_file"], "wb"))
+            reg_file.append(open_binary_for_writing(ops["reg_file"], ops))
             if nchannels > 1:
-                reg_file_chan2.append(open(ops["reg_file_chan2"], "wb"))
+                reg_file_chan2.append(open_binary_for_writing(ops["reg_file_chan2"], ops))
 
         if "input_format" in ops.keys():
             input_format = ops["input_format"]
@@ -327,6 +330,108 @@ def find_files_open_binaries(ops1, ish5=False):
     return ops1, fs, reg_file, reg_file_chan2
 
 
+@njit(parallel=True)
+def _deinterleave(im, i0s, stride, frames, mean_imgs, counts):
+    """ scatters every stride-th frame of im from i0s[c, j] into frames[c, j] and adds them
+    to mean_imgs[c, j], one (channel, plane) pair per thread """
+    nchan, nplanes = i0s.shape
+    nframes, Ly, Lx = im.shape
+    for ic in prange(nchan * nplanes):
+        c, j = ic // nplanes, ic % nplanes
+        n = 0
+        for t in range(i0s[c, j], nframes, stride):
+            for y in range(Ly):
+                for x in range(Lx):
+                    frames[c, j, n, y, x] = im[t, y, x]
+                    mean_imgs[c, j, y, x] += frames[c, j, n, y, x]
+            n += 1
+        counts[c, j] = n
+
+
+# single-threaded kernel for worker processes (numba's threading layer is not fork-safe)
+_deinterleave_serial = njit(_deinterleave.py_func)
+
+
+def deinterleave(im, nplanes, nchannels, functional_chan=1, iplane=0, mean_imgs=None,
+                 dtype="int16", parallel=True):
+    """ splits interleaved frames into planes and channels in a single pass
+
+    frames are interleaved as (time, plane, channel), with the first frame of im from
+    plane iplane (channel 0)
+
+    Parameters
+    ----------
+    im : frames x Ly x Lx
+        interleaved frames
+    nplanes : int
+        number of planes
+    nchannels : int
+        number of channels
+    functional_chan : int
+        1-based index of the functional channel
+    iplane : int
+        plane of the first frame of im
+    mean_imgs : float64 array, nchan x nplanes x Ly x Lx (optional)
+        sums of the frames of each channel and plane, updated in place
+    dtype : str
+        data type of the output frames (values are cast as in np.astype)
+    parallel : bool
+        split the channels and planes across threads (set to False in worker processes)
+
+    Returns
+    -------
+    frames : nchan x nplanes x nmax x Ly x Lx
+        frames of the functional channel (and second channel if nchannels > 1) of each
+        plane, padded to nmax frames
+    counts : int array, nchan x nplanes
+        number of frames of each channel and plane
+    mean_imgs : float64 array, nchan x nplanes x Ly x Lx
+        sums of the frames of each channel and plane
+    """
+    nframes, Ly, Lx = im.shape
+    nchan = 2 if nchannels > 1 else 1
+    nfunc = functional_chan - 1 if nchannels > 1 else 0
+    stride = nplanes * nchannels
+    i0s = np.zeros((nchan, nplanes), np.int64)
+    for j in range(nplanes):
+        i0 = int(nchannels * ((iplane + j) % nplanes))
+        i0s[0, j] = i0 + nfunc
+        if nchan > 1:
+            i0s[1, j] = i0 + 1 - nfunc
+    if mean_imgs is None:
+        mean_imgs = np.zeros((nchan, nplanes, Ly, Lx), np.float64)
+    frames = np.empty((nchan, nplanes, -(-nframes // stride), Ly, Lx), dtype)
+    counts = np.zeros((nchan, nplanes), np.int64)
+    if nframes > 0:
+        kernel = _deinterleave if parallel else _deinterleave_serial
+        kernel(np.ascontiguousarray(im), i0s, stride, frames, mean_imgs, counts)
+    return frames, counts, mean_imgs
+
+
+def deinterleave_to_binaries(im, reg_file, reg_file_chan2, nplanes, nchannels,
+                             functional_chan=1, iplane=0, mean_imgs=None,
+                             dtype="int16"):
+    """ splits interleaved frames into planes and channels (see deinterleave) and appends
+    them to the binaries of each plane, opened by find_files_open_binaries
+
+    Returns
+    -------
+    counts : int array, nchan x nplanes
+        number of frames written to each channel and plane
+    mean_imgs : float64 array, nchan x nplanes x Ly x Lx
+        sums of the frames of each channel and plane
+    """
+    frames, counts, mean_imgs = deinterleave(im, nplanes, nchannels,
+                                             functional_chan=functional_chan,
+                                             iplane=iplane, mean_imgs=mean_imgs,
+                                             dtype=dtype)
+    for c, files in enumerate([reg_file, reg_file_chan2][:frames.shape[0]]):
+        for j in range(nplanes):
+            if counts[c, j] > 0:
+                files[j].write(frames[c, j, :counts[c, j]])
+    return counts, mean_imgs
+
+
 def init_ops(ops):
     """ initializes ops files for each plane in recording
 
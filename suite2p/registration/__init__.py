@@ -4,4 +4,5 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 from .register import (registration_wrapper, save_registration_outputs_to_ops,
                        compute_enhanced_mean_image)
 from .metrics import get_pc_metrics
-from .zalign import compute_zpos
+from .zalign import compute_zpos, register_stack
+from .online import OnlineRegistration
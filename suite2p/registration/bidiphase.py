@@ -1,11 +1,17 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+from typing import Union
+
 import numpy as np
+from numba import njit, prange
 from numpy import fft
 
+from . import utils
+from .utils import apply_dotnorm, fft_out
+
 
-def compute(frames: np.ndarray) -> int:
+def compute(frames: np.ndarray, subpixel: int = 1) -> Union[int, float]:
     """
     Returns the bidirectional phase offset, the offset between lines that sometimes occurs in line scanning.
 
@@ -13,43 +19,103 @@ def compute(frames: np.ndarray) -> int:
     ----------
     frames : frames x Ly x Lx
         random subsample of frames in binary (frames x Ly x Lx)
+    subpixel : int (optional, default 1)
+        if > 1, the offset is refined with a parabola fit around the correlation peak and
+        returned with a precision of 1 / subpixel pixels
 
     Returns
     -------
-    bidiphase : int
+    bidiphase : int (or float if subpixel > 1)
         bidirectional phase offset in pixels
 
     """
 
-    _, Ly, Lx = frames.shape
+    nimg, Ly, Lx = frames.shape
+    nlines = Ly // 2
 
     # compute phase-correlation between lines in x-direction
-    d1 = fft.fft(frames[:, 1::2, :], axis=2)
-    d1 /= np.abs(d1) + 1e-5
+    d1 = utils.fft(frames[:, 1::2, :].astype(np.float32),
+                   out=fft_out((nimg, nlines, Lx), slot=0))
+    apply_dotnorm(d1, np.complex64(1), out=d1)
 
-    d2 = np.conj(fft.fft(frames[:, ::2, :], axis=2))
-    d2 /= np.abs(d2) + 1e-5
-    d2 = d2[:, :d1.shape[1], :]
+    d2 = utils.fft(frames[:, :2 * nlines:2, :].astype(np.float32),
+                   out=fft_out((nimg, nlines, Lx), slot=1))
+    apply_dotnorm(d2, np.complex64(1), out=d2)
 
-    cc = np.real(fft.ifft(d1 * d2, axis=2))
-    cc = cc.mean(axis=1).mean(axis=0)
+    d1 *= np.conj(d2)
+    cc = utils.ifft(d1, out=fft_out((nimg, nlines, Lx), slot=1))
+    cc = cc.real.mean(axis=1).mean(axis=0)
     cc = fft.fftshift(cc)
 
-    bidiphase = -(np.argmax(cc[-10 + Lx // 2:11 + Lx // 2]) - 10)
+    cc = cc[-10 + Lx // 2:11 + Lx // 2]
+    imax = np.argmax(cc)
+    bidiphase = -(imax - 10)
+    if subpixel > 1 and 0 < imax < len(cc) - 1:
+        c0, c1, c2 = cc[imax - 1:imax + 2]
+        denom = c0 - 2 * c1 + c2
+        if denom < 0:
+            dx = np.clip(0.5 * (c0 - c2) / denom, -0.5, 0.5)
+            bidiphase = float(np.round((bidiphase - dx) * subpixel) / subpixel)
     return bidiphase
 
 
-def shift(frames: np.ndarray, bidiphase: int) -> None:
+def shift(frames: np.ndarray, bidiphase: Union[int, float, np.ndarray]) -> None:
     """
     Shift last axis of "frames" by bidirectional phase offset in-place, bidiphase.
 
     Parameters
     ----------
     frames : frames x Ly x Lx
-    bidiphase : int
-        bidirectional phase offset in pixels
+    bidiphase : int, float or array of one offset per frame
+        bidirectional phase offset in pixels, sub-pixel offsets are applied with linear
+        interpolation (rounded for integer frames)
     """
+    if np.ndim(bidiphase) > 0:
+        # offsets estimated on each batch (see ops["bidi_per_batch"])
+        bidiphase = np.asarray(bidiphase)
+        for b in np.unique(bidiphase[bidiphase != 0]):
+            inds = np.nonzero(bidiphase == b)[0]
+            shifted = frames[inds]
+            shift(shifted, b)
+            frames[inds] = shifted
+        return
+    if bidiphase != np.round(bidiphase):
+        _shift_lines(frames, float(bidiphase), np.issubdtype(frames.dtype, np.integer))
+        return
+    bidiphase = int(bidiphase)
     if bidiphase > 0:
         frames[:, 1::2, bidiphase:] = frames[:, 1::2, :-bidiphase]
-    else:
+    elif bidiphase < 0:
         frames[:, 1::2, :bidiphase] = frames[:, 1::2, -bidiphase:]
+
+
+@njit(cache=True)
+def line_indices(Lx, bidiphase):
+    """
+    Returns the pixels x0, x1 and the weight f of x1 to sample a line of Lx pixels shifted
+    by bidiphase, with linear interpolation for sub-pixel offsets. Pixels at the edges that
+    would be sampled outside of the line are not shifted (as in shift).
+    """
+    x0 = np.arange(Lx)
+    x1 = np.arange(Lx)
+    f = np.zeros(Lx, np.float32)
+    for x in range(Lx):
+        xs = x - bidiphase
+        xf = int(np.floor(xs))
+        fx = np.float32(xs - xf)
+        if xf >= 0 and (xf < Lx - 1 or (xf == Lx - 1 and fx == 0)):
+            x0[x], x1[x], f[x] = xf, min(xf + 1, Lx - 1), fx
+    return x0, x1, f
+
+
+@njit(parallel=True, cache=True)
+def _shift_lines(frames, bidiphase, rounded):
+    """ shifts the odd lines of frames by a sub-pixel bidiphase in-place """
+    nimg, Ly, Lx = frames.shape
+    x0, x1, f = line_indices(Lx, bidiphase)
+    for t in prange(nimg):
+        for y in range(1, Ly, 2):
+            line = frames[t, y].copy()
+            for x in range(Lx):
+                v = (1 - f[x]) * np.float32(line[x0[x]]) + f[x] * np.float32(line[x1[x]])
+                frames[t, y, x] = np.round(v) if rounded else v
@@ -1,11 +1,11 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
-from multiprocessing import Pool
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from numpy.linalg import norm
-from scipy.signal import convolve2d
 from sklearn.decomposition import PCA
 from scipy.ndimage import gaussian_filter1d
 
@@ -66,10 +66,122 @@ def pclowhigh(mov, nlowhigh, nPC, random_state):
     return pclow, pchigh, w, v
 
 
+def pclowhigh_batched(f, inds, nlowhigh, nPC, random_state, batch_size=500, crop=None,
+                      n_iter=2):
+    """
+    Compute mean of top and bottom PC weights for nPC"s of the frames inds of f, reading
+    batch_size frames at a time (see pclowhigh)
+
+    The PCs are computed with a randomized SVD of the centered frames (as the randomized
+    PCA of pclowhigh), in which each product with the frames is accumulated over batches:
+    one pass over the frames sketches their range, and each power iteration is a single
+    pass (the products with the frames and their transpose are accumulated together). The
+    top and bottom frames of each PC are averaged in a last pass. Only one batch of frames
+    and about 4 * nPC images are kept in memory.
+
+    Parameters
+    ----------
+    f : BinaryFile or array
+        frames x Ly x Lx
+    inds : int, array
+        indices of the subsampled frames in f
+    nlowhigh : int
+        number of frames to average at top and bottom of each PC
+    nPC : int
+        number of PCs to compute
+    random_state:
+        a value that sets the seed for the randomized SVD.
+    batch_size : int
+        number of frames read at a time
+    crop : (int, int), (int, int)
+        y_range, x_range to crop the frames to
+    n_iter : int
+        number of power iterations (passes over the frames) of the randomized SVD (at
+        least 1)
+
+    Returns
+    -------
+        pclow : float, array
+            average of bottom of spatial PC: nPC x Ly x Lx
+        pchigh : float, array
+            average of top of spatial PC: nPC x Ly x Lx
+        w : float, array
+            singular values of decomposition of the frames
+        v : float, array
+            frames x nPC, how the PCs vary across frames
+    """
+    y_range, x_range = crop if crop is not None else ((0, f.shape[1]), (0, f.shape[2]))
+    Ly, Lx = y_range[1] - y_range[0], x_range[1] - x_range[0]
+    nframes = len(inds)
+    nPC = min(nPC, nframes)
+    nsketch = min(nframes, nPC + 10)
+
+    def batches():
+        for k in range(0, nframes, batch_size):
+            frames = f[inds[k:k + batch_size]][:, y_range[0]:y_range[1],
+                                               x_range[0]:x_range[1]]
+            yield k, frames.reshape(len(frames), -1).astype(np.float32)
+
+    # range of the frames, and mean image and mean of each frame for centering
+    Omega = np.random.default_rng(random_state).standard_normal((Ly * Lx, nsketch),
+                                                                dtype=np.float32)
+    Y = np.zeros((nframes, nsketch), np.float32)
+    mimg = np.zeros(Ly * Lx, np.float64)
+    fmean = np.zeros(nframes, np.float32)
+    for k, mov in batches():
+        Y[k:k + len(mov)] = mov @ Omega
+        mimg += mov.sum(axis=0)
+        fmean[k:k + len(mov)] = mov.mean(axis=1)
+    # the mean image is subtracted from each frame, then the mean of each frame (as in
+    # pclowhigh)
+    mimg = (mimg / nframes).astype(np.float32)
+    fmean -= mimg.mean()
+    Y -= mimg @ Omega
+    Y -= np.outer(fmean, Omega.sum(axis=0))
+    del Omega
+
+    def centered_batches():
+        for k, mov in batches():
+            mov -= mimg
+            mov -= fmean[k:k + len(mov), np.newaxis]
+            yield k, mov
+
+    # Z spans the top PCs in pixels, Y = frames @ Z
+    Q = np.linalg.qr(Y)[0]
+    Z = np.zeros((Ly * Lx, nsketch), np.float32)
+    for k, mov in centered_batches():
+        Z += mov.T @ Q[k:k + len(mov)]
+    for _ in range(max(1, n_iter)):
+        Z = np.linalg.qr(Z)[0]
+        Znew = np.zeros_like(Z)
+        for k, mov in centered_batches():
+            Y[k:k + len(mov)] = mov @ Z
+            Znew += mov.T @ Y[k:k + len(mov)]
+        Z = Znew
+    del Z
+    u, w = np.linalg.svd(Y, full_matrices=False)[:2]
+    v, w = u[:, :nPC], w[:nPC]
+    # sign of each PC such that its largest weight is positive
+    v *= np.sign(v[np.abs(v).argmax(axis=0), np.arange(nPC)])
+
+    # average the frames at the top and bottom of each PC
+    isort = np.argsort(v, axis=0)
+    low = np.zeros((nframes, nPC), np.float32)
+    high = np.zeros((nframes, nPC), np.float32)
+    low[isort[:nlowhigh], np.arange(nPC)] = 1. / nlowhigh
+    high[isort[-nlowhigh:], np.arange(nPC)] = 1. / nlowhigh
+    pclow = np.zeros((nPC, Ly * Lx), np.float32)
+    pchigh = np.zeros((nPC, Ly * Lx), np.float32)
+    for k, mov in batches():
+        pclow += low[k:k + len(mov)].T @ mov
+        pchigh += high[k:k + len(mov)].T @ mov
+    return pclow.reshape(nPC, Ly, Lx), pchigh.reshape(nPC, Ly, Lx), w, v
+
+
 def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
                 smooth_sigma=1.15, smooth_sigma_time=0, block_size=(128, 128),
                 maxregshift=0.1, maxregshiftNR=10, reg_1p=False, snr_thresh=1.25,
-                is_nonrigid=True, bidiphase_offset=0, spatial_taper=50.0):
+                is_nonrigid=True, bidiphase_offset=0, spatial_taper=50.0, pad_fft=False):
     """
     register top and bottom of PCs to each other
 
@@ -102,6 +214,8 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
     is_nonrigid: bool
     bidiphase_offset: int
     spatial_taper: float
+    pad_fft: bool
+        see registration settings
 
     Returns
     -------
@@ -135,6 +249,7 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
         cfRefImg = rigid.phasecorr_reference(
             refImg=refImg,
             smooth_sigma=smooth_sigma,
+            pad_fft=pad_fft,
         )
 
         cfRefImg = cfRefImg[np.newaxis, :, :]
@@ -147,6 +262,7 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
                 smooth_sigma=smooth_sigma,
                 yblock=yblock,
                 xblock=xblock,
+                pad_fft=pad_fft,
             )
 
         if bidiphase_offset and not bidi_corrected:
@@ -167,8 +283,7 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
             maxregshift=maxregshift,
             smooth_sigma_time=0,
         )
-        for frame, dy, dx in zip(Img, ymax.flatten(), xmax.flatten()):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+        Img = rigid.shift_frames(Img, ymax.flatten(), xmax.flatten())
         ###
 
         # non-rigid registration
@@ -195,7 +310,7 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
     return X
 
 
-def get_pc_metrics(mov, ops, use_red=False):
+def get_pc_metrics(mov, ops, use_red=False, inds=None):
     """
     Computes registration metrics using top PCs of registered movie
 
@@ -207,11 +322,17 @@ def get_pc_metrics(mov, ops, use_red=False):
 
     Parameters
     ----------
+    mov : frames x Ly x Lx
+        subsampled frames from movie, or the registered BinaryFile if inds is given
     ops : dict
         "nframes", "Ly", "Lx", "reg_file" (if use_red=True, "reg_file_chan2")
         (optional, "refImg", "block_size", "maxregshiftNR", "smooth_sigma", "maxregshift", "1Preg")
     use_red : :obj:`bool`, optional
         default False, whether to use "reg_file" or "reg_file_chan2"
+    inds : int, array, optional
+        indices of the subsampled frames in mov. If given, the PCs are computed from
+        batches of ops["batch_size"] frames cropped to ops["yrange"], ops["xrange"] (see
+        pclowhigh_batched) instead of from all frames in memory
 
     Returns
     -------
@@ -221,9 +342,14 @@ def get_pc_metrics(mov, ops, use_red=False):
     """
     random_state = ops["reg_metrics_rs"] if "reg_metrics_rs" in ops else None
     nPC = ops["reg_metric_n_pc"] if "reg_metric_n_pc" in ops else 30
-    pclow, pchigh, sv, ops["tPC"] = pclowhigh(
-        mov, nlowhigh=np.minimum(300, int(ops["nframes"] / 2)), nPC=nPC,
-        random_state=random_state)
+    nlowhigh = np.minimum(300, int(ops["nframes"] / 2))
+    if inds is not None:
+        pclow, pchigh, sv, ops["tPC"] = pclowhigh_batched(
+            mov, inds, nlowhigh=nlowhigh, nPC=nPC, random_state=random_state,
+            batch_size=ops["batch_size"], crop=(ops["yrange"], ops["xrange"]))
+    else:
+        pclow, pchigh, sv, ops["tPC"] = pclowhigh(mov, nlowhigh=nlowhigh, nPC=nPC,
+                                                  random_state=random_state)
     ops["regPC"] = np.concatenate(
         (pclow[np.newaxis, :, :, :], pchigh[np.newaxis, :, :, :]), axis=0)
 
@@ -237,63 +363,44 @@ def get_pc_metrics(mov, ops, use_red=False):
         maxregshiftNR=ops["maxregshiftNR"] if "maxregshiftNR" in ops else 5,
         reg_1p=ops["1Preg"] if "1Preg" in ops else False, snr_thresh=ops["snr_thresh"],
         is_nonrigid=ops["nonrigid"], bidiphase_offset=ops["bidiphase"],
-        spatial_taper=ops["spatial_taper"])
+        spatial_taper=ops["spatial_taper"], pad_fft=ops.get("pad_fft", False))
     return ops
 
 
-def filt_worker(inputs):
-    X, filt = inputs
-    for n in range(X.shape[0]):
-        X[n, :, :] = convolve2d(X[n, :, :], filt, "same")
-    return X
-
+def neighbor_sum(X):
+    """ sum of the 8 neighbors of each pixel of the frames X (zero outside the frames) """
+    # separable 3 x 3 box sum, minus the center pixel
+    S = X.copy()
+    S[:, :, 1:] += X[:, :, :-1]
+    S[:, :, :-1] += X[:, :, 1:]
+    B = S.copy()
+    B[:, 1:] += S[:, :-1]
+    B[:, :-1] += S[:, 1:]
+    B -= X
+    return B
 
-def filt_parallel(data, filt, num_cores):
-    nimg = data.shape[0]
-    nbatch = int(np.ceil(nimg / float(num_cores)))
-    inputs = np.arange(0, nimg, nbatch)
-    irange = []
-    dsplit = []
-    for i in inputs:
-        ilist = i + np.arange(0, np.minimum(nbatch, nimg - i), 1, int)
-        irange.append(ilist)
-        dsplit.append([data[ilist, :, :], filt])
-    if num_cores > 1:
-        with Pool(num_cores) as p:
-            results = p.map(filt_worker, dsplit)
-        results = np.concatenate(results, axis=0)
-    else:
-        results = filt_worker(dsplit[0])
-    return results
 
+def local_corr(mov, batch_size):
+    """ computes correlation image on mov (nframes x pixels x pixels)
 
-def local_corr(mov, batch_size, num_cores):
-    """ computes correlation image on mov (nframes x pixels x pixels) """
+    the correlation image is the mean correlation (over batches of batch_size frames) of
+    each pixel with its 8 neighbors
+    """
     nframes, Ly, Lx = mov.shape
 
-    filt = np.ones((3, 3), np.float32)
-    filt[1, 1] = 0
-    filt /= norm(filt)
-    ix = 0
-    k = 0
-    filtnorm = convolve2d(np.ones((Ly, Lx)), filt, "same")
+    # number of neighbors of each pixel
+    filtnorm = neighbor_sum(np.ones((1, Ly, Lx), np.float32))[0]
 
+    k = 0
     img_corr = np.zeros((Ly, Lx), np.float32)
-    while ix < nframes:
-        ifr = np.arange(ix, min(ix + batch_size, nframes), 1, int)
-
-        X = mov[ifr, :, :]
-        X = X.astype(np.float32)
+    for ix in range(0, nframes, batch_size):
+        X = mov[ix:ix + batch_size].astype(np.float32)
         X -= X.mean(axis=0)
         Xstd = X.std(axis=0)
         Xstd[Xstd == 0] = np.inf
-        #X /= np.maximum(1, X.std(axis=0))
         X /= Xstd
-        #for n in range(X.shape[0]):
-        #    X[n,:,:] *= convolve2d(X[n,:,:], filt, "same")
-        X *= filt_parallel(X, filt, num_cores)
+        X *= neighbor_sum(X)
         img_corr += X.mean(axis=0)
-        ix += batch_size
         k += 1
     img_corr /= filtnorm
     img_corr /= float(k)
@@ -325,8 +432,12 @@ def corr_to_template(mov, tmpl):
     return correlations
 
 
-def optic_flow(mov, tmpl, nflows):
-    """ optic flow computation using farneback """
+def optic_flow(mov, tmpl, nflows, pool=None):
+    """ optic flow computation using farneback
+
+    flows of the frames are computed in parallel by the threads of pool (a
+    ThreadPoolExecutor) if given
+    """
     window = int(1 / 0.2)  # window size
     nframes, Ly, Lx = mov.shape
     mov = mov.astype(np.float32)
@@ -343,15 +454,17 @@ def optic_flow(mov, tmpl, nflows):
     poly_sigma = 1.2 / 5
     flags = 0
 
+    def flow_frame(frame):
+        return cv2.calcOpticalFlowFarneback(tmpl, frame, None, pyr_scale, levels, winsize,
+                                            iterations, poly_n, poly_sigma, flags)
+
     nframes, Ly, Lx = mov.shape
     norms = np.zeros((nframes,))
     flows = np.zeros((nframes, Ly, Lx, 2))
 
-    for n in range(nframes):
-        flow = cv2.calcOpticalFlowFarneback(tmpl, mov[n, :, :], None, pyr_scale, levels,
-                                            winsize, iterations, poly_n, poly_sigma,
-                                            flags)
-
+    # frames are shared with the threads, cv2 releases the GIL while computing the flow
+    results = pool.map(flow_frame, mov) if pool is not None else map(flow_frame, mov)
+    for n, flow in enumerate(results):
         flows[n, :, :, :] = flow
         norms[n] = norm(flow)
 
@@ -359,62 +472,51 @@ def optic_flow(mov, tmpl, nflows):
 
 
 def get_flow_metrics(ops):
-    """ get farneback optical flow and some other stats from normcorre paper """
+    """ get farneback optical flow and some other stats from normcorre paper
+
+    frames of ops["reg_file"] are read in batches, and the optical flows of each batch are
+    computed by ops["num_workers"] threads (0 uses one thread per core)
+    """
     # done in batches for memory reasons
     Ly = ops["Ly"]
     Lx = ops["Lx"]
-    reg_file = open(ops["reg_file"], "rb")
     nbatch = ops["batch_size"]
-    nbytesread = 2 * Ly * Lx * nbatch
 
     Lyc = ops["yrange"][1] - ops["yrange"][0]
     Lxc = ops["xrange"][1] - ops["xrange"][0]
     img_corr = np.zeros((Lyc, Lxc), np.float32)
     img_median = np.zeros((Lyc, Lxc), np.float32)
-    correlations = np.zeros((0,), np.float32)
-    flows = np.zeros((0, Lyc, Lxc, 2), np.float32)
-    norms = np.zeros((0,), np.float32)
+    correlations, flows, norms = [], [], []
     smoothness = 0
     smoothness_corr = 0
 
     nflows = np.minimum(ops["nframes"], int(np.floor(100 / (ops["nframes"] / nbatch))))
-    ncorrs = np.minimum(ops["nframes"], int(np.floor(1000 / (ops["nframes"] / nbatch))))
 
-    k = 0
-    while True:
-        buff = reg_file.read(nbytesread)
-        mov = np.frombuffer(buff, dtype=np.int16, offset=0)
-        buff = []
-        if mov.size == 0:
-            break
-        mov = np.reshape(mov, (-1, Ly, Lx))
-
-        mov = mov[np.ix_(np.arange(0, mov.shape[0], 1, int),
-                         np.arange(ops["yrange"][0], ops["yrange"][1], 1, int),
-                         np.arange(ops["xrange"][0], ops["xrange"][1], 1, int))]
-
-        img_corr += local_corr(mov[:, :, :], 1000, ops["num_workers"])
-        img_median += bin_median(mov)
-        k += 1
+    if not HAS_CV2:
+        print("flows not computed, cv2 not installed / did not import correctly")
 
-        smoothness += np.sqrt(
-            np.sum(np.sum(np.array(np.gradient(np.mean(mov, 0)))**2, 0)))
-        smoothness_corr += np.sqrt(np.sum(np.sum(np.array(np.gradient(img_corr))**2,
-                                                 0)))
-
-        tmpl = img_median / k
-
-        correlations0 = corr_to_template(mov, tmpl)
-        correlations = np.hstack((correlations, correlations0))
-        if HAS_CV2:
-            flows0, norms0 = optic_flow(mov, tmpl, nflows)
-        else:
-            flows0 = []
-            norms0 = []
-            print("flows not computed, cv2 not installed / did not import correctly")
-
-        flows = np.vstack((flows, flows0))
-        norms = np.hstack((norms, norms0))
+    k = 0
+    with ThreadPoolExecutor(ops.get("num_workers", 0) or os.cpu_count() or 1) as pool, \
+            io.BinaryFile(Ly=Ly, Lx=Lx, filename=ops["reg_file"]) as reg_file:
+        for _, mov in io.iter_batches(reg_file, nbatch,
+                                      crop=(ops["yrange"], ops["xrange"]),
+                                      prefetch=ops.get("prefetch_batches", 1)):
+            img_corr += local_corr(mov, 1000)
+            img_median += bin_median(mov)
+            k += 1
+
+            smoothness += np.sqrt(
+                np.sum(np.sum(np.array(np.gradient(np.mean(mov, 0)))**2, 0)))
+            smoothness_corr += np.sqrt(np.sum(np.sum(np.array(np.gradient(img_corr))**2,
+                                                     0)))
+
+            tmpl = img_median / k
+
+            correlations.append(corr_to_template(mov, tmpl))
+            if HAS_CV2:
+                flows0, norms0 = optic_flow(mov, tmpl, nflows, pool=pool)
+                flows.append(flows0)
+                norms.append(norms0)
 
     img_corr /= float(k)
     img_median /= float(k)
@@ -422,4 +524,10 @@ def get_flow_metrics(ops):
     smoothness /= float(k)
     smoothness_corr /= float(k)
 
+    correlations = np.concatenate(correlations).astype(np.float32)
+    flows = (np.concatenate(flows).astype(np.float32)
+             if len(flows) > 0 else np.zeros((0, Lyc, Lxc, 2), np.float32))
+    norms = (np.concatenate(norms).astype(np.float32)
+             if len(norms) > 0 else np.zeros((0,), np.float32))
+
     return tmpl, correlations, flows, norms, smoothness, smoothness_corr, img_corr
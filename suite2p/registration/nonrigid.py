@@ -7,9 +7,14 @@ from typing import Tuple
 import numpy as np
 from numba import float32, njit, prange
 from numpy import fft
-from scipy.fftpack import next_fast_len
+from scipy.fft import next_fast_len
 
-from .utils import addmultiply, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve
+from .rigid import shift_frames
+from .utils import addmultiply, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve, cc_window
+
+
+# number of block correlations upsampled at once in phasecorr
+UPSAMPLE_BATCH = 1024
 
 
 def calculate_nblocks(L: int, block_size: int = 128) -> Tuple[int, int]:
@@ -76,7 +81,7 @@ def make_blocks(Ly, Lx, block_size=(128, 128)):
 
 
 def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma,
-                        yblock: np.ndarray, xblock: np.ndarray):
+                        yblock: np.ndarray, xblock: np.ndarray, pad_fft: bool = False):
     """
     Computes taper and fft"ed reference image for phasecorr.
 
@@ -87,6 +92,8 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma,
     smooth_sigma
     yblock: float array
     xblock: float array
+    pad_fft: bool (optional, default False)
+        whether to zero-pad the blocks to a fast FFT size
     
     Returns
     -------
@@ -97,7 +104,7 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma,
     """
     nb, Ly, Lx = len(yblock), yblock[0][1] - yblock[0][0], xblock[0][1] - xblock[0][0]
     dims = (nb, Ly, Lx)
-    cfRef_dims = dims
+    cfRef_dims = (nb, next_fast_len(Ly), next_fast_len(Lx)) if pad_fft else dims
     gaussian_filter = gaussian_fft(smooth_sigma, *cfRef_dims[1:])
     cfRefImg1 = np.zeros(cfRef_dims, "complex64")
 
@@ -117,7 +124,7 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma,
         maskOffset1_n[:] = refImg.mean() * (1. - maskMul1_n)
 
         # gaussian filter
-        cfRefImg1_n[:] = np.conj(fft.fft2(refImg))
+        cfRefImg1_n[:] = np.conj(fft.fft2(refImg, s=cfRef_dims[1:]))
         cfRefImg1_n /= 1e-5 + np.absolute(cfRefImg1_n)
         cfRefImg1_n[:] *= gaussian_filter
 
@@ -145,11 +152,11 @@ def getSNR(cc: np.ndarray, lcorr: int, lpad: int) -> float:
     """
     cc0 = cc[:, lpad:-lpad, lpad:-lpad].reshape(cc.shape[0], -1)
     # set to 0 all pts +-lpad from ymax,xmax
-    cc1 = cc.copy()
-    for c1, ymax, xmax in zip(
-            cc1,
-            *np.unravel_index(np.argmax(cc0, axis=1), (2 * lcorr + 1, 2 * lcorr + 1))):
-        c1[ymax:ymax + 2 * lpad, xmax:xmax + 2 * lpad] = 0
+    ymax, xmax = np.unravel_index(np.argmax(cc0, axis=1), (2 * lcorr + 1, 2 * lcorr + 1))
+    inds = np.arange(cc.shape[-1])
+    ypeak = (inds >= ymax[:, np.newaxis]) & (inds < ymax[:, np.newaxis] + 2 * lpad)
+    xpeak = (inds >= xmax[:, np.newaxis]) & (inds < xmax[:, np.newaxis] + 2 * lpad)
+    cc1 = np.where(ypeak[:, :, np.newaxis] & xpeak[:, np.newaxis, :], 0, cc)
 
     snr = np.amax(cc0, axis=1) / np.maximum(
         1e-10, np.amax(cc1.reshape(cc.shape[0], -1),
@@ -188,10 +195,11 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     cmax1
     """
 
-    Kmat, nup = mat_upsample(lpad=3)
+    Kmat, nup = mat_upsample(lpad=lpad, subpixel=subpixel)
 
     nimg = data.shape[0]
-    ly, lx = cfRefImg.shape[-2:]
+    ly, lx = maskMul.shape[-2:]
+    cfRefImg = cfRefImg.reshape(-1, *cfRefImg.shape[-2:])
 
     # maximum registration shift allowed
     lcorr = int(
@@ -205,57 +213,57 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
         yind, xind = yblock[n], xblock[n]
         Y[:, n] = data[:, yind[0]:yind[-1], xind[0]:xind[-1]]
     Y = addmultiply(Y, maskMul, maskOffset)
+
+    # phase correlation within +/- (lcorr + lpad) of zero shift
+    lhalf = lcorr + lpad
+    cc0 = np.zeros((nb, nimg, 2 * lhalf + 1, 2 * lhalf + 1), "float32")
     batch = min(64, Y.shape[1])  #16
     for n in np.arange(0, nb, batch):
         nend = min(Y.shape[1], n + batch)
-        Y[:, n:nend] = convolve(mov=Y[:, n:nend], img=cfRefImg[n:nend])
-
-    # calculate ccsm
-    lhalf = lcorr + lpad
-    cc0 = np.real(
-        np.block([[Y[:, :, -lhalf:, -lhalf:], Y[:, :, -lhalf:, :lhalf + 1]],
-                  [Y[:, :, :lhalf + 1, -lhalf:], Y[:, :, :lhalf + 1, :lhalf + 1]]]))
-    cc0 = cc0.transpose(1, 0, 2, 3)
+        cc = convolve(mov=Y[:, n:nend], img=cfRefImg[n:nend])
+        cc_window(cc, lhalf, out=cc0[n:nend].transpose(1, 0, 2, 3))
     cc0 = cc0.reshape(cc0.shape[0], -1)
 
-    cc2 = [cc0, NRsm @ cc0, NRsm @ NRsm @ cc0]
-    cc2 = [
-        c2.reshape(nb, nimg, 2 * lcorr + 2 * lpad + 1, 2 * lcorr + 2 * lpad + 1)
-        for c2 in cc2
-    ]
-    ccsm = cc2[0]
-    for n in range(nb):
-        snr = np.ones(nimg, "float32")
-        for j, c2 in enumerate(cc2):
-            ism = snr < snr_thresh
-            if np.sum(ism) == 0:
-                break
-            cc = c2[n, ism, :, :]
-            if j > 0:
-                ccsm[n, ism, :, :] = cc
-            snr[ism] = getSNR(cc, lcorr, lpad)
+    # smooth blocks with low SNR with their neighbours (up to twice), for all blocks and
+    # frames at once
+    ccsm = cc0.reshape(nb, nimg, 2 * lhalf + 1, 2 * lhalf + 1)
+    snr = np.ones((nb, nimg), "float32")
+    c2 = cc0
+    for j in range(3):
+        ism = snr < snr_thresh
+        if np.sum(ism) == 0:
+            break
+        if j > 0:
+            c2 = NRsm @ c2
+            cc = c2.reshape(ccsm.shape)[ism]
+            ccsm[ism] = cc
+        else:
+            cc = ccsm[ism]
+        snr[ism] = getSNR(cc, lcorr, lpad)
 
     # calculate ymax1, xmax1, cmax1
+    ccsm = ccsm.reshape(nb * nimg, 2 * lhalf + 1, 2 * lhalf + 1)
+    ix = np.argmax(ccsm[:, lpad:-lpad, lpad:-lpad].reshape(nb * nimg, -1), axis=1)
+    ymax, xmax = np.unravel_index(ix, (2 * lcorr + 1, 2 * lcorr + 1))
+    dy, dx = np.meshgrid(np.arange(2 * lpad + 1), np.arange(2 * lpad + 1), indexing="ij")
+    ccmat = ccsm[np.arange(nb * nimg)[:, np.newaxis, np.newaxis],
+                 ymax[:, np.newaxis, np.newaxis] + dy, xmax[:, np.newaxis, np.newaxis] + dx]
+    ccmat = ccmat.reshape(nb * nimg, -1)
+    imax = np.empty(nb * nimg, np.int64)
+    cmax1 = np.empty(nb * nimg, np.float32)
+    # upsample in chunks to keep the upsampled correlations small
+    for i in range(0, nb * nimg, UPSAMPLE_BATCH):
+        ccb = ccmat[i:i + UPSAMPLE_BATCH] @ Kmat
+        imax[i:i + UPSAMPLE_BATCH] = np.argmax(ccb, axis=1)
+        cmax1[i:i + UPSAMPLE_BATCH] = ccb[np.arange(ccb.shape[0]), imax[i:i + UPSAMPLE_BATCH]]
+    yup, xup = np.unravel_index(imax, (nup, nup))
     mdpt = nup // 2
-    ymax1 = np.empty((nimg, nb), np.float32)
-    cmax1 = np.empty((nimg, nb), np.float32)
-    xmax1 = np.empty((nimg, nb), np.float32)
-    ymax = np.empty((nb,), np.int32)
-    xmax = np.empty((nb,), np.int32)
-
-    for t in range(nimg):
-        ccmat = np.empty((nb, 2 * lpad + 1, 2 * lpad + 1), np.float32)
-        for n in range(nb):
-            ix = np.argmax(ccsm[n, t][lpad:-lpad, lpad:-lpad], axis=None)
-            ym, xm = np.unravel_index(ix, (2 * lcorr + 1, 2 * lcorr + 1))
-            ccmat[n] = ccsm[n, t][ym:ym + 2 * lpad + 1, xm:xm + 2 * lpad + 1]
-            ymax[n], xmax[n] = ym - lcorr, xm - lcorr
-        ccb = ccmat.reshape(nb, -1) @ Kmat
-        cmax1[t] = np.amax(ccb, axis=1)
-        ymax1[t], xmax1[t] = np.unravel_index(np.argmax(ccb, axis=1), (nup, nup))
-        ymax1[t] = (ymax1[t] - mdpt) / subpixel + ymax
-        xmax1[t] = (xmax1[t] - mdpt) / subpixel + xmax
+    ymax1 = (yup - mdpt) / subpixel + (ymax - lcorr)
+    xmax1 = (xup - mdpt) / subpixel + (xmax - lcorr)
 
+    ymax1 = ymax1.reshape(nb, nimg).T.astype(np.float32)
+    xmax1 = xmax1.reshape(nb, nimg).T.astype(np.float32)
+    cmax1 = np.ascontiguousarray(cmax1.reshape(nb, nimg).T)
     return ymax1, xmax1, cmax1
 
 
@@ -348,6 +356,39 @@ def block_interp(ymax1, xmax1, mshy, mshx, yup, xup):
                         xup[t])  # x shifts for blocks to coordinate map
 
 
+def block_coordinates(Lx, Ly, nblocks, xblock, yblock):
+    """ returns the coordinates of each pixel on the grid of block centers
+
+    Parameters
+    ----------
+    Lx: int
+        number of pixels in the horizontal dimension
+    Ly: int
+        number of pixels in the vertical dimension
+    nblocks: (int, int)
+    xblock: float array
+    yblock: float array
+
+    Returns
+    -------
+    iy : Ly
+        position of each row between the block centers in y
+    ix : Lx
+        position of each column between the block centers in x
+    """
+    # make arrays of control points for piecewise-affine transform
+    # includes centers of blocks AND edges of blocks
+    # note indices are flipped for control points
+    # block centers
+    yb = np.array(yblock[::nblocks[1]]).mean(
+        axis=1)  # this recovers the coordinates of the meshgrid from (yblock, xblock)
+    xb = np.array(xblock[:nblocks[1]]).mean(axis=1)
+
+    iy = np.interp(np.arange(Ly), yb, np.arange(yb.size)).astype(np.float32)
+    ix = np.interp(np.arange(Lx), xb, np.arange(xb.size)).astype(np.float32)
+    return iy, ix
+
+
 def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
     """ upsample blocks of shifts into full pixel-wise maps for shifting
 
@@ -377,16 +418,7 @@ def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
         x shifts for each coordinate
 
     """
-    # make arrays of control points for piecewise-affine transform
-    # includes centers of blocks AND edges of blocks
-    # note indices are flipped for control points
-    # block centers
-    yb = np.array(yblock[::nblocks[1]]).mean(
-        axis=1)  # this recovers the coordinates of the meshgrid from (yblock, xblock)
-    xb = np.array(xblock[:nblocks[1]]).mean(axis=1)
-
-    iy = np.interp(np.arange(Ly), yb, np.arange(yb.size)).astype(np.float32)
-    ix = np.interp(np.arange(Lx), xb, np.arange(xb.size)).astype(np.float32)
+    iy, ix = block_coordinates(Lx, Ly, nblocks, xblock, yblock)
     mshx, mshy = np.meshgrid(ix, iy)
 
     # interpolate from block centers to all points Ly x Lx
@@ -401,9 +433,72 @@ def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
     return yup, xup
 
 
-def transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinear=True):
+def _interp_indices(c, n):
+    """ floor, clipped floor and ceil and fraction of coordinates c on a grid of size n,
+    as computed in map_coordinates """
+    c_floor = c.astype(np.int32)
+    frac = (c - c_floor).astype(np.float32)
+    c0 = np.minimum(n - 1, np.maximum(0, c_floor))
+    c1 = np.minimum(n - 1, c0 + 1)
+    return c0, c1, frac
+
+
+@njit(parallel=True, cache=True)
+def _transform_frames(data, ymax1, xmax1, by0, by1, bfy, bx0, bx1, bfx, ymax, xmax,
+                      bilinear, Y):
+    """
+    Shifts data by the rigid shifts ymax, xmax (integers, circular) and by the block
+    shifts ymax1, xmax1 interpolated to each pixel, in a single pass.
+
+    The pixel-wise shifts are computed on the fly from the block shifts, with the same
+    bilinear interpolation as block_interp and shift_coordinates.
+    """
+    nimg, Ly, Lx = data.shape
+    for t in prange(nimg):
+        ry, rx = ymax[t], xmax[t]
+        for i in range(Ly):
+            yb0, yb1, fby = by0[i], by1[i], bfy[i]
+            for j in range(Lx):
+                xb0, xb1, fbx = bx0[j], bx1[j], bfx[j]
+                # shifts of pixel (i, j) from the shifts of the surrounding blocks
+                dy = np.float32(ymax1[t, yb0, xb0] * (1 - fby) * (1 - fbx) +
+                                ymax1[t, yb0, xb1] * (1 - fby) * fbx +
+                                ymax1[t, yb1, xb0] * fby * (1 - fbx) +
+                                ymax1[t, yb1, xb1] * fby * fbx)
+                dx = np.float32(xmax1[t, yb0, xb0] * (1 - fby) * (1 - fbx) +
+                                xmax1[t, yb0, xb1] * (1 - fby) * fbx +
+                                xmax1[t, yb1, xb0] * fby * (1 - fbx) +
+                                xmax1[t, yb1, xb1] * fby * fbx)
+                if not bilinear:
+                    dy = np.float32(np.round(dy))
+                    dx = np.float32(np.round(dx))
+                yc = np.float32(i) + dy
+                xc = np.float32(j) + dx
+                yc_floor = np.int32(yc)
+                xc_floor = np.int32(xc)
+                y = np.float32(yc - yc_floor)
+                x = np.float32(xc - xc_floor)
+                yf = min(Ly - 1, max(0, yc_floor))
+                xf = min(Lx - 1, max(0, xc_floor))
+                yf1 = min(Ly - 1, yf + 1)
+                xf1 = min(Lx - 1, xf + 1)
+                # sample the rigidly shifted frame
+                yf, yf1 = (yf + ry) % Ly, (yf1 + ry) % Ly
+                xf, xf1 = (xf + rx) % Lx, (xf1 + rx) % Lx
+                Y[t, i, j] = np.float32(
+                    np.float32(data[t, yf, xf]) * (1 - y) * (1 - x) +
+                    np.float32(data[t, yf, xf1]) * (1 - y) * x +
+                    np.float32(data[t, yf1, xf]) * y * (1 - x) +
+                    np.float32(data[t, yf1, xf1]) * y * x)
+
+
+def transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinear=True,
+                   ymax=None, xmax=None):
     """
     Piecewise affine transformation of data using block shifts ymax1, xmax1
+
+    The pixel-wise shifts are interpolated from the block shifts on the fly, and rigid
+    shifts ymax, xmax can be applied in the same pass.
     
     Parameters
     ----------
@@ -418,29 +513,34 @@ def transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinear=True):
         y shifts of blocks
     bilinear: bool (optional, default=True)
         do bilinear interpolation, if False do nearest neighbor
+    ymax : nimg (optional, default None)
+        rigid y shifts to apply before the block shifts (as in rigid.shift_frames)
+    xmax : nimg (optional, default None)
+        rigid x shifts to apply before the block shifts (as in rigid.shift_frames)
 
     Returns
     -----------
     Y : float32, nimg x Ly x Lx
         shifted data
     """
-    _, Ly, Lx = data.shape
-    yup, xup = upsample_block_shifts(
-        Lx=Lx,
-        Ly=Ly,
-        nblocks=nblocks,
-        xblock=xblock,
-        yblock=yblock,
-        ymax1=ymax1,
-        xmax1=xmax1,
-    )
-    if not bilinear:
-        yup = np.round(yup)
-        xup = np.round(xup)
-
-    # use shifts and do bilinear interpolation
-    mshx, mshy = np.meshgrid(np.arange(Lx, dtype=np.float32),
-                             np.arange(Ly, dtype=np.float32))
+    nimg, Ly, Lx = data.shape
+    if ymax is None or xmax is None:
+        ymax, xmax = np.zeros(nimg, np.int64), np.zeros(nimg, np.int64)
+    ymax, xmax = np.asarray(ymax).reshape(-1), np.asarray(xmax).reshape(-1)
+    if np.all(ymax == np.round(ymax)) and np.all(xmax == np.round(xmax)):
+        ymax, xmax = ymax.astype(np.int64), xmax.astype(np.int64)
+    else:
+        # sub-pixel rigid shifts are interpolated separately
+        data = shift_frames(data, ymax, xmax)
+        ymax, xmax = np.zeros(nimg, np.int64), np.zeros(nimg, np.int64)
+
+    iy, ix = block_coordinates(Lx, Ly, nblocks, xblock, yblock)
+    by0, by1, bfy = _interp_indices(iy, nblocks[0])
+    bx0, bx1, bfx = _interp_indices(ix, nblocks[1])
+    ymax1 = np.ascontiguousarray(ymax1, np.float32).reshape(nimg, nblocks[0], nblocks[1])
+    xmax1 = np.ascontiguousarray(xmax1, np.float32).reshape(nimg, nblocks[0], nblocks[1])
+
     Y = np.zeros_like(data, dtype=np.float32)
-    shift_coordinates(data, yup, xup, mshy, mshx, Y)
+    _transform_frames(data, ymax1, xmax1, by0, by1, bfy, bx0, bx1, bfx, ymax, xmax,
+                      bilinear, Y)
     return Y
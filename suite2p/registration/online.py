@@ -0,0 +1,369 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import struct
+import time
+import zlib
+from typing import Optional
+
+import numpy as np
+from tifffile import TiffFile, TiffPage
+
+from .. import default_ops
+from ..io.binary import CHECKSUM_FRAMES, write_header
+from ..io.chunked import ChunkedWriter, open_binary_for_writing
+from . import bidiphase as bidi
+from . import register, utils
+
+
+class OnlineRegistration:
+
+    def __init__(self, Ly: int, Lx: int, ops=default_ops(), filename: Optional[str] = None):
+        """
+        Registers frames as they are acquired.
+
+        The first ops["nimg_init"] frames are buffered and used to compute the reference
+        image (see register.compute_reference), and all following frames are registered
+        (see register.register_frames) as soon as they are pushed. If
+        ops["online_ref_update"] > 0, the reference image is replaced by the mean of the
+        last ops["online_ref_update"] registered frames each time that many frames have
+        been registered.
+
+        The FFT backend of ops["fft_backend"] and ops["fft_threads"] is only used while
+        frames are pushed, the previous backend is restored afterwards.
+
+        Parameters
+        ----------
+        Ly: int
+            The height of each frame
+        Lx: int
+            The width of each frame
+        ops: dictionary
+            registration settings
+        filename: str
+            If not None, registered frames are appended to this binary (e.g. data.bin,
+            compressed if ops["binary_compression"] is set), and its header is updated
+            after each push
+        """
+        self.Ly, self.Lx = Ly, Lx
+        self.ops = dict(ops)
+        self.filename = filename
+        self.file = (open_binary_for_writing(filename, self.ops)
+                     if filename is not None else None)
+        self._fft_settings = (self.ops.get("fft_backend", ""), self.ops.get("fft_threads", 0),
+                              utils.fft_shape(Ly, Lx, self.ops["pad_fft"]))
+        # crc32 of the completed chunks of CHECKSUM_FRAMES frames, and of the last chunk
+        self._checksums, self._chunk_crc, self._chunk_frames = [], 0, 0
+
+        self.refImg = None
+        self.refAndMasks = None
+        self.rmin, self.rmax = -np.inf, np.inf
+        self.bidiphase = 0
+        self.n_frames = 0
+        self.mean_img = np.zeros((Ly, Lx), np.float64)
+
+        # frames waiting for the reference image and the time they were pushed
+        self._buffer, self._t_push = [], []
+        # registered frames since the last reference update
+        self._ref_sum, self._ref_count = np.zeros((Ly, Lx), np.float64), 0
+        self.rigid_offsets, self.nonrigid_offsets = [], []
+        self.latency = np.zeros((0,), np.float32)
+
+    @property
+    def initialized(self) -> bool:
+        """ whether the reference image has been computed """
+        return self.refAndMasks is not None
+
+    def push(self, frames: np.ndarray) -> np.ndarray:
+        """
+        Registers frames, or buffers them until there are enough frames to compute the
+        reference image.
+
+        Parameters
+        ----------
+        frames: nImg x Ly x Lx, int16
+
+        Returns
+        -------
+        registered frames: nImg x Ly x Lx, float32
+            the frames registered during this push, in order of acquisition (frames are
+            returned once the reference image is computed)
+        """
+        frames = np.asarray(frames).reshape(-1, self.Ly, self.Lx)
+        self._buffer.append(frames)
+        self._t_push.append(np.full(len(frames), time.perf_counter()))
+        if not self.initialized:
+            if sum(len(f) for f in self._buffer) < self.ops["nimg_init"]:
+                return np.zeros((0, self.Ly, self.Lx), np.float32)
+        with utils.using_fft_backend(*self._fft_settings):
+            if not self.initialized:
+                self._initialize(np.concatenate(self._buffer))
+            return self._register_buffer()
+
+    def close(self):
+        """
+        Registers any buffered frames (computing the reference image from them if fewer
+        than ops["nimg_init"] frames were pushed) and closes the binary.
+
+        Returns
+        -------
+        registered frames: nImg x Ly x Lx, float32
+            the frames registered in this call
+        """
+        frames = np.zeros((0, self.Ly, self.Lx), np.float32)
+        if len(self._buffer) > 0 and sum(len(f) for f in self._buffer) > 0:
+            with utils.using_fft_backend(*self._fft_settings):
+                if not self.initialized:
+                    self._initialize(np.concatenate(self._buffer))
+                frames = self._register_buffer()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def tail(self, filename: str, poll_interval: float = 0.1, timeout: float = 10.):
+        """
+        Registers frames from filename as they are written to it, until no new frames were
+        written for timeout seconds.
+
+        filename can be a tiff (one page per frame) or a raw int16 binary with frames of
+        Ly x Lx, from a single plane and channel.
+
+        Parameters
+        ----------
+        filename: str
+            The file being written by the acquisition
+        poll_interval: float
+            Seconds to wait before checking for new frames
+        timeout: float
+            Seconds without new frames after which tailing stops
+
+        Yields
+        ------
+        registered frames: nImg x Ly x Lx, float32
+            the frames registered after each read
+        """
+        reader = NewFrameReader(filename, self.Ly, self.Lx)
+        t_last = time.time()
+        while True:
+            frames = reader.read()
+            if len(frames) > 0:
+                t_last = time.time()
+                frames = self.push(frames)
+                if len(frames) > 0:
+                    yield frames
+            elif time.time() - t_last > timeout:
+                break
+            else:
+                time.sleep(poll_interval)
+
+    def _initialize(self, frames: np.ndarray) -> None:
+        """ computes the bidiphase offset and reference image from the first frames """
+        ops = self.ops
+        frames = frames[np.linspace(0, len(frames), 1 + min(ops["nimg_init"], len(frames)),
+                                    dtype=int)[:-1]].copy()
+        if ops["do_bidiphase"] and ops["bidiphase"] == 0 and not ops["bidi_corrected"]:
+            ops["bidiphase"] = bidi.compute(
+                frames, subpixel=ops["subpixel"] if ops.get("bidi_subpixel", False) else 1)
+            print("NOTE: estimated bidiphase offset from data: %g pixels" %
+                  ops["bidiphase"])
+        if ops["bidiphase"] and not ops["bidi_corrected"]:
+            self.bidiphase = ops["bidiphase"]
+            bidi.shift(frames, self.bidiphase)
+        self._set_reference(register.compute_reference(frames, ops=ops))
+
+    def _set_reference(self, refImg: np.ndarray) -> None:
+        self.refImg = refImg
+        if self.ops.get("norm_frames", False):
+            refImg, self.rmin, self.rmax = register.normalize_reference_image(refImg)
+        self.refAndMasks = register.compute_reference_masks(refImg, self.ops)
+
+    def _register_buffer(self) -> np.ndarray:
+        frames = np.concatenate(self._buffer)
+        t_push = np.concatenate(self._t_push)
+        self._buffer, self._t_push = [], []
+
+        batch_size = self.ops["batch_size"]
+        ref_update = self.ops.get("online_ref_update", 0)
+        registered = []
+        for k in range(0, len(frames), batch_size):
+            # frames are registered in place, so they are copied from the caller's array
+            batch = frames[k:k + batch_size].copy()
+            batch, ymax, xmax, cmax, ymax1, xmax1, cmax1, _ = register.register_frames(
+                self.refAndMasks, batch, rmin=self.rmin, rmax=self.rmax,
+                bidiphase=self.bidiphase, ops=self.ops)
+            self.rigid_offsets.append([ymax, xmax, cmax])
+            if self.ops["nonrigid"]:
+                self.nonrigid_offsets.append([ymax1, xmax1, cmax1])
+            self.mean_img += batch.sum(axis=0)
+            self.n_frames += len(batch)
+            if self.file is not None:
+                frames16 = np.minimum(batch, 2**15 - 2).astype("int16")
+                self.file.write(frames16)
+                self._append_checksums(frames16)
+            registered.append(batch.astype(np.float32, copy=False))
+
+            # rolling reference update, from frames registered to the current reference
+            if ref_update > 0:
+                self._ref_sum += batch.sum(axis=0)
+                self._ref_count += len(batch)
+                if self._ref_count >= ref_update:
+                    self._set_reference(
+                        (self._ref_sum / self._ref_count).astype(self.refImg.dtype))
+                    self._ref_sum[:], self._ref_count = 0, 0
+
+        self.latency = np.concatenate(
+            (self.latency, (time.perf_counter() - t_push).astype(np.float32)))
+        if self.file is not None:
+            self.file.flush()
+            if not isinstance(self.file, ChunkedWriter):
+                # chunked binaries carry their own header
+                checksums = self._checksums + ([self._chunk_crc]
+                                               if self._chunk_frames > 0 else [])
+                write_header(self.filename, Ly=self.Ly, Lx=self.Lx, dtype="int16",
+                             n_frames=self.n_frames, fs=self.ops.get("fs"),
+                             checksums=checksums)
+        return np.concatenate(registered)
+
+    def _append_checksums(self, frames: np.ndarray) -> None:
+        """ updates the crc32 of the chunks of CHECKSUM_FRAMES frames with frames """
+        k = 0
+        while k < len(frames):
+            n = min(CHECKSUM_FRAMES - self._chunk_frames, len(frames) - k)
+            self._chunk_crc = zlib.crc32(frames[k:k + n], self._chunk_crc)
+            self._chunk_frames += n
+            k += n
+            if self._chunk_frames == CHECKSUM_FRAMES:
+                self._checksums.append(self._chunk_crc)
+                self._chunk_crc, self._chunk_frames = 0, 0
+
+    def registration_outputs(self):
+        """
+        Returns the outputs of the frames registered so far, in the format of
+        register.registration_wrapper (see register.save_registration_outputs_to_ops).
+        """
+        rigid_offsets = utils.combine_offsets_across_batches(self.rigid_offsets,
+                                                             rigid=True)
+        nonrigid_offsets = utils.combine_offsets_across_batches(
+            self.nonrigid_offsets, rigid=False) if self.ops["nonrigid"] else []
+        yoff, xoff, corrXY = rigid_offsets
+        badframes, yrange, xrange = register.compute_crop(
+            xoff=xoff,
+            yoff=yoff,
+            corrXY=corrXY,
+            th_badframes=self.ops["th_badframes"],
+            badframes=np.zeros(self.n_frames, "bool"),
+            maxregshift=self.ops["maxregshift"],
+            Ly=self.Ly,
+            Lx=self.Lx,
+        )
+        meanImg = (self.mean_img / max(1, self.n_frames)).astype(np.float32)
+        return (self.refImg, self.rmin, self.rmax, meanImg, rigid_offsets, nonrigid_offsets,
+                ([], []), None, badframes, yrange, xrange)
+
+
+# IFD layout of classic tiffs (42) and bigtiffs (43): format and size of the number of
+# tags, size of a tag, format and size of IFD offsets, position of the first IFD offset
+TIFF_IFD_FORMATS = {42: ("H", 2, 12, "I", 4, 4), 43: ("Q", 8, 20, "Q", 8, 8)}
+
+
+class NewFrameReader:
+
+    def __init__(self, filename: str, Ly: int, Lx: int):
+        """
+        Reads the frames appended to a file while it is being written by an acquisition.
+
+        filename can be a tiff (one page per frame) or a raw int16 binary with frames of
+        Ly x Lx. The position of the last frame read (the offset of its IFD for tiffs) is
+        kept between reads, so that each read only parses the new frames. Frames that are
+        not completely written yet are not returned, any other error is raised.
+        """
+        self.filename = filename
+        self.Ly, self.Lx = Ly, Lx
+        self.nread = 0
+        self.is_tiff = os.path.splitext(filename)[-1].lower() in [".tif", ".tiff"]
+        self._ifd = None  # offset of the IFD of the last tiff page read
+
+    def read(self) -> np.ndarray:
+        """ returns the frames written after the last read, nImg x Ly x Lx """
+        frames = np.zeros((0, self.Ly, self.Lx), np.int16)
+        if os.path.exists(self.filename):
+            frames = self._read_tiff() if self.is_tiff else self._read_raw()
+        self.nread += len(frames)
+        return frames
+
+    def _read_raw(self) -> np.ndarray:
+        nbytes = 2 * self.Ly * self.Lx
+        nframes = os.path.getsize(self.filename) // nbytes - self.nread
+        return np.fromfile(self.filename, dtype=np.int16, count=max(0, nframes) * self.Ly *
+                           self.Lx, offset=self.nread * nbytes).reshape(-1, self.Ly, self.Lx)
+
+    def _new_ifds(self):
+        """ offsets of the completely written IFDs after the last page read """
+        with open(self.filename, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            header = fh.read(16)
+            if len(header) < 8:
+                return []
+            if header[:2] not in (b"II", b"MM"):
+                raise ValueError("%s is not a tiff file" % self.filename)
+            byteorder = "<" if header[:2] == b"II" else ">"
+            version = struct.unpack(byteorder + "H", header[2:4])[0]
+            if version not in TIFF_IFD_FORMATS:
+                raise ValueError("%s is not a tiff file" % self.filename)
+            tagnoformat, tagnosize, tagsize, offsetformat, offsetsize, first = \
+                TIFF_IFD_FORMATS[version]
+
+            def next_ifd(offset):
+                # offset of the IFD after the IFD at offset (0 if none), None if the IFD
+                # at offset is not completely written
+                if offset + tagnosize > size:
+                    return None
+                fh.seek(offset)
+                tagno = struct.unpack(byteorder + tagnoformat, fh.read(tagnosize))[0]
+                end = offset + tagnosize + tagno * tagsize
+                if end + offsetsize > size:
+                    return None
+                fh.seek(end)
+                return struct.unpack(byteorder + offsetformat, fh.read(offsetsize))[0]
+
+            if self._ifd is None:
+                if len(header) < first + offsetsize:
+                    return []
+                offset = struct.unpack(byteorder + offsetformat,
+                                       header[first:first + offsetsize])[0]
+            else:
+                offset = next_ifd(self._ifd)
+            offsets = []
+            while offset:
+                following = next_ifd(offset)
+                if following is None:
+                    break
+                offsets.append(offset)
+                offset = following
+        return offsets
+
+    def _read_tiff(self) -> np.ndarray:
+        frames = []
+        offsets = self._new_ifds()
+        if len(offsets) > 0:
+            with TiffFile(self.filename) as tif:
+                fh = tif.filehandle
+                for offset in offsets:
+                    fh.seek(offset)
+                    page = TiffPage(tif, index=self.nread + len(frames))
+                    if max([o + n for o, n in zip(page.dataoffsets, page.databytecounts)],
+                           default=0) > fh.size:
+                        # the image data of the last page is still being written
+                        break
+                    frames.append(page.asarray().reshape(self.Ly, self.Lx))
+                    self._ifd = offset
+        return (np.stack(frames)
+                if len(frames) > 0 else np.zeros((0, self.Ly, self.Lx), np.int16))
@@ -1,6 +1,7 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+import hashlib
 import time
 from os import path
 from typing import Dict, Any
@@ -13,6 +14,18 @@ from .. import io, default_ops
 from . import bidiphase as bidi
 from . import utils, rigid, nonrigid
 
+# ops that change the registration offsets, part of the registration cache key
+REGISTRATION_CACHE_OPS = ("nimg_init", "batch_size", "maxregshift", "align_by_chan",
+                          "functional_chan", "subpixel", "rigid_subpixel",
+                          "smooth_sigma_time",
+                          "smooth_sigma", "th_badframes", "norm_frames", "pad_fft",
+                          "nonrigid", "block_size", "snr_thresh", "maxregshiftNR",
+                          "1Preg", "spatial_hp_reg", "pre_smooth", "spatial_taper",
+                          "do_bidiphase", "bidiphase", "bidi_corrected", "bidi_subpixel",
+                          "bidi_per_batch", "bilinear_reg", "frames_include")
+# number of keys kept in the registration cache (in place registrations use two keys)
+CACHE_ENTRIES = 8
+
 
 def compute_crop(xoff: int, yoff: int, corrXY, th_badframes, badframes, maxregshift,
                  Ly: int, Lx: int):
@@ -110,6 +123,14 @@ def compute_reference(frames, ops=default_ops()):
 
     picks initial reference then iteratively aligns frames to create reference
 
+    The frames are not shifted between iterations: the fft of the tapered frames is
+    computed once, and each iteration finds the shifts of the original frames to the
+    current reference image (the mask offset of the reference image is added in the fft
+    domain, see rigid.phasecorr_multi). The reference image is the mean of the best
+    correlated frames shifted by these shifts. If the shifts of all frames change by the
+    same amount (the re-centering of the reference image) in an iteration, the shifts have
+    converged and the reference image is computed from the frames of the last iteration.
+
     Parameters
     ----------
     
@@ -134,34 +155,51 @@ def compute_reference(frames, ops=default_ops()):
         refImg = utils.spatial_high_pass(refImg, int(ops["spatial_hp_reg"]))
         frames = utils.spatial_high_pass(frames, int(ops["spatial_hp_reg"]))
 
+    nimg, Ly, Lx = frames.shape
+    min_dim = min(Ly, Lx)  # maximum registration shift allowed
+    lcorr = int(np.minimum(np.round(ops["maxregshift"] * min_dim), min_dim // 2))
+    size = (utils.next_fast_len(Ly), utils.next_fast_len(Lx)) if ops["pad_fft"] else (Ly,
+                                                                                     Lx)
+    # taper mask does not depend on the reference image, the offset is its mean
+    maskMul, _ = rigid.compute_masks(
+        refImg=refImg,
+        maskSlope=ops["spatial_taper"] if ops["1Preg"] else 3 * ops["smooth_sigma"],
+    )
+    frames_fft = utils.fft2(rigid.apply_masks(frames, maskMul, np.zeros_like(maskMul)),
+                            size)
+    offset_fft = utils.fft2((1. - maskMul).astype("complex64"), size)
+
     niter = 8
+    ymax_prev, xmax_prev = None, None
     for iter in range(0, niter):
-        # rigid registration
-        ymax, xmax, cmax = rigid.phasecorr(
-            data=rigid.apply_masks(
-                frames,
-                *rigid.compute_masks(
-                    refImg=refImg,
-                    maskSlope=ops["spatial_taper"] if ops["1Preg"] else 3 *
-                    ops["smooth_sigma"],
-                )),
-            cfRefImg=rigid.phasecorr_reference(
+        # rigid registration of the frames to the current reference image
+        data_fft = np.add(frames_fft, np.float32(refImg.mean()) * offset_fft,
+                          out=utils.fft_workspace(frames_fft.shape, slot=2).numpy())
+        cc = utils.convolve_fft(
+            data_fft,
+            rigid.phasecorr_reference(
                 refImg=refImg,
                 smooth_sigma=ops["smooth_sigma"],
-            ),
-            maxregshift=ops["maxregshift"],
-            smooth_sigma_time=ops["smooth_sigma_time"],
-        )
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
-
-        nmax = max(2, int(frames.shape[0] * (1. + iter) / (2 * niter)))
+                pad_fft=ops["pad_fft"],
+            ))
+        ymax, xmax, cmax = rigid.phasecorr_peak(cc, lcorr, ops["smooth_sigma_time"])
+
+        converged = (ymax_prev is not None and np.ptp(ymax - ymax_prev) == 0 and
+                     np.ptp(xmax - xmax_prev) == 0)
+        ymax_prev, xmax_prev = ymax, xmax
+        nmax = max(2, int(nimg * (1. + (niter - 1 if converged else iter)) / (2 * niter)))
         isort = np.argsort(-cmax)[1:nmax]
-        # reset reference image
-        refImg = frames[isort].mean(axis=0).astype(np.int16)
+        # reset reference image, in pixel space: its spectrum (phasecorr_reference above)
+        # is a single FFT, while updating it from the frame spectra would need the
+        # untapered frame FFTs in memory and a phase ramp per selected frame, which is
+        # slower than shifting the frames (integer shifts, int16 reference)
+        refImg = rigid.shift_frames(frames[isort], ymax[isort],
+                                    xmax[isort]).mean(axis=0).astype(np.int16)
         # shift reference image to position of mean shifts
         refImg = rigid.shift_frame(frame=refImg, dy=int(np.round(-ymax[isort].mean())),
                                    dx=int(np.round(-xmax[isort].mean())))
+        if converged:
+            break
 
     return refImg
 
@@ -182,6 +220,7 @@ def compute_reference_masks(refImg, ops=default_ops()):
         cfRefImg = rigid.phasecorr_reference(
             refImg=refImg,
             smooth_sigma=ops["smooth_sigma"],
+            pad_fft=ops["pad_fft"],
         )
         Ly, Lx = refImg.shape
         blocks = []
@@ -195,6 +234,7 @@ def compute_reference_masks(refImg, ops=default_ops()):
                 smooth_sigma=ops["smooth_sigma"],
                 yblock=blocks[0],
                 xblock=blocks[1],
+                pad_fft=ops["pad_fft"],
             )
         else:
             maskMulNR, maskOffsetNR, cfRefImgNR = [], [], []
@@ -202,6 +242,116 @@ def compute_reference_masks(refImg, ops=default_ops()):
         return maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR, blocks
 
 
+def preprocess_frames(frames, ops=default_ops()):
+    """ returns frames smoothed in time and/or filtered for 1P recordings, to compute the
+    registration shifts (frames are returned as they are if no preprocessing is needed) """
+    # if smoothing or filtering or clipping to compute registration shifts, make a copy of the frames
+    dtype = "float32" if ops["smooth_sigma_time"] > 0 or ops["1Preg"] else frames.dtype
+    fsmooth = frames.copy().astype(
+        dtype) if ops["smooth_sigma_time"] > 0 or ops["1Preg"] else frames
+
+    if ops["smooth_sigma_time"]:
+        fsmooth = utils.temporal_smooth(data=fsmooth, sigma=ops["smooth_sigma_time"])
+    else:
+        fsmooth = frames
+
+    # preprocessing for 1P recordings
+    if ops["1Preg"]:
+        if ops["pre_smooth"]:
+            fsmooth = utils.spatial_smooth(fsmooth, int(ops["pre_smooth"]))
+        fsmooth = utils.spatial_high_pass(fsmooth, int(ops["spatial_hp_reg"]))
+    return fsmooth
+
+
+def register_frames_multi(refAndMasks, frames, rmin, rmax, bidiphase=0,
+                          ops=default_ops()):
+    """ register frames to the best of several reference images (e.g. planes of a z-stack)
+
+    The frames are correlated with all reference images at once (see rigid.phasecorr_multi),
+    and nonrigid registration is run once for each group of frames with the same best
+    reference image.
+
+    Parameters
+    ----------
+
+    refAndMasks : list of nZ processed reference images and masks (see compute_reference_masks)
+
+    frames : np.ndarray, np.int16 or np.float32
+        time x Ly x Lx
+
+    rmin : list of nZ, clip frames at rmin[z] for reference image z
+
+    rmax : list of nZ, clip frames at rmax[z] for reference image z
+
+    Returns
+    --------
+
+    frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 : see register_frames
+
+    (zpos, cmax_all) : best reference image of each frame, and phase correlation of each
+        frame with all reference images (time x nZ)
+
+    """
+    if bidiphase != 0:
+        bidi.shift(frames, bidiphase)
+
+    fsmooth = preprocess_frames(frames, ops)
+
+    # rigid registration to all reference images
+    ymax_all, xmax_all, cmax_all = rigid.phasecorr_multi(
+        data=fsmooth,
+        maskMul=[ref[0] for ref in refAndMasks],
+        maskOffset=[ref[1] for ref in refAndMasks],
+        cfRefImg=[ref[2] for ref in refAndMasks],
+        maxregshift=ops["maxregshift"],
+        smooth_sigma_time=ops["smooth_sigma_time"],
+        rmin=rmin,
+        rmax=rmax,
+        subpixel=ops["subpixel"] if ops.get("rigid_subpixel", False) else 1,
+    )
+    zpos = np.argmax(cmax_all, axis=0)
+    t = np.arange(len(frames))
+    ymax, xmax, cmax = ymax_all[zpos, t], xmax_all[zpos, t], cmax_all[zpos, t]
+
+    # non-rigid registration, grouped by reference image
+    if ops["nonrigid"]:
+        fsmooth = rigid.shift_frames(fsmooth, ymax, xmax)
+        nb = len(refAndMasks[0][-1][0])
+        ymax1, xmax1, cmax1 = (np.zeros((len(frames), nb), np.float32) for _ in range(3))
+        frames_reg = np.zeros(frames.shape, np.float32)
+        for z in np.unique(zpos):
+            iz = zpos == z
+            maskMulNR, maskOffsetNR, cfRefImgNR, blocks = refAndMasks[z][3:]
+            ymax1[iz], xmax1[iz], cmax1[iz] = nonrigid.phasecorr(
+                data=np.clip(fsmooth[iz], rmin[z], rmax[z])
+                if rmin[z] > -np.inf else fsmooth[iz],
+                maskMul=maskMulNR.squeeze(),
+                maskOffset=maskOffsetNR.squeeze(),
+                cfRefImg=cfRefImgNR.squeeze(),
+                snr_thresh=ops["snr_thresh"],
+                NRsm=blocks[-1],
+                xblock=blocks[1],
+                yblock=blocks[0],
+                maxregshiftNR=ops["maxregshiftNR"],
+            )
+            frames_reg[iz] = nonrigid.transform_data(
+                data=frames[iz],
+                yblock=blocks[0],
+                xblock=blocks[1],
+                nblocks=blocks[2],
+                ymax1=ymax1[iz],
+                xmax1=xmax1[iz],
+                ymax=ymax[iz],
+                xmax=xmax[iz],
+            )
+        frames = frames_reg
+    else:
+        frames = rigid.shift_frames(frames, ymax, xmax)
+        ymax1, xmax1, cmax1 = None, None, None
+
+    return frames, ymax, xmax, cmax, ymax1, xmax1, cmax1, (zpos, cmax_all.T)
+
+
 def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
                     ops=default_ops(), nZ=1):
     """ register frames to reference image 
@@ -228,44 +378,8 @@ def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
 
     """
     if nZ > 1:
-        cmax_best = -np.inf * np.ones(len(frames), "float32")
-        cmax_all = -np.inf * np.ones((len(frames), nZ), "float32")
-        zpos_best = np.zeros(len(frames), "int")
-        run_nonrigid = ops["nonrigid"]
-        for z in range(nZ):
-            ops["nonrigid"] = False
-            outputs = register_frames(refAndMasks[z], frames.copy(), rmin=rmin[z],
-                                      rmax=rmax[z], bidiphase=bidiphase, ops=ops, nZ=1)
-            cmax_all[:, z] = outputs[3]
-            if z == 0:
-                outputs_best = list(outputs[:-4]).copy()
-            ibest = cmax_best < cmax_all[:, z]
-            zpos_best[ibest] = z
-            cmax_best[ibest] = cmax_all[ibest, z]
-            for i, (output_best, output) in enumerate(zip(outputs_best, outputs[:-4])):
-                output_best[ibest] = output[ibest]
-        if run_nonrigid:
-            ops["nonrigid"] = True
-            nfr = frames.shape[0]
-            for i, z in enumerate(zpos_best):
-                outputs = register_frames(refAndMasks[z], frames[[i]], rmin=rmin[z],
-                                          rmax=rmax[z], bidiphase=bidiphase, ops=ops,
-                                          nZ=1)
-                if i == 0:
-                    outputs_best = []
-                    for output in outputs[:-1]:
-                        outputs_best.append(
-                            np.zeros((nfr, *output.shape[1:]), dtype=output.dtype))
-                        outputs_best[-1][0] = output[0]
-                else:
-                    for output, output_best in zip(outputs[:-1], outputs_best):
-                        output_best[i] = output[0]
-        if len(outputs_best)==7:
-            frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = outputs_best
-        else:
-            frames, ymax, xmax, cmax = outputs_best
-            ymax1, xmax1, cmax1 = None, None, None
-        return frames, ymax, xmax, cmax, ymax1, xmax1, cmax1, (zpos_best, cmax_all)
+        return register_frames_multi(refAndMasks, frames, rmin=rmin, rmax=rmax,
+                                     bidiphase=bidiphase, ops=ops)
     else:
         if len(refAndMasks) == 7 or not isinstance(refAndMasks, np.ndarray):
             maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR, blocks = refAndMasks
@@ -281,23 +395,7 @@ def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
         if bidiphase != 0:
             bidi.shift(frames, bidiphase)
 
-        # if smoothing or filtering or clipping to compute registration shifts, make a copy of the frames
-        dtype = "float32" if ops["smooth_sigma_time"] > 0 or ops[
-            "1Preg"] else frames.dtype
-        fsmooth = frames.copy().astype(
-            dtype) if ops["smooth_sigma_time"] > 0 or ops["1Preg"] else frames
-
-        if ops["smooth_sigma_time"]:
-            fsmooth = utils.temporal_smooth(data=fsmooth,
-                                            sigma=ops["smooth_sigma_time"])
-        else:
-            fsmooth = frames
-
-        # preprocessing for 1P recordings
-        if ops["1Preg"]:
-            if ops["pre_smooth"]:
-                fsmooth = utils.spatial_smooth(fsmooth, int(ops["pre_smooth"]))
-            fsmooth = utils.spatial_high_pass(fsmooth, int(ops["spatial_hp_reg"]))
+        fsmooth = preprocess_frames(frames, ops)
 
         # rigid registration
         ymax, xmax, cmax = rigid.phasecorr(
@@ -307,17 +405,13 @@ def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
             cfRefImg=cfRefImg,
             maxregshift=ops["maxregshift"],
             smooth_sigma_time=ops["smooth_sigma_time"],
+            subpixel=ops["subpixel"] if ops.get("rigid_subpixel", False) else 1,
         )
-        
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
 
         # non-rigid registration
         if ops["nonrigid"]:
             # need to also shift smoothed/filtered data
-            if ops["smooth_sigma_time"] or ops["1Preg"]:
-                for fsm, dy, dx in zip(fsmooth, ymax, xmax):
-                    fsm[:] = rigid.shift_frame(frame=fsm, dy=dy, dx=dx)
+            fsmooth = rigid.shift_frames(fsmooth, ymax, xmax)
 
             ymax1, xmax1, cmax1 = nonrigid.phasecorr(
                 data=np.clip(fsmooth, rmin, rmax) if rmin > -np.inf else fsmooth,
@@ -331,6 +425,7 @@ def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
                 maxregshiftNR=ops["maxregshiftNR"],
             )
 
+            # rigid and nonrigid shifts are applied in one pass
             frames = nonrigid.transform_data(
                 data=frames,
                 yblock=blocks[0],
@@ -338,24 +433,30 @@ def register_frames(refAndMasks, frames, rmin=-np.inf, rmax=np.inf, bidiphase=0,
                 nblocks=blocks[2],
                 ymax1=ymax1,
                 xmax1=xmax1,
+                ymax=ymax,
+                xmax=xmax,
             )
         else:
+            frames = rigid.shift_frames(frames, ymax, xmax)
             ymax1, xmax1, cmax1 = None, None, None
 
         return frames, ymax, xmax, cmax, ymax1, xmax1, cmax1, None
 
 
-def shift_frames(frames, yoff, xoff, yoff1, xoff1, blocks=None, ops=default_ops()):
-    if ops["bidiphase"] != 0 and not ops["bidi_corrected"]:
-        bidi.shift(frames, int(ops["bidiphase"]))
-
-    for frame, dy, dx in zip(frames, yoff, xoff):
-        frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+def shift_frames(frames, yoff, xoff, yoff1, xoff1, blocks=None, ops=default_ops(),
+                 bidiphase=None):
+    if bidiphase is None:
+        bidiphase = ops["bidiphase"] if not ops["bidi_corrected"] else 0
+    if np.any(bidiphase != 0):
+        bidi.shift(frames, bidiphase)
 
     if ops["nonrigid"]:
         frames = nonrigid.transform_data(frames, yblock=blocks[0], xblock=blocks[1],
                                          nblocks=blocks[2], ymax1=yoff1, xmax1=xoff1,
-                                         bilinear=ops.get("bilinear_reg", True))
+                                         bilinear=ops.get("bilinear_reg", True),
+                                         ymax=yoff, xmax=xoff)
+    else:
+        frames = rigid.shift_frames(frames, yoff, xoff)
     return frames
 
 
@@ -388,8 +489,14 @@ def compute_reference_and_register_frames(f_align_in, f_align_out=None, refImg=N
     """
 
     n_frames, Ly, Lx = f_align_in.shape
+    utils.set_fft_backend(ops.get("fft_backend", ""), ops.get("fft_threads", 0),
+                          shape=utils.fft_shape(Ly, Lx, ops["pad_fft"]))
 
     batch_size = ops["batch_size"]
+    bidi_subpixel = ops["subpixel"] if ops.get("bidi_subpixel", False) else 1
+    # bidiphase offset estimated on each batch, to follow drifts of the scanner
+    bidi_per_batch = (ops.get("bidi_per_batch", False) and ops["do_bidiphase"] and
+                      not ops["bidi_corrected"])
     ### ----- compute reference image and bidiphase shift -------------- ###
     if refImg is None:
         # grab frames
@@ -398,12 +505,12 @@ def compute_reference_and_register_frames(f_align_in, f_align_out=None, refImg=N
                                         dtype=int)[:-1]]
         # compute bidiphase shift
         if ops["do_bidiphase"] and ops["bidiphase"] == 0 and not ops["bidi_corrected"]:
-            bidiphase = bidi.compute(frames)
-            print("NOTE: estimated bidiphase offset from data: %d pixels" % bidiphase)
+            bidiphase = bidi.compute(frames, subpixel=bidi_subpixel)
+            print("NOTE: estimated bidiphase offset from data: %g pixels" % bidiphase)
             ops["bidiphase"] = bidiphase
             # shift frames
             if bidiphase != 0:
-                bidi.shift(frames, int(ops["bidiphase"]))
+                bidi.shift(frames, ops["bidiphase"])
         else:
             bidiphase = 0
 
@@ -430,7 +537,7 @@ def compute_reference_and_register_frames(f_align_in, f_align_out=None, refImg=N
             rmax = np.inf * np.ones(nZ)
 
     if ops["bidiphase"] and not ops["bidi_corrected"]:
-        bidiphase = int(ops["bidiphase"])
+        bidiphase = ops["bidiphase"]
     else:
         bidiphase = 0
 
@@ -439,53 +546,67 @@ def compute_reference_and_register_frames(f_align_in, f_align_out=None, refImg=N
 
     mean_img = np.zeros((Ly, Lx), "float32")
     rigid_offsets, nonrigid_offsets, zpos, cmax_all = [], [], [], []
+    bidiphase_frames = []
 
     if ops["frames_include"] != -1:
         n_frames = min(n_frames, ops["frames_include"])
 
     t0 = time.time()
 
-    for k in np.arange(0, n_frames, batch_size):
-        frames = f_align_in[k:min(k + batch_size, n_frames)]
-        frames, ymax, xmax, cmax, ymax1, xmax1, cmax1, zest = register_frames(
-            refAndMasks, frames, rmin=rmin, rmax=rmax, bidiphase=bidiphase, ops=ops,
-            nZ=nZ)
-        rigid_offsets.append([ymax, xmax, cmax])
-        if zest is not None:
-            zpos.extend(list(zest[0]))
-            cmax_all.extend(list(zest[1]))
-        if ops["nonrigid"]:
-            nonrigid_offsets.append([ymax1, xmax1, cmax1])
-
-        mean_img += frames.sum(axis=0) / n_frames
-
-        if f_align_out is None:
-            f_align_in[k:min(k + batch_size, n_frames)] = frames
-        else:
-            f_align_out[k:min(k + batch_size, n_frames)] = frames
-
-        if (ops["reg_tif"] if ops["functional_chan"] == ops["align_by_chan"] else
-                ops["reg_tif_chan2"]):
-            fname = io.generate_tiff_filename(functional_chan=ops["functional_chan"],
-                                              align_by_chan=ops["align_by_chan"],
-                                              save_path=ops["save_path"], k=k,
-                                              ichan=True)
-            io.save_tiff(mov=frames, fname=fname)
-
-        print("Registered %d/%d in %0.2fs" %
-              (k + frames.shape[0], n_frames, time.time() - t0))
+    f_out = f_align_in if f_align_out is None else f_align_out
+    with io.write_behind(f_out, max_pending=ops.get("write_behind_batches", 2)):
+        for k, frames in io.iter_batches(f_align_in, batch_size, n_frames=n_frames,
+                                         prefetch=ops.get("prefetch_batches", 1)):
+            if bidi_per_batch:
+                bidiphase = bidi.compute(frames, subpixel=bidi_subpixel)
+                bidiphase_frames.append(np.full(len(frames), bidiphase, np.float32))
+            frames, ymax, xmax, cmax, ymax1, xmax1, cmax1, zest = register_frames(
+                refAndMasks, frames, rmin=rmin, rmax=rmax, bidiphase=bidiphase, ops=ops,
+                nZ=nZ)
+            rigid_offsets.append([ymax, xmax, cmax])
+            if zest is not None:
+                zpos.extend(list(zest[0]))
+                cmax_all.extend(list(zest[1]))
+            if ops["nonrigid"]:
+                nonrigid_offsets.append([ymax1, xmax1, cmax1])
+
+            mean_img += frames.sum(axis=0) / n_frames
+
+            if f_align_out is None:
+                f_align_in[k:min(k + batch_size, n_frames)] = frames
+            else:
+                f_align_out[k:min(k + batch_size, n_frames)] = frames
+
+            if (ops["reg_tif"] if ops["functional_chan"] == ops["align_by_chan"] else
+                    ops["reg_tif_chan2"]):
+                fname = io.generate_tiff_filename(functional_chan=ops["functional_chan"],
+                                                  align_by_chan=ops["align_by_chan"],
+                                                  save_path=ops["save_path"], k=k,
+                                                  ichan=True)
+                io.save_tiff(mov=frames, fname=fname)
+
+            print("Registered %d/%d in %0.2fs" %
+                  (k + frames.shape[0], n_frames, time.time() - t0))
     rigid_offsets = utils.combine_offsets_across_batches(rigid_offsets, rigid=True)
     if ops["nonrigid"]:
         nonrigid_offsets = utils.combine_offsets_across_batches(
             nonrigid_offsets, rigid=False)
+    if bidi_per_batch:
+        ops["bidiphase_frames"] = np.concatenate(bidiphase_frames)
+    else:
+        ops.pop("bidiphase_frames", None)
 
     return refImg_orig, rmin, rmax, mean_img, rigid_offsets, nonrigid_offsets, (
         zpos, cmax_all)
 
 
 def shift_frames_and_write(f_alt_in, f_alt_out=None, yoff=None, xoff=None, yoff1=None,
-                           xoff1=None, ops=default_ops()):
-    """ shift frames for alternate channel in f_alt_in and write to f_alt_out if not None (else write to f_alt_in) """
+                           xoff1=None, ops=default_ops(), bidiphase=None):
+    """ shift frames for alternate channel in f_alt_in and write to f_alt_out if not None (else write to f_alt_in)
+
+    bidiphase (offset, or array of offsets per frame) is applied instead of
+    ops["bidiphase"] / ops["bidiphase_frames"] if not None
+    """
     n_frames, Ly, Lx = f_alt_in.shape
     if yoff is None or xoff is None:
         raise ValueError("no rigid registration offsets provided")
@@ -509,37 +630,116 @@ def shift_frames_and_write(f_alt_in, f_alt_out=None, yoff=None, xoff=None, yoff1
 
     mean_img = np.zeros((Ly, Lx), "float32")
     batch_size = ops["batch_size"]
+    # bidiphase offsets estimated on each batch (see compute_reference_and_register_frames)
+    if ops["bidi_corrected"]:
+        bidiphase = 0
+    elif bidiphase is None:
+        bidiphase = ops["bidiphase"] if ops.get(
+            "bidiphase_frames") is None else ops["bidiphase_frames"]
     t0 = time.time()
-    for k in np.arange(0, n_frames, batch_size):
-        frames = f_alt_in[k:min(k + batch_size, n_frames)].astype("float32")
-        yoffk = yoff[k:min(k + batch_size, n_frames)].astype(int)
-        xoffk = xoff[k:min(k + batch_size, n_frames)].astype(int)
-        if ops.get("nonrigid"):
-            yoff1k = yoff1[k:min(k + batch_size, n_frames)]
-            xoff1k = xoff1[k:min(k + batch_size, n_frames)]
-        else:
-            yoff1k, xoff1k = None, None
+    f_out = f_alt_in if f_alt_out is None else f_alt_out
+    with io.write_behind(f_out, max_pending=ops.get("write_behind_batches", 2)):
+        for k, frames in io.iter_batches(f_alt_in, batch_size, n_frames=n_frames,
+                                         prefetch=ops.get("prefetch_batches", 1)):
+            frames = frames.astype("float32")
+            yoffk = yoff[k:min(k + batch_size, n_frames)]
+            xoffk = xoff[k:min(k + batch_size, n_frames)]
+            if ops.get("nonrigid"):
+                yoff1k = yoff1[k:min(k + batch_size, n_frames)]
+                xoff1k = xoff1[k:min(k + batch_size, n_frames)]
+            else:
+                yoff1k, xoff1k = None, None
+
+            bidik = bidiphase[k:min(k + batch_size, n_frames)] if np.ndim(
+                bidiphase) > 0 else bidiphase
+            frames = shift_frames(frames, yoffk, xoffk, yoff1k, xoff1k, blocks, ops,
+                                  bidiphase=bidik)
+            mean_img += frames.sum(axis=0) / n_frames
+
+            if f_alt_out is None:
+                f_alt_in[k:min(k + batch_size, n_frames)] = frames
+            else:
+                f_alt_out[k:min(k + batch_size, n_frames)] = frames
+
+            if (ops["reg_tif_chan2"]
+                    if ops["functional_chan"] == ops["align_by_chan"] else ops["reg_tif"]):
+                fname = io.generate_tiff_filename(functional_chan=ops["functional_chan"],
+                                                  align_by_chan=ops["align_by_chan"],
+                                                  save_path=ops["save_path"], k=k,
+                                                  ichan=False)
+                io.save_tiff(mov=frames, fname=fname)
+
+            print("Second channel, Registered %d/%d in %0.2fs" %
+                  (k + frames.shape[0], n_frames, time.time() - t0))
 
-        frames = shift_frames(frames, yoffk, xoffk, yoff1k, xoff1k, blocks, ops)
-        mean_img += frames.sum(axis=0) / n_frames
+    return mean_img
 
-        if f_alt_out is None:
-            f_alt_in[k:min(k + batch_size, n_frames)] = frames
-        else:
-            f_alt_out[k:min(k + batch_size, n_frames)] = frames
 
-        if (ops["reg_tif_chan2"]
-                if ops["functional_chan"] == ops["align_by_chan"] else ops["reg_tif"]):
-            fname = io.generate_tiff_filename(functional_chan=ops["functional_chan"],
-                                              align_by_chan=ops["align_by_chan"],
-                                              save_path=ops["save_path"], k=k,
-                                              ichan=False)
-            io.save_tiff(mov=frames, fname=fname)
+def registration_settings_hash(refImg=None, ops=default_ops()):
+    """ hash of the registration settings in REGISTRATION_CACHE_OPS, of the initial
+    reference image and of the bad_frames.npy file """
+    h = hashlib.sha1()
+    for key in REGISTRATION_CACHE_OPS:
+        h.update(("%s=%r;" % (key, np.asarray(ops.get(key)).tolist())).encode())
+    if refImg is not None:
+        for rimg in (refImg if isinstance(refImg, list) else [refImg]):
+            h.update(np.asarray(rimg, "float32").tobytes())
+    if "data_path" in ops and len(ops["data_path"]) > 0:
+        badfrfile = path.abspath(path.join(ops["data_path"][0], "bad_frames.npy"))
+        if path.isfile(badfrfile):
+            h.update(np.load(badfrfile).astype(int).tobytes())
+    return h.hexdigest()
 
-        print("Second channel, Registered %d/%d in %0.2fs" %
-              (k + frames.shape[0], n_frames, time.time() - t0))
 
-    return mean_img
+def registration_cache_key(settings, *fs):
+    """ key in the registration cache of the frames fs registered with settings (see
+    registration_settings_hash) """
+    return hashlib.sha1((settings + io.frames_hash(*fs)).encode()).hexdigest()
+
+
+def load_registration_cache(cache_file):
+    """ returns the registration cache saved in cache_file (empty if it does not exist) """
+    if cache_file is None or not path.isfile(cache_file):
+        return {}
+    try:
+        return np.load(cache_file, allow_pickle=True).item()
+    except (OSError, ValueError, EOFError):
+        warn("could not read registration cache %s, ignoring it" % cache_file)
+        return {}
+
+
+def save_registration_cache(cache_file, cache):
+    """ saves the last CACHE_ENTRIES keys of the registration cache to cache_file """
+    np.save(cache_file, dict(list(cache.items())[-CACHE_ENTRIES:]))
+
+
+def registration_from_cache(entry, f_align_in, f_align_out=None, f_alt_in=None,
+                            f_alt_out=None, ops=default_ops()):
+    """ applies the cached registration entry to the frames and returns its outputs, with
+    the cached bidiphase offset and bidiphase offsets per frame (None if not estimated per
+    batch), which are not written to ops
+
+    the shifts are only applied if the output frames are not already the registered frames
+    (e.g. when the frames were registered in place)
+    """
+    outputs = entry["outputs"]
+    bidiphase, bidiphase_frames = entry["bidiphase"], entry.get("bidiphase_frames")
+    f_out = f_align_in if f_align_out is None else f_align_out
+    f_alt = f_alt_in if f_alt_out is None else f_alt_out
+    if io.frames_hash(f_out, f_alt) == entry["registered"]:
+        print("NOTE: frames already registered with cached offsets")
+        return outputs, bidiphase, bidiphase_frames
+    print("NOTE: applying cached registration offsets")
+    rigid_offsets, nonrigid_offsets = outputs[4], outputs[5]
+    yoff, xoff = rigid_offsets[:2]
+    yoff1, xoff1 = nonrigid_offsets[:2] if ops["nonrigid"] else (None, None)
+    bidik = bidiphase if bidiphase_frames is None else bidiphase_frames
+    shift_frames_and_write(f_align_in, f_align_out, yoff, xoff, yoff1, xoff1, ops,
+                           bidiphase=bidik)
+    if f_alt_in is not None:
+        shift_frames_and_write(f_alt_in, f_alt_out, yoff, xoff, yoff1, xoff1, ops,
+                               bidiphase=bidik)
+    return outputs, bidiphase, bidiphase_frames
 
 
 def registration_wrapper(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
@@ -638,6 +838,28 @@ def registration_wrapper(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
         print("registering two channels")
     else:
         nchannels = 1
+        f_alt_in, f_alt_out = None, None
+
+    # reuse the offsets of a previous registration of the same frames with the same settings
+    cache_file = path.join(ops["save_path"], "reg_cache.npy") if ops.get(
+        "reg_cache", False) and ops.get("save_path") else None
+    if cache_file is not None:
+        settings = registration_settings_hash(refImg, ops)
+        cache_key = registration_cache_key(settings, f_align_in, f_alt_in)
+        cache = load_registration_cache(cache_file)
+        if cache_key in cache:
+            entry = cache[cache_key]
+            outputs, ops["bidiphase"], bidiphase_frames = registration_from_cache(
+                entry, f_align_in, f_align_out, f_alt_in, f_alt_out, ops)
+            if bidiphase_frames is not None:
+                ops["bidiphase_frames"] = bidiphase_frames
+            else:
+                ops.pop("bidiphase_frames", None)
+            if f_align_out is None:
+                # frames registered in place are found by the key of the registered frames
+                cache[registration_cache_key(settings, f_align_in, f_alt_in)] = entry
+                save_registration_cache(cache_file, cache)
+            return outputs
 
     outputs = compute_reference_and_register_frames(f_align_in, f_align_out=f_align_out,
                                                     refImg=refImg, ops=ops)
@@ -690,7 +912,22 @@ def registration_wrapper(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
         Lx=Lx,
     )
 
-    return refImg, rmin, rmax, meanImg, rigid_offsets, nonrigid_offsets, zest, meanImg_chan2, badframes, yrange, xrange
+    outputs = refImg, rmin, rmax, meanImg, rigid_offsets, nonrigid_offsets, zest, meanImg_chan2, badframes, yrange, xrange
+    if cache_file is not None:
+        f_out = f_align_in if f_align_out is None else f_align_out
+        f_alt = f_alt_in if f_alt_out is None else f_alt_out
+        entry = {
+            "outputs": outputs,
+            "bidiphase": ops["bidiphase"],
+            "bidiphase_frames": ops.get("bidiphase_frames"),
+            "registered": io.frames_hash(f_out, f_alt),
+        }
+        cache.pop(cache_key, None)
+        cache[cache_key] = entry
+        if f_align_out is None:
+            cache[registration_cache_key(settings, f_out, f_alt)] = entry
+        save_registration_cache(cache_file, cache)
+    return outputs
 
 
 def save_registration_outputs_to_ops(registration_outputs, ops):
@@ -4,8 +4,10 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 from typing import Tuple
 
 import numpy as np
+from numba import njit, prange
 
-from .utils import convolve, complex_fft2, spatial_taper, addmultiply, gaussian_fft, temporal_smooth
+from .utils import (convolve, convolve_fft, complex_fft2, fft2, fft_workspace, spatial_taper,
+                    addmultiply, gaussian_fft, temporal_smooth, mat_upsample, cc_window)
 
 import torch
 
@@ -49,7 +51,8 @@ def apply_masks(data: np.ndarray, maskMul: np.ndarray,
     return addmultiply(data, maskMul, maskOffset)
 
 
-def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
+def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None,
+                        pad_fft: bool = False) -> np.ndarray:
     """
     Returns reference image fft"ed and complex conjugate and multiplied by gaussian filter in the fft domain,
     with standard deviation "smooth_sigma" computes fft"ed reference image for phasecorr.
@@ -58,18 +61,22 @@ def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
     ----------
     refImg : 2D array, int16
         reference image
+    pad_fft : bool (optional, default False)
+        whether to zero-pad the reference image to a fast FFT size, the frames are then
+        padded to the same size in phasecorr
 
     Returns
     -------
     cfRefImg : 2D array, complex64
     """
-    cfRefImg = complex_fft2(img=refImg)
+    cfRefImg = complex_fft2(img=refImg, pad_fft=pad_fft)
     cfRefImg /= (1e-5 + np.absolute(cfRefImg))
     cfRefImg *= gaussian_fft(smooth_sigma, cfRefImg.shape[0], cfRefImg.shape[1])
     return cfRefImg.astype("complex64")
 
 
-def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time) -> Tuple[int, int, float]:
+def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, subpixel: int = 1,
+              lpad: int = 3) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """ compute phase correlation between data and reference image
 
     Parameters
@@ -80,12 +87,17 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time) -> Tuple[int, int,
         maximum shift as a fraction of the minimum dimension of data (min(Ly,Lx) * maxregshift)
     smooth_sigma_time : float
         how many frames to smooth in time
+    subpixel : int (optional, default 1)
+        if > 1, shifts are estimated with a precision of 1 / subpixel by upsampling the
+        phase correlation around its peak (as in nonrigid registration)
+    lpad : int (optional, default 3)
+        upsample from a square +/- lpad around the peak
 
     Returns
     -------
-    ymax : int
+    ymax : int (float if subpixel > 1)
         shifts in y from cfRefImg to data for each frame
-    xmax : int
+    xmax : int (float if subpixel > 1)
         shifts in x from cfRefImg to data for each frame
     cmax : float
         maximum of phase correlation for each frame
@@ -93,21 +105,140 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time) -> Tuple[int, int,
     """
     min_dim = np.minimum(*data.shape[1:])  # maximum registration shift allowed
     lcorr = int(np.minimum(np.round(maxregshift * min_dim), min_dim // 2))
+    cc = convolve(data, cfRefImg)
+    return phasecorr_peak(cc, lcorr, smooth_sigma_time, subpixel=subpixel, lpad=lpad)
 
-    #cc = convolve(data, cfRefImg, lcorr)
-    data = convolve(data, cfRefImg)
-    cc = np.real(
-        np.block([[data[:, -lcorr:, -lcorr:], data[:, -lcorr:, :lcorr + 1]],
-                  [data[:, :lcorr + 1, -lcorr:], data[:, :lcorr + 1, :lcorr + 1]]]))
+
+def phasecorr_multi(data, maskMul, maskOffset, cfRefImg, maxregshift, smooth_sigma_time,
+                    rmin=None, rmax=None, subpixel: int = 1,
+                    lpad: int = 3) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ compute phase correlation between data and several reference images (e.g. the
+    planes of a z-stack)
+
+    If the frames are clipped to the same range and tapered with the same maskMul for
+    all reference images, they are fft"ed once and the maskOffset of each reference
+    image is added in the fft domain.
+
+    Parameters
+    ----------
+    data : int16 or float32, 3D array
+        array that"s frames x Ly x Lx, before clipping and masking
+    maskMul : list of nZ 2D arrays
+        taper masks of each reference image (see compute_masks)
+    maskOffset : list of nZ 2D arrays
+        mask offsets of each reference image (see compute_masks)
+    cfRefImg : list of nZ 2D arrays
+        fft"ed reference images (see phasecorr_reference)
+    maxregshift : float
+        maximum shift as a fraction of the minimum dimension of data (min(Ly,Lx) * maxregshift)
+    smooth_sigma_time : float
+        how many frames to smooth in time
+    rmin : list of nZ floats (optional, default None)
+        frames are clipped at rmin[z] for reference image z
+    rmax : list of nZ floats (optional, default None)
+        frames are clipped at rmax[z] for reference image z
+    subpixel : int (optional, default 1)
+        see phasecorr
+    lpad : int (optional, default 3)
+        see phasecorr
+
+    Returns
+    -------
+    ymax : nZ x nimg
+        shifts in y from each cfRefImg to data for each frame
+    xmax : nZ x nimg
+        shifts in x from each cfRefImg to data for each frame
+    cmax : nZ x nimg
+        maximum of phase correlation with each cfRefImg for each frame
+
+    """
+    nZ = len(cfRefImg)
+    rmin = np.full(nZ, -np.inf) if rmin is None else np.asarray(rmin)
+    rmax = np.full(nZ, np.inf) if rmax is None else np.asarray(rmax)
+    min_dim = np.minimum(*data.shape[1:])  # maximum registration shift allowed
+    lcorr = int(np.minimum(np.round(maxregshift * min_dim), min_dim // 2))
+    size = cfRefImg[0].shape[-2:]
+
+    shared = (np.all(rmin == rmin[0]) and np.all(rmax == rmax[0]) and
+              all(np.array_equal(mask, maskMul[0]) for mask in maskMul[1:]))
+    if shared:
+        data = np.clip(data, rmin[0], rmax[0]) if rmin[0] > -np.inf else data
+        data_fft = fft2(apply_masks(data, maskMul[0], np.zeros(data.shape[1:], "float32")),
+                        size)
+
+    ymax, xmax, cmax = [], [], []
+    for z in range(nZ):
+        if shared:
+            cc_fft = np.add(data_fft, fft2(maskOffset[z].astype("complex64"), size),
+                            out=fft_workspace(data_fft.shape, slot=2).numpy())
+        else:
+            cc_fft = fft2(
+                apply_masks(
+                    np.clip(data, rmin[z], rmax[z]) if rmin[z] > -np.inf else data,
+                    maskMul[z], maskOffset[z]), size)
+        cc = convolve_fft(cc_fft, cfRefImg[z])
+        ymax_z, xmax_z, cmax_z = phasecorr_peak(cc, lcorr, smooth_sigma_time,
+                                                subpixel=subpixel, lpad=lpad)
+        ymax.append(ymax_z)
+        xmax.append(xmax_z)
+        cmax.append(cmax_z)
+    return np.stack(ymax), np.stack(xmax), np.stack(cmax)
+
+
+def phasecorr_peak(cc, lcorr, smooth_sigma_time, subpixel: int = 1,
+                   lpad: int = 3) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ find the peaks of phase correlations within +/- lcorr of zero shift
+
+    Parameters
+    ----------
+    cc : nimg x Ly x Lx
+        circular phase correlations with zero shift at [0, 0]
+    lcorr : int
+        maximum shift
+    smooth_sigma_time : float
+        how many frames to smooth in time
+    subpixel : int (optional, default 1)
+        see phasecorr
+    lpad : int (optional, default 3)
+        see phasecorr
+
+    Returns
+    -------
+    ymax, xmax, cmax : see phasecorr
+    """
+    lpad = lpad if subpixel > 1 else 0
+
+    # phase correlation within +/- (lcorr + lpad) of zero shift
+    lhalf = lcorr + lpad
+    cc = cc_window(cc, lhalf)
 
     cc = temporal_smooth(cc, smooth_sigma_time) if smooth_sigma_time > 0 else cc
 
-    ymax, xmax = np.zeros(data.shape[0], np.int32), np.zeros(data.shape[0], np.int32)
-    for t in np.arange(data.shape[0]):
-        ymax[t], xmax[t] = np.unravel_index(np.argmax(cc[t], axis=None),
-                                            (2 * lcorr + 1, 2 * lcorr + 1))
-    cmax = cc[np.arange(len(cc)), ymax, xmax]
-    ymax, xmax = ymax - lcorr, xmax - lcorr
+    # peak within +/- lcorr for all frames at once
+    nimg = cc.shape[0]
+    lc = 2 * lcorr + 1
+    cc0 = cc[:, lpad:lpad + lc, lpad:lpad + lc].reshape(nimg, -1)
+    imax = np.argmax(cc0, axis=1)
+    cmax = cc0[np.arange(nimg), imax]
+    ymax, xmax = np.unravel_index(imax, (lc, lc))
+
+    if subpixel > 1:
+        # upsample the +/- lpad neighbourhood of each peak
+        Kmat, nup = mat_upsample(lpad=lpad, subpixel=subpixel)
+        dy, dx = np.meshgrid(np.arange(2 * lpad + 1), np.arange(2 * lpad + 1),
+                             indexing="ij")
+        t = np.arange(nimg)[:, np.newaxis, np.newaxis]
+        ccmat = cc[t, ymax[:, np.newaxis, np.newaxis] + dy,
+                   xmax[:, np.newaxis, np.newaxis] + dx]
+        ccb = ccmat.reshape(nimg, -1) @ Kmat
+        imax = np.argmax(ccb, axis=1)
+        cmax = ccb[np.arange(nimg), imax]
+        yup, xup = np.unravel_index(imax, (nup, nup))
+        mdpt = nup // 2
+        ymax = ((yup - mdpt) / subpixel + ymax - lcorr).astype(np.float32)
+        xmax = ((xup - mdpt) / subpixel + xmax - lcorr).astype(np.float32)
+    else:
+        ymax, xmax = (ymax - lcorr).astype(np.int32), (xmax - lcorr).astype(np.int32)
 
     return ymax, xmax, cmax.astype(np.float32)
 
@@ -131,3 +262,51 @@ def shift_frame(frame: np.ndarray, dy: int, dx: int) -> np.ndarray:
 
     """
     return np.roll(frame, (-dy, -dx), axis=(0, 1))
+
+
+@njit(parallel=True, cache=True)
+def _shift_frames(frames, ymax, xmax, out):
+    """ circularly shifts frames[t] by (ymax[t], xmax[t]) with bilinear interpolation """
+    nimg, Ly, Lx = frames.shape
+    for t in prange(nimg):
+        y0, x0 = np.floor(ymax[t]), np.floor(xmax[t])
+        fy, fx = ymax[t] - y0, xmax[t] - x0
+        iy, ix = int(y0), int(x0)
+        for y in range(Ly):
+            ya = (y + iy) % Ly
+            yb = (ya + 1) % Ly
+            for x in range(Lx):
+                xa = (x + ix) % Lx
+                xb = (xa + 1) % Lx
+                out[t, y, x] = ((1 - fy) * ((1 - fx) * frames[t, ya, xa] +
+                                            fx * frames[t, ya, xb]) + fy *
+                                ((1 - fx) * frames[t, yb, xa] + fx * frames[t, yb, xb]))
+
+
+def shift_frames(frames: np.ndarray, ymax: np.ndarray, xmax: np.ndarray) -> np.ndarray:
+    """
+    Returns frames, each shifted by its ymax and xmax in a single batched kernel
+
+    Integer shifts give the same frames as shift_frame (np.roll) in the same dtype,
+    sub-pixel shifts are applied with bilinear interpolation and return float32 frames.
+
+    Parameters
+    ----------
+    frames: nimg x Ly x Lx
+    ymax: nimg
+        vertical shift of each frame
+    xmax: nimg
+        horizontal shift of each frame
+
+    Returns
+    -------
+    frames_shifted: nimg x Ly x Lx
+        The shifted frames
+
+    """
+    ymax = np.asarray(ymax, np.float64).reshape(-1)
+    xmax = np.asarray(xmax, np.float64).reshape(-1)
+    integer = np.all(ymax == np.round(ymax)) and np.all(xmax == np.round(xmax))
+    out = np.empty(frames.shape, frames.dtype if integer else np.float32)
+    _shift_frames(np.ascontiguousarray(frames), ymax, xmax, out)
+    return out
@@ -1,92 +1,373 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+import os
+import threading
+import time
 import warnings
+from contextlib import contextmanager
 from functools import lru_cache
 from typing import Tuple
 
 import numpy as np
 from numba import vectorize, complex64
 from numpy.fft import ifftshift  #, fft2, ifft2
-from scipy.fft import next_fast_len  #, fft2, ifft2
+from scipy import fft as scipy_fft
+from scipy.fft import next_fast_len
 from scipy.ndimage import gaussian_filter1d
 import torch
 
+try:
+    # pytorch > 1.7
+    from torch.fft import fft as torch_fft
+    from torch.fft import fft2 as torch_fft2
+    from torch.fft import ifft as torch_ifft
+    from torch.fft import ifft2 as torch_ifft2
+except:
+    # pytorch <= 1.7
+    raise ImportError("pytorch version > 1.7 required")
+
 try:
     # use mkl_fft if installed
-    from mkl_fft import fft2, ifft2
-
-    def convolve(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
-        """
-        Returns the 3D array "mov" convolved by a 2D array "img".
-
-        Parameters
-        ----------
-        mov: nImg x Ly x Lx
-            The frames to process
-        img: 2D array
-            The convolution kernel
-
-        Returns
-        -------
-        convolved_data: nImg x Ly x Lx
-        """
-        return ifft2(apply_dotnorm(fft2(mov), img))  #.astype(np.complex64)
+    import mkl_fft
+    HAS_MKL_FFT = True
+except:
+    HAS_MKL_FFT = False
+
+try:
+    # sets the number of MKL threads used by mkl_fft
+    import mkl
+    HAS_MKL = True
 except:
+    HAS_MKL = False
+
+# environment variable selecting the FFT backend if it is not set in ops["fft_backend"]
+FFT_BACKEND_ENV = "SUITE2P_FFT_BACKEND"
+# number of frames FFT'ed by each backend in the micro-benchmark of set_fft_backend("auto")
+FFT_BENCHMARK_FRAMES = 16
+
+
+def _torch_fft2(data, size=None, out=None):
+    data = torch.from_numpy(data)
+    if out is None:
+        return torch_fft2(data, s=size, dim=(-2, -1)).numpy()
+    torch_fft2(data, s=size, dim=(-2, -1), out=torch.from_numpy(out))
+    return out
+
+
+def _torch_ifft2(data, size=None, out=None):
+    data = torch.from_numpy(data)
+    if out is None:
+        return torch_ifft2(data, s=size, dim=(-2, -1)).numpy()
+    torch_ifft2(data, s=size, dim=(-2, -1), out=torch.from_numpy(out))
+    return out
+
+
+def _torch_fft(data, size=None, out=None):
+    data = torch.from_numpy(data)
+    if out is None:
+        return torch_fft(data, n=size, dim=-1).numpy()
+    torch_fft(data, n=size, dim=-1, out=torch.from_numpy(out))
+    return out
+
+
+def _torch_ifft(data, size=None, out=None):
+    data = torch.from_numpy(data)
+    if out is None:
+        return torch_ifft(data, n=size, dim=-1).numpy()
+    torch_ifft(data, n=size, dim=-1, out=torch.from_numpy(out))
+    return out
+
+
+def _scipy_fft2(data, size=None, out=None):
+    return scipy_fft.fft2(data, s=size, axes=(-2, -1), workers=_fft_threads or -1)
+
+
+def _scipy_ifft2(data, size=None, out=None):
+    return scipy_fft.ifft2(data, s=size, axes=(-2, -1), workers=_fft_threads or -1)
+
+
+def _scipy_fft(data, size=None, out=None):
+    return scipy_fft.fft(data, n=size, axis=-1, workers=_fft_threads or -1)
+
+
+def _scipy_ifft(data, size=None, out=None):
+    return scipy_fft.ifft(data, n=size, axis=-1, workers=_fft_threads or -1)
+
+
+def _mkl_fft2(data, size=None, out=None):
+    return mkl_fft.fft2(data, size)
+
+
+def _mkl_ifft2(data, size=None, out=None):
+    return mkl_fft.ifft2(data, size)
+
+
+def _mkl_fft(data, size=None, out=None):
+    return mkl_fft.fft(data, n=size, axis=-1)
+
+
+def _mkl_ifft(data, size=None, out=None):
+    return mkl_fft.ifft(data, n=size, axis=-1)
+
+
+def _torch_threads(nthreads: int) -> None:
+    torch.set_num_threads(nthreads if nthreads > 0 else torch.get_num_threads())
+
+
+def _mkl_threads(nthreads: int) -> None:
+    if HAS_MKL and nthreads > 0:
+        mkl.set_num_threads(nthreads)
+
+
+# fft2, ifft2, fft and ifft (over the last axis) and a function setting the number of
+# threads of each backend
+FFT_BACKENDS = {
+    "torch": (_torch_fft2, _torch_ifft2, _torch_fft, _torch_ifft, _torch_threads),
+    "scipy": (_scipy_fft2, _scipy_ifft2, _scipy_fft, _scipy_ifft, lambda nthreads: None),
+}
+if HAS_MKL_FFT:
+    FFT_BACKENDS["mkl_fft"] = (_mkl_fft2, _mkl_ifft2, _mkl_fft, _mkl_ifft, _mkl_threads)
+
+_fft_backend = "mkl_fft" if HAS_MKL_FFT else "torch"
+_fft_threads = 0
+_fft_benchmarks = {}
+
+
+def fft2(data, size=None, out=None):
+    """ compute fft2 over last two dimensions with the current FFT backend
+    data is zero-padded to size if given, the result is written to out if the backend
+    supports it (out is a hint, use the returned array)
+    """
+    return FFT_BACKENDS[_fft_backend][0](data, size, out)
+
+
+def ifft2(data, size=None, out=None):
+    """ compute ifft2 over last two dimensions with the current FFT backend
+    data is zero-padded to size if given, the result is written to out if the backend
+    supports it (out is a hint, use the returned array)
+    """
+    return FFT_BACKENDS[_fft_backend][1](data, size, out)
+
+
+def fft(data, size=None, out=None):
+    """ compute fft over the last dimension with the current FFT backend
+    data is zero-padded to size if given, the result is written to out if the backend
+    supports it (out is a hint, use the returned array)
+    """
+    return FFT_BACKENDS[_fft_backend][2](data, size, out)
+
+
+def ifft(data, size=None, out=None):
+    """ compute ifft over the last dimension with the current FFT backend
+    data is zero-padded to size if given, the result is written to out if the backend
+    supports it (out is a hint, use the returned array)
+    """
+    return FFT_BACKENDS[_fft_backend][3](data, size, out)
+
+
+def get_fft_backend() -> str:
+    """ returns the name of the current FFT backend """
+    return _fft_backend
+
+
+def set_fft_backend(backend: str = "", nthreads: int = 0, shape=None) -> str:
+    """
+    Sets the backend used for the FFTs in registration.
+
+    Parameters
+    ----------
+    backend: str
+        "torch", "scipy" or "mkl_fft" (if installed). If "auto", the fastest backend for
+        frames of "shape" is picked with a micro-benchmark (see benchmark_fft_backends).
+        If "", the backend is read from the SUITE2P_FFT_BACKEND environment variable, and
+        defaults to mkl_fft if installed, else torch.
+    nthreads: int
+        number of threads of the backend (0 keeps the default)
+    shape: tuple
+        (Ly, Lx) or (nimg, Ly, Lx) of the frames, used by the micro-benchmark
+
+    Returns
+    -------
+    backend: str
+        the name of the backend that is used
+    """
+    global _fft_backend
+    backend = backend or os.environ.get(FFT_BACKEND_ENV, "")
+    if backend == "auto":
+        if shape is None:
+            raise ValueError("shape of the frames needed to benchmark the FFT backends")
+        timings = benchmark_fft_backends(shape, nthreads=nthreads)
+        backend = min(timings, key=timings.get)
+    elif backend == "":
+        backend = "mkl_fft" if HAS_MKL_FFT else "torch"
+    elif backend not in FFT_BACKENDS:
+        raise ValueError("FFT backend %s not available, choose from %s" %
+                         (backend, ", ".join(["auto"] + list(FFT_BACKENDS))))
+    _fft_backend = backend
+    set_fft_threads(nthreads)
+    return backend
+
+
+@contextmanager
+def using_fft_backend(backend: str = "", nthreads: int = 0, shape=None):
+    """
+    Context manager setting the FFT backend and its number of threads (see
+    set_fft_backend), and restoring the previous ones on exit. Yields the backend name.
+    """
+    global _fft_backend, _fft_threads
+    previous = (_fft_backend, _fft_threads, torch.get_num_threads(),
+                mkl.get_max_threads() if HAS_MKL else 0)
     try:
-        # pytorch > 1.7
-        from torch.fft import fft as torch_fft
-        from torch.fft import fft2 as torch_fft2
-        from torch.fft import ifft as torch_ifft
-        from torch.fft import ifft2 as torch_ifft2
-    except:
-        # pytorch <= 1.7
-        raise ImportError("pytorch version > 1.7 required")
-
-    eps = torch.complex(torch.tensor(1e-5), torch.tensor(0.0))
-
-    def fft2(data, size=None):
-        """ compute fft2 over last two dimensions using pytorch
-        size (padding) is not used
-        """
-        data_torch = torch.from_numpy(data)
-        data_torch = torch_fft(data_torch, dim=-1)
-        data_torch = torch_fft(data_torch, dim=-2)
-        return data_torch.cpu().numpy()
-
-    def ifft2(data, size=None):
-        """ compute ifft2 over last two dimensions using pytorch
-        size (padding) is not used
-        """
-        data_torch = torch.from_numpy(data)
-        data_torch = torch_ifft(data_torch, dim=-1)
-        data_torch = torch_ifft(data_torch, dim=-2)
-        return data_torch.cpu().numpy()
-
-    def convolve(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
-        """
-        Returns the 3D array "mov" convolved by a 2D array "img".
-
-        Parameters
-        ----------
-        mov: nImg x Ly x Lx
-            The frames to process
-        img: 2D array
-            The convolution kernel
-        lcorr: int (optional)
-            amount to crop cross-correlation
-
-        Returns
-        -------
-        convolved_data: nImg x Ly x Lx
-        """
-        mov_fft = torch.from_numpy(mov)
-        mov_fft = torch_fft2(mov_fft, dim=(-2, -1))
-        #mov_fft = torch_fft(torch_fft(mov_fft, dim=-1), dim=-2)
-        mov_fft /= (eps + torch.abs(mov_fft))
-        mov_fft *= torch.from_numpy(img)
-        mov_fft = torch.real(torch_ifft2(mov_fft, dim=(-2, -1)))
-        return mov_fft.numpy()
+        yield set_fft_backend(backend, nthreads, shape=shape)
+    finally:
+        _fft_backend, _fft_threads = previous[:2]
+        torch.set_num_threads(previous[2])
+        if HAS_MKL:
+            mkl.set_num_threads(previous[3])
+
+
+def fft_shape(Ly: int, Lx: int, pad_fft: bool = False) -> Tuple[int, int]:
+    """ returns the size of the frames in the FFTs of registration """
+    return (next_fast_len(Ly), next_fast_len(Lx)) if pad_fft else (Ly, Lx)
+
+
+def benchmark_fft_backends(shape, nthreads: int = 0, nrep: int = 3) -> dict:
+    """
+    Times a forward and inverse FFT of FFT_BENCHMARK_FRAMES frames of shape[-2:] with each
+    backend (best of nrep runs, after a warm-up run). Results are cached for each frame size
+    and number of threads.
+
+    Returns
+    -------
+    timings: dict
+        seconds per frame of each backend
+    """
+    key = (tuple(shape[-2:]), nthreads)
+    if key not in _fft_benchmarks:
+        global _fft_threads
+        threads = _fft_threads
+        rng = np.random.default_rng(0)
+        data = (rng.standard_normal((FFT_BENCHMARK_FRAMES,) + key[0]) +
+                0j).astype("complex64")
+        timings = {}
+        for backend, (bfft2, bifft2, _, _, bthreads) in FFT_BACKENDS.items():
+            bthreads(nthreads)
+            _fft_threads = nthreads
+            times = []
+            for _ in range(nrep + 1):
+                t0 = time.perf_counter()
+                bifft2(bfft2(data.copy()))
+                times.append(time.perf_counter() - t0)
+            timings[backend] = min(times[1:]) / FFT_BENCHMARK_FRAMES
+        _fft_threads = threads
+        _fft_benchmarks[key] = timings
+        print("FFT backends, msec per frame: %s" %
+              ", ".join(["%s %0.3f" % (b, 1000 * t) for b, t in timings.items()]))
+    return _fft_benchmarks[key]
+
+
+# maximum number of FFT buffers kept per thread
+FFT_WORKSPACES = 4
+_fft_workspace = threading.local()
+# backends that write their result to the "out" array of fft2 / ifft2 / fft / ifft
+FFT_OUT_BACKENDS = ("torch",)
+
+
+def fft_workspace(shape, slot: int = 0, dtype=torch.complex64) -> torch.Tensor:
+    """
+    Returns a preallocated buffer of "shape" for the calling thread.
+
+    Buffers are kept for the last FFT_WORKSPACES (shape, slot, dtype) so that consecutive
+    batches reuse the same memory instead of allocating new complex arrays on every call.
+
+    Parameters
+    ----------
+    shape: tuple
+        shape of the buffer, e.g. (nimg, Ly, Lx)
+    slot: int (optional, default 0)
+        index of the buffer, to hold several buffers of the same shape at once
+    dtype: torch.dtype (optional, default torch.complex64)
+
+    Returns
+    -------
+    buffer: torch.Tensor
+        uninitialized buffer, only valid until the next call with the same arguments in this thread
+    """
+    buffers = _fft_workspace.__dict__.setdefault("buffers", {})
+    key = (tuple(shape), slot, dtype)
+    if key not in buffers:
+        if len(buffers) >= FFT_WORKSPACES:
+            buffers.pop(next(iter(buffers)))
+        buffers[key] = torch.empty(key[0], dtype=dtype)
+    return buffers[key]
+
+
+def fft_out(shape, slot: int = 0):
+    """
+    Returns a workspace buffer (see fft_workspace) to pass as "out" to fft2 / ifft2 / fft /
+    ifft, or None if the current backend allocates its own output.
+    """
+    if _fft_backend not in FFT_OUT_BACKENDS:
+        return None
+    return fft_workspace(shape, slot=slot).numpy()
+
+
+def set_fft_threads(nthreads: int = 0) -> None:
+    """ sets the number of threads used for FFTs in registration (0 keeps the default) """
+    global _fft_threads
+    _fft_threads = int(nthreads)
+    FFT_BACKENDS[_fft_backend][4](int(nthreads))
+
+
+def convolve(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
+    """
+    Returns the 3D array "mov" convolved by a 2D array "img".
+
+    If "img" is larger than the frames (padded to a fast FFT size), "mov" is zero-padded
+    to the size of "img".
+
+    Parameters
+    ----------
+    mov: nImg x Ly x Lx
+        The frames to process
+    img: 2D array
+        The convolution kernel, in the fft domain
+
+    Returns
+    -------
+    convolved_data: nImg x Ly x Lx
+        real part of the convolution
+    """
+    size = img.shape[-2:]
+    mov_fft = fft2(mov, size, out=fft_out(mov.shape[:-2] + size, slot=0))
+    return convolve_fft(mov_fft, img)
+
+
+def convolve_fft(mov_fft: np.ndarray, img: np.ndarray) -> np.ndarray:
+    """
+    Returns the 3D array "mov" convolved by a 2D array "img", with "mov" already in the
+    fft domain (e.g. to convolve the same frames with several kernels).
+
+    Parameters
+    ----------
+    mov_fft: nImg x Ly x Lx, complex64
+        The fft of the frames to process, normalized in place
+    img: 2D array
+        The convolution kernel, in the fft domain
+
+    Returns
+    -------
+    convolved_data: nImg x Ly x Lx
+        real part of the convolution
+    """
+    img = img.astype("complex64", copy=False)
+    if np.broadcast_shapes(mov_fft.shape, img.shape) == mov_fft.shape:
+        apply_dotnorm(mov_fft, img, out=mov_fft)
+    else:
+        mov_fft = apply_dotnorm(mov_fft, img)
+    # copy the real part out of the workspace, which is reused by the next call
+    return ifft2(mov_fft, out=fft_out(mov_fft.shape, slot=1)).real.copy()
 
 
 @vectorize([complex64(complex64, complex64)], nopython=True, target="parallel")
@@ -332,6 +613,34 @@ def kernelD2(xs: int, ys: int) -> np.ndarray:
     return R
 
 
+def cc_window(cc: np.ndarray, lhalf: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Returns the +/- lhalf window around zero shift of circular correlations.
+
+    Parameters
+    ----------
+    cc: ... x Ly x Lx
+        circular correlations with zero shift at [0, 0]
+    lhalf: int
+        half-width of the window
+    out: ... x (2*lhalf+1) x (2*lhalf+1) (optional)
+        array to write the window into
+
+    Returns
+    -------
+    ccw: ... x (2*lhalf+1) x (2*lhalf+1)
+        correlations from shift -lhalf to +lhalf in y and x
+    """
+    if out is None:
+        out = np.empty(cc.shape[:-2] + (2 * lhalf + 1, 2 * lhalf + 1), "float32")
+    out[..., lhalf:, lhalf:] = cc[..., :lhalf + 1, :lhalf + 1]
+    if lhalf > 0:
+        out[..., :lhalf, :lhalf] = cc[..., -lhalf:, -lhalf:]
+        out[..., :lhalf, lhalf:] = cc[..., -lhalf:, :lhalf + 1]
+        out[..., lhalf:, :lhalf] = cc[..., :lhalf + 1, -lhalf:]
+    return out
+
+
 @lru_cache(maxsize=5)
 def mat_upsample(lpad: int, subpixel: int = 10):
     """
@@ -345,10 +654,12 @@ def mat_upsample(lpad: int, subpixel: int = 10):
     Returns
     -------
     Kmat: np.ndarray
+        read-only, the matrix is cached and shared by all callers
     nup: int
     """
     lar = np.arange(-lpad, lpad + 1)
     larUP = np.arange(-lpad, lpad + .001, 1. / subpixel)
     nup = larUP.shape[0]
     Kmat = np.linalg.inv(kernelD(lar, lar)) @ kernelD(lar, larUP)
+    Kmat.flags.writeable = False
     return Kmat, nup
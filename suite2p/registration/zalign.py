@@ -1,224 +1,207 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
-import os
 import time
 
 import numpy as np
-from scipy.signal import medfilt
+from scipy.ndimage import gaussian_filter1d
 
-from . import nonrigid, rigid, utils
+from .. import io, default_ops
+from . import register, rigid, utils
 
 
-# This function doesn"t work. Has a bunch of name errors.
-def register_stack(Z, ops):
-    """
+def register_stack(Z, ops=default_ops()):
+    """ register the planes of a z-stack to each other
+
+    If the stack has several frames at each plane, the frames of each plane are first
+    registered to a reference image computed from them (see compute_reference_masks and
+    register_frames) and averaged. Each plane is then aligned rigidly to the previous plane,
+    with all pairs of planes in a batch aligned in one phase correlation, and the shifts are
+    accumulated to align all planes to the middle plane.
 
     Parameters
     ----------
-    Z
-    ops: dict
+    Z : nplanes x Ly x Lx, or nplanes x nframes x Ly x Lx
+        z-stack, can be any array that can be slice-indexed (e.g. a BinaryFile of planes)
+    ops : dictionary
+        registration settings ("batch_size", "maxregshift", "smooth_sigma", "norm_frames",
+        "1Preg", "nonrigid" for the frames at each plane, ...)
 
     Returns
     -------
-    Zreg: nplanes x Ly x Lx
-        Z-stack
-    ops: dict
+    Zreg : nplanes x Ly x Lx, float32
+        registered z-stack
+    yoff : nplanes
+        y shifts applied to each plane
+    xoff : nplanes
+        x shifts applied to each plane
+    corrXY : nplanes
+        peak of the phase correlation of each plane with the previous plane (0 for the
+        first plane)
     """
+    ops = {**ops, "smooth_sigma_time": 0}
+    if Z.ndim == 4:
+        t0 = time.time()
+        Zmean = np.zeros((Z.shape[0], *Z.shape[2:]), np.float32)
+        for p in range(Z.shape[0]):
+            Zmean[p] = register_plane(Z[p], ops)
+        print("registered frames of %d planes, %0.2f sec." % (Z.shape[0], time.time() - t0))
+        Z = Zmean
+    nplanes = Z.shape[0]
+
+    # shifts of each plane to the previous plane
+    dy, dx, corrXY = (np.zeros(nplanes, np.float32) for _ in range(3))
+    prev = None
+    for k, planes in io.iter_batches(Z, ops["batch_size"],
+                                     prefetch=ops.get("prefetch_batches", 1)):
+        planes = register.preprocess_frames(planes.astype(np.float32), ops)
+        refs = planes[:-1] if prev is None else np.concatenate((prev, planes[:-1]))
+        i0 = k + 1 if prev is None else k
+        if len(refs) > 0:
+            dy[i0:k + len(planes)], dx[i0:k + len(planes)], corrXY[i0:k + len(planes)] = (
+                align_planes(planes[i0 - k:], refs, ops))
+        prev = planes[-1:]
+
+    # accumulate shifts from the middle plane
+    yoff, xoff = np.cumsum(dy), np.cumsum(dx)
+    yoff -= yoff[nplanes // 2]
+    xoff -= xoff[nplanes // 2]
+    if not ops.get("rigid_subpixel", False):
+        yoff, xoff = yoff.astype(int), xoff.astype(int)
+    Zreg = rigid.shift_frames(np.asarray(Z[:nplanes], np.float32), yoff, xoff)
+    return Zreg.astype(np.float32, copy=False), yoff, xoff, corrXY
+
+
+def register_plane(frames, ops=default_ops()):
+    """ register frames (nframes x Ly x Lx) to a reference image computed from them,
+    in batches of ops["batch_size"], and return their mean """
+    nframes, Ly, Lx = frames.shape
+    refImg = register.compute_reference(
+        np.asarray(frames[np.linspace(0, nframes, 1 + min(ops["nimg_init"], nframes),
+                                      dtype=int)[:-1]], np.float32), ops=ops)
+    rmin, rmax = -np.inf, np.inf
+    if ops.get("norm_frames", False):
+        refImg, rmin, rmax = register.normalize_reference_image(refImg)
+    refAndMasks = register.compute_reference_masks(refImg, ops)
+    bidiphase = ops["bidiphase"] if not ops["bidi_corrected"] else 0
+
+    mean_img = np.zeros((Ly, Lx), np.float32)
+    for k, batch in io.iter_batches(frames, ops["batch_size"]):
+        # frames are registered in place, so the stack is copied
+        batch = register.register_frames(refAndMasks, batch.astype(np.float32),
+                                         rmin=rmin, rmax=rmax, bidiphase=bidiphase,
+                                         ops=ops)[0]
+        mean_img += batch.sum(axis=0)
+    return mean_img / nframes
+
+
+def align_planes(frames, refs, ops=default_ops()):
+    """ rigid shifts of each plane in frames to the corresponding plane in refs, with all
+    pairs of planes in one phase correlation
+
+    Parameters
+    ----------
+    frames : nplanes x Ly x Lx, float32
+    refs : nplanes x Ly x Lx, float32
+    ops : dictionary
 
-    if "refImg" not in ops:
-        ops["refImg"] = Z.mean(axis=0)
-    ops["nframes"], ops["Ly"], ops["Lx"] = Z.shape
-
-    if ops["nonrigid"]:
-        ops["yblock"], ops["xblock"], ops["nblocks"], ops["block_size"], ops[
-            "NRsm"] = nonrigid.make_blocks(Ly=ops["Ly"], Lx=ops["Lx"],
-                                           block_size=ops["block_size"])
-
-    Ly = ops["Ly"]
-    Lx = ops["Lx"]
-
-    nbatch = ops["batch_size"]
-    meanImg = np.zeros((Ly, Lx))  # mean of this stack
-
-    yoff = np.zeros((0,), np.float32)
-    xoff = np.zeros((0,), np.float32)
-    corrXY = np.zeros((0,), np.float32)
-    if ops["nonrigid"]:
-        yoff1 = np.zeros((0, nb), np.float32)
-        xoff1 = np.zeros((0, nb), np.float32)
-        corrXY1 = np.zeros((0, nb), np.float32)
-
-    maskMul, maskOffset, cfRefImg = rigid.prepare_masks(
-        refImg, ops)  # prepare masks for rigid registration
-    if ops["nonrigid"]:
-        # prepare masks for non- rigid registration
-        maskMulNR, maskOffsetNR, cfRefImgNR = nonrigid.prepare_masks(refImg, ops)
-        refAndMasks = [
-            maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR
-        ]
-        nb = ops["nblocks"][0] * ops["nblocks"][1]
-    else:
-        refAndMasks = [maskMul, maskOffset, cfRefImg]
-
-    k = 0
-    nfr = 0
-    Zreg = np.zeros((
-        nframes,
-        Ly,
-        Lx,
-    ), "int16")
-    while True:
-        irange = np.arange(nfr, nfr + nbatch)
-        data = Z[irange, :, :]
-        if data.size == 0:
-            break
-        data = np.reshape(data, (-1, Ly, Lx))
-        dwrite, ymax, xmax, cmax, yxnr = rigid.phasecorr(data, refAndMasks,
-                                                         ops)  # not here
-        dwrite = dwrite.astype("int16")  # need to hold on to this
-        meanImg += dwrite.sum(axis=0)
-        yoff = np.hstack((yoff, ymax))
-        xoff = np.hstack((xoff, xmax))
-        corrXY = np.hstack((corrXY, cmax))
-        if ops["nonrigid"]:
-            yoff1 = np.vstack((yoff1, yxnr[0]))
-            xoff1 = np.vstack((xoff1, yxnr[1]))
-            corrXY1 = np.vstack((corrXY1, yxnr[2]))
-        nfr += dwrite.shape[0]
-        Zreg[irange] = dwrite
-
-        k += 1
-        if k % 5 == 0:
-            print("%d/%d frames %4.2f sec" %
-                  (nfr, ops["nframes"], time.time() - k0))  # where is this timer set?
-
-    # compute some potentially useful info
-    ops["th_badframes"] = 100
-    dx = xoff - medfilt(xoff, 101)
-    dy = yoff - medfilt(yoff, 101)
-    dxy = (dx**2 + dy**2)**.5
-    cXY = corrXY / medfilt(corrXY, 101)
-    px = dxy / np.mean(dxy) / np.maximum(0, cXY)
-    ops["badframes"] = px > ops["th_badframes"]
-    ymin = np.maximum(0, np.ceil(np.amax(yoff[np.logical_not(ops["badframes"])])))
-    ymax = ops["Ly"] + np.minimum(0, np.floor(np.amin(yoff)))
-    xmin = np.maximum(0, np.ceil(np.amax(xoff[np.logical_not(ops["badframes"])])))
-    xmax = ops["Lx"] + np.minimum(0, np.floor(np.amin(xoff)))
-    ops["yrange"] = [int(ymin), int(ymax)]
-    ops["xrange"] = [int(xmin), int(xmax)]
-    ops["corrXY"] = corrXY
-
-    ops["yoff"] = yoff
-    ops["xoff"] = xoff
-
-    if ops["nonrigid"]:
-        ops["yoff1"] = yoff1
-        ops["xoff1"] = xoff1
-        ops["corrXY1"] = corrXY1
-
-    ops["meanImg"] = meanImg / ops["nframes"]
-
-    return Zreg, ops
-
-
-def compute_zpos(Zreg, ops, reg_file=None):
+    Returns
+    -------
+    ymax, xmax, cmax : see rigid.phasecorr
+    """
+    if ops.get("norm_frames", False):
+        rmin, rmax = np.percentile(refs, [1, 99], axis=(1, 2))[..., np.newaxis, np.newaxis]
+        refs = np.clip(refs, rmin, rmax)
+        frames = np.clip(frames, rmin, rmax).astype(np.float32)
+    refAndMasks = register.compute_reference_masks(list(refs), {**ops, "nonrigid": False})
+    maskMul = refAndMasks[0][0]
+    maskOffset = np.stack([ref[1] for ref in refAndMasks])
+    cfRefImg = np.stack([ref[2] for ref in refAndMasks])
+    return rigid.phasecorr(
+        data=rigid.apply_masks(frames, maskMul, maskOffset),
+        cfRefImg=cfRefImg,
+        maxregshift=ops["maxregshift"],
+        smooth_sigma_time=0,
+        subpixel=ops["subpixel"] if ops.get("rigid_subpixel", False) else 1,
+    )
+
+
+def compute_zpos(Zreg, ops, reg_file=None, smooth_sigma_z: float = 2.):
     """ compute z position of frames given z-stack Zreg
 
+    The frames are read in batches of ops["batch_size"] (in a background thread, see
+    io.iter_batches) and correlated with all planes at once (see rigid.phasecorr_multi).
+
     Parameters
     ----------
 
     Zreg : 3D array
-        size [nplanes x Ly x Lx], z-stack
+        size [nplanes x Ly x Lx], z-stack (e.g. registered with register_stack)
 
     ops : dictionary
         "reg_file" <- binary to register to z-stack, "smooth_sigma",
         "Ly", "Lx", "batch_size"
 
+    reg_file : str (optional, default ops["reg_file"])
+        binary to register to z-stack
+
+    smooth_sigma_z : float (optional, default 2.)
+        the correlations are smoothed in time with this standard deviation (in frames)
+        before estimating the z position of each frame
+
     Returns
     -------
-    ops_orig
-    zcorr
+    ops_orig : dictionary
+        ops with "zcorr" and "zpos" (estimated plane of each frame)
+    zcorr : nplanes x nframes
+        phase correlation of each frame with each plane
     """
-    if "reg_file" not in ops:
+    if "reg_file" not in ops and reg_file is None:
         raise IOError("no binary specified")
+    reg_file = ops["reg_file"] if reg_file is None else reg_file
 
-    nbatch = ops["batch_size"]
-    Ly = ops["Ly"]
-    Lx = ops["Lx"]
-    nbytesread = 2 * Ly * Lx * nbatch
+    Ly, Lx = ops["Ly"], ops["Lx"]
+    nplanes = Zreg.shape[0]
+    if Zreg.shape[1:] != (Ly, Lx):
+        raise ValueError("z-stack planes %s do not match the size of the frames %s" %
+                         (Zreg.shape[1:], (Ly, Lx)))
 
     ops_orig = ops.copy()
-    ops["nonrigid"] = False
-    nplanes, zLy, zLx = Zreg.shape
-    if Zreg.shape[1] > Ly or Zreg.shape[2] != Lx:
-        Zreg = Zreg[
-            :,
-        ]
+    ops = {**ops, "nonrigid": False}
+    Zreg = np.asarray(Zreg, np.float32)
+    if ops["1Preg"]:
+        if ops["pre_smooth"]:
+            Zreg = utils.spatial_smooth(Zreg, int(ops["pre_smooth"]))
+        Zreg = utils.spatial_high_pass(Zreg, int(ops["spatial_hp_reg"]))
+    refAndMasks = register.compute_reference_masks(list(Zreg), ops)
 
-    reg_file = ops["reg_file"] if reg_file is None else reg_file
-    nbytes = os.path.getsize(reg_file)
-    nFrames = int(nbytes / (2 * Ly * Lx))
-
-    reg_file = open(reg_file, "rb")
-    refAndMasks = []
-    for Z in Zreg:
-        if ops["1Preg"]:
-            Z = Z.astype(np.float32)
-            Z = Z[np.newaxis, :, :]
-            if ops["pre_smooth"]:
-                Z = utils.spatial_smooth(Z, int(ops["pre_smooth"]))
-            Z = utils.spatial_high_pass(Z, int(ops["spatial_hp_reg"]))
-            Z = Z.squeeze()
-
-        maskMul, maskOffset = rigid.compute_masks(
-            refImg=Z,
-            maskSlope=ops["spatial_taper"] if ops["1Preg"] else 3 * ops["smooth_sigma"],
-        )
-        cfRefImag = rigid.phasecorr_reference(refImg=Z,
-                                              smooth_sigma=ops["smooth_sigma"])
-        cfRefImag = cfRefImag[np.newaxis, :, :]
-        refAndMasks.append((maskMul, maskOffset, cfRefImag))
-
-    zcorr = np.zeros((Zreg.shape[0], nFrames), np.float32)
     t0 = time.time()
-    k = 0
-    nfr = 0
-    while True:
-        buff = reg_file.read(nbytesread)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0).copy()
-        if (data.size == 0) | (nfr >= ops["nframes"]):
-            break
-        data = np.float32(np.reshape(data, (-1, Ly, Lx)))
-        inds = np.arange(nfr, nfr + data.shape[0], 1, int)
-        for z, ref in enumerate(refAndMasks):
-
+    with io.BinaryFile(Ly=Ly, Lx=Lx, filename=reg_file) as f:
+        nframes = min(f.n_frames, ops.get("nframes", f.n_frames))
+        zcorr = np.zeros((nplanes, nframes), np.float32)
+        for k, data in io.iter_batches(f, ops["batch_size"], n_frames=nframes,
+                                       prefetch=ops.get("prefetch_batches", 1)):
+            data = data.astype(np.float32)
             # preprocessing for 1P recordings
             if ops["1Preg"]:
-                data = data.astype(np.float32)
-
                 if ops["pre_smooth"]:
                     data = utils.spatial_smooth(data, int(ops["pre_smooth"]))
                 data = utils.spatial_high_pass(data, int(ops["spatial_hp_reg"]))
 
-            maskMul, maskOffset, cfRefImg = ref
-            cfRefImg = cfRefImg.squeeze()
-
-            _, _, zcorr[z, inds] = rigid.phasecorr(
-                data=rigid.apply_masks(data=data, maskMul=maskMul,
-                                       maskOffset=maskOffset),
-                cfRefImg=cfRefImg,
+            # correlate the frames with all planes at once
+            _, _, zcorr[:, k:k + data.shape[0]] = rigid.phasecorr_multi(
+                data=data,
+                maskMul=[ref[0] for ref in refAndMasks],
+                maskOffset=[ref[1] for ref in refAndMasks],
+                cfRefImg=[ref[2] for ref in refAndMasks],
                 maxregshift=ops["maxregshift"],
                 smooth_sigma_time=ops["smooth_sigma_time"],
             )
-            if z % 10 == 1:
-                print("%d planes, %d/%d frames, %0.2f sec." %
-                      (z, nfr, ops["nframes"], time.time() - t0))
-        print("%d planes, %d/%d frames, %0.2f sec." %
-              (z, nfr, ops["nframes"], time.time() - t0))
-        nfr += data.shape[0]
-        k += 1
-
-    reg_file.close()
+            print("%d planes, %d/%d frames, %0.2f sec." %
+                  (nplanes, k + data.shape[0], nframes, time.time() - t0))
+
     ops_orig["zcorr"] = zcorr
+    ops_orig["zpos"] = np.argmax(
+        gaussian_filter1d(zcorr, smooth_sigma_z, axis=1) if smooth_sigma_z > 0 else zcorr,
+        axis=0)
     return ops_orig, zcorr
@@ -2,14 +2,17 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 import os
-import shutil
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
 from natsort import natsorted
 from datetime import datetime
 from getpass import getpass
 import pathlib
 import contextlib
+import numba
 import numpy as np
+import torch
 #from scipy.io import savemat
 
 from . import extraction, io, registration, detection, classification, default_ops
@@ -55,6 +58,9 @@ from pathlib import Path
 
 print = partial(print, flush=True)
 
+# memory used by each plane worker in addition to the data (libraries, compiled kernels)
+PLANE_WORKER_OVERHEAD = 1e9
+
 
 def pipeline(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
              run_registration=True, ops=default_ops(), stat=None):
@@ -152,10 +158,14 @@ def pipeline(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
             nsamp = min(2000 if n_frames < 5000 or Ly > 700 or Lx > 700 else 5000,
                         n_frames)
             inds = np.linspace(0, n_frames - 1, nsamp).astype("int")
-            mov = f_reg[inds]
-            mov = mov[:, ops["yrange"][0]:ops["yrange"][-1],
-                      ops["xrange"][0]:ops["xrange"][-1]]
-            ops = registration.get_pc_metrics(mov, ops)
+            if ops.get("reg_metrics_batched", False):
+                # frames are read in batches instead of all at once
+                ops = registration.get_pc_metrics(f_reg, ops, inds=inds)
+            else:
+                mov = f_reg[inds]
+                mov = mov[:, ops["yrange"][0]:ops["yrange"][-1],
+                          ops["xrange"][0]:ops["xrange"][-1]]
+                ops = registration.get_pc_metrics(mov, ops)
             plane_times["registration_metrics"] = time.time() - t0
             print("Registration metrics, %0.2f sec." %
                   plane_times["registration_metrics"])
@@ -331,12 +341,14 @@ def run_plane(ops, ops_path=None, stat=None):
 
     null = contextlib.nullcontext()
     twoc = ops["nchannels"] > 1
-    with io.BinaryFile(Ly=Ly, Lx=Lx, filename=raw_file, n_frames=n_frames) \
+    kwargs = {"n_frames": n_frames, "compression": ops.get("binary_compression"),
+              "fs": ops["fs"]}
+    with io.BinaryFile(Ly=Ly, Lx=Lx, filename=raw_file, **kwargs) \
             if raw else null as f_raw, \
-         io.BinaryFile(Ly=Ly, Lx=Lx, filename=reg_file, n_frames=n_frames) as f_reg, \
-         io.BinaryFile(Ly=Ly, Lx=Lx, filename=raw_file_chan2, n_frames=n_frames) \
+         io.BinaryFile(Ly=Ly, Lx=Lx, filename=reg_file, **kwargs) as f_reg, \
+         io.BinaryFile(Ly=Ly, Lx=Lx, filename=raw_file_chan2, **kwargs) \
             if raw and twoc else null as f_raw_chan2,\
-         io.BinaryFile(Ly=Ly, Lx=Lx, filename=reg_file_chan2, n_frames=n_frames) \
+         io.BinaryFile(Ly=Ly, Lx=Lx, filename=reg_file_chan2, **kwargs) \
             if twoc else null as f_reg_chan2:
 
         ops = pipeline(f_reg, f_raw, f_reg_chan2, f_raw_chan2, run_registration, ops,
@@ -344,27 +356,120 @@ def run_plane(ops, ops_path=None, stat=None):
 
     if ops.get("move_bin") and ops["save_path"] != ops["fast_disk"]:
         print("moving binary files to save_path")
-        shutil.move(ops["reg_file"], os.path.join(ops["save_path"], "data.bin"))
+        io.move_binary(ops["reg_file"], os.path.join(ops["save_path"], "data.bin"))
         if ops["nchannels"] > 1:
-            shutil.move(ops["reg_file_chan2"],
-                        os.path.join(ops["save_path"], "data_chan2.bin"))
+            io.move_binary(ops["reg_file_chan2"],
+                           os.path.join(ops["save_path"], "data_chan2.bin"))
         if "raw_file" in ops:
-            shutil.move(ops["raw_file"], os.path.join(ops["save_path"], "data_raw.bin"))
+            io.move_binary(ops["raw_file"],
+                           os.path.join(ops["save_path"], "data_raw.bin"))
             if ops["nchannels"] > 1:
-                shutil.move(ops["raw_file_chan2"],
-                            os.path.join(ops["save_path"], "data_chan2_raw.bin"))
+                io.move_binary(ops["raw_file_chan2"],
+                               os.path.join(ops["save_path"], "data_chan2_raw.bin"))
     elif ops.get("delete_bin"):
         print("deleting binary files")
-        os.remove(ops["reg_file"])
+        io.remove_binary(ops["reg_file"])
         if ops["nchannels"] > 1:
-            os.remove(ops["reg_file_chan2"])
+            io.remove_binary(ops["reg_file_chan2"])
         if "raw_file" in ops:
-            os.remove(ops["raw_file"])
+            io.remove_binary(ops["raw_file"])
             if ops["nchannels"] > 1:
-                os.remove(ops["raw_file_chan2"])
+                io.remove_binary(ops["raw_file_chan2"])
     return ops
 
 
+def plane_memory(ops):
+    """ estimated peak memory in bytes of running run_plane on a plane with ops """
+    npix = ops["Ly"] * ops["Lx"]
+    # int16 read-ahead / write-behind buffers, float32 frames and complex64 FFT workspaces
+    nbuffers = 1 + ops.get("prefetch_batches", 1) + ops.get("write_behind_batches", 2)
+    registration = npix * ops["batch_size"] * (2 * nbuffers + 4 * 2 + 8 * 3)
+    # float32 binned movie and its filtered copies
+    detection = npix * min(ops["nbinned"], ops["nframes"]) * 4 * 3
+    return PLANE_WORKER_OVERHEAD + max(registration, detection)
+
+
+def available_memory():
+    """ physical memory in bytes that is currently free (inf if unknown) """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return np.inf
+
+
+def _run_plane_worker(ops, ops_path, nthreads):
+    """ runs run_plane in a worker process with nthreads threads for torch and numba """
+    torch.set_num_threads(nthreads)
+    numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))
+    return run_plane(ops, ops_path=ops_path)
+
+
+def run_planes(plane_ops, ops_paths, ops):
+    """ run suite2p processing on several planes in parallel on this machine
+
+    The planes are processed by run_plane on a pool of ops["plane_workers"] processes, each
+    using ops["plane_threads"] threads (by default the cores are split evenly across the
+    workers). A plane is started when a worker is free and its estimated peak memory (see
+    plane_memory) fits in ops["plane_memory"] GB (by default the free memory) together
+    with the planes that are running; a plane is always started if no other plane is
+    running.
+
+    Parameters
+    -----------
+    plane_ops : list of :obj:`dict`
+        ops of each plane
+    ops_paths : list of str
+        absolute path to the ops file of each plane
+    ops : :obj:`dict`
+        "plane_workers", "plane_threads", "plane_memory"
+
+    Returns
+    --------
+    plane_ops : list of :obj:`dict`
+        ops of each plane after processing
+    """
+    nworkers = min(ops["plane_workers"], len(plane_ops))
+    nthreads = ops.get("plane_threads", 0) or max(1, (os.cpu_count() or 1) // nworkers)
+    budget = (ops["plane_memory"] * 1e9
+              if ops.get("plane_memory", 0) > 0 else available_memory())
+    print("processing %d planes on %d workers with %d threads each" %
+          (len(plane_ops), nworkers, nthreads))
+
+    # BLAS and OpenMP thread pools are sized from the environment when the workers start
+    thread_vars = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+    environ = {key: os.environ.get(key) for key in thread_vars}
+    os.environ.update({key: str(nthreads) for key in thread_vars})
+    outputs = [None] * len(plane_ops)
+    try:
+        # workers are not forked from this process, which may already be running threads
+        with ProcessPoolExecutor(nworkers, mp_context=get_context("spawn")) as pool:
+            pending, running = list(range(len(plane_ops))), {}
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < nworkers:
+                    memory = plane_memory(plane_ops[pending[0]])
+                    if len(running) > 0 and sum(
+                            mem for _, mem in running.values()) + memory > budget:
+                        break
+                    i = pending.pop(0)
+                    future = pool.submit(_run_plane_worker, plane_ops[i], ops_paths[i],
+                                         nthreads)
+                    running[future] = (i, memory)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, _ = running.pop(future)
+                    outputs[i] = future.result()
+                    print("%s processed in %0.2f sec (can open in GUI)." %
+                          (os.path.basename(os.path.dirname(ops_paths[i])),
+                           outputs[i]["timing"]["total_plane_runtime"]))
+    finally:
+        for key, value in environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return outputs
+
+
 def run_s2p(ops={}, db={}, server={}):
     """ run suite2p pipeline
 
@@ -421,8 +526,9 @@ def run_s2p(ops={}, db={}, server={}):
             ops["bin_file"] = os.path.join(f, "data.bin")
             ops["Ly"] = ops["Lys"][i]
             ops["Lx"] = ops["Lxs"][i]
-            nbytesread = np.int64(2 * ops["Ly"] * ops["Lx"])
-            ops["nframes"] = os.path.getsize(ops["bin_file"]) // nbytesread
+            with io.BinaryFile(Ly=ops["Ly"], Lx=ops["Lx"],
+                               filename=ops["bin_file"]) as f:
+                ops["nframes"] = f.n_frames
             np.save(opf, ops)
         files_found_flag = True
     elif len(plane_folders) > 0:
@@ -532,6 +638,7 @@ def run_s2p(ops={}, db={}, server={}):
             io.server.send_jobs(save_folder)
         return None
     else:
+        plane_ids, plane_ops, plane_paths = [], [], []
         for ipl, ops_path in enumerate(ops_paths):
             if ipl in ops["ignore_flyback"]:
                 print(">>>> skipping flyback PLANE", ipl)
@@ -546,11 +653,18 @@ def run_s2p(ops={}, db={}, server={}):
                 ]:
                     if key in ops:
                         op[key] = ops[key]
+            plane_ids.append(ipl)
+            plane_ops.append(op)
+            plane_paths.append(ops_path)
 
-            print(">>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<" % ipl)
-            op = run_plane(op, ops_path=ops_path)
-            print("Plane %d processed in %0.2f sec (can open in GUI)." %
-                  (ipl, op["timing"]["total_plane_runtime"]))
+        if ops.get("plane_workers", 0) > 1 and len(plane_ops) > 1:
+            op = run_planes(plane_ops, plane_paths, ops)[-1]
+        else:
+            for ipl, op, ops_path in zip(plane_ids, plane_ops, plane_paths):
+                print(">>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<" % ipl)
+                op = run_plane(op, ops_path=ops_path)
+                print("Plane %d processed in %0.2f sec (can open in GUI)." %
+                      (ipl, op["timing"]["total_plane_runtime"]))
         run_time = time.time() - t0
         print("total = %0.2f sec." % run_time)
 
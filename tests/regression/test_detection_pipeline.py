@@ -68,3 +68,42 @@ def test_detection_output_2plane2chan(test_ops):
             utils.get_list_of_data(outputs_to_check, test_ops['data_path'][0].parent.joinpath(f"test_outputs/detection/suite2p/plane{i}")),
             utils.get_list_of_data(outputs_to_check, Path(test_ops['save_path0']).joinpath(f"suite2p/plane{i}")),
         ))
+
+
+def test_detection_reuses_cached_binned_and_denoised_movies(test_ops):
+    test_ops.update({
+        'tiff_list': ['input.tif'],
+        'detect_cache': True,
+        'denoise': True,
+    })
+    op = utils.DetectionTestUtils.prepare(
+        test_ops,
+        [[test_ops['data_path'][0].joinpath('detection/pre_registered.npy')]],
+        (404, 360)
+    )[0]
+    save_path = Path(op['save_path'])
+    _, stat = detection.detect(ops=dict(op))
+    cache = np.load(save_path.joinpath('detect_cache.npy'), allow_pickle=True)[()]
+    assert 'binned' in cache and 'denoised' in cache
+    binned = np.load(save_path.joinpath('mov_binned.npy'))
+
+    # rerunning with the same frames and binning settings uses the cached movies
+    _, stat_cached = detection.detect(ops=dict(op))
+    assert np.load(save_path.joinpath('detect_cache.npy'), allow_pickle=True)[()] == cache
+    assert len(stat_cached) == len(stat)
+    for s, s_cached in zip(stat, stat_cached):
+        assert np.array_equal(s['ypix'], s_cached['ypix'])
+        assert np.allclose(s['lam'], s_cached['lam'])
+
+    # cache entries are only used if their movies still exist
+    save_path.joinpath('mov_denoised.npy').unlink()
+    _, stat_cached = detection.detect(ops=dict(op))
+    assert save_path.joinpath('mov_denoised.npy').exists()
+    assert len(stat_cached) == len(stat)
+
+    # changing the bin size invalidates the cache
+    detection.detect(ops=dict(op, tau=2 * op['tau']))
+    new_cache = np.load(save_path.joinpath('detect_cache.npy'), allow_pickle=True)[()]
+    assert new_cache['binned'] != cache['binned']
+    assert not np.array_equal(np.load(save_path.joinpath('mov_binned.npy')).shape,
+                              binned.shape)
@@ -99,3 +99,21 @@ def test_mesoscan_2plane_2z(test_ops):
 			utils.get_list_of_data(outputs_to_check, test_ops['data_path'][0].parent.parent.joinpath(f'test_outputs/mesoscan/suite2p/plane{i}')),
 			utils.get_list_of_data(outputs_to_check, Path(test_ops['save_path0']).joinpath(f"suite2p/plane{i}")),
 		))
+
+
+def test_2plane_2chan_with_batches_planes_in_parallel(test_ops):
+	"""
+	Tests for case with 2 planes and 2 channels processed in parallel by two plane workers.
+	"""
+	ops = utils.FullPipelineTestUtils.initialize_ops_test2plane_2chan_with_batches(test_ops)
+	ops['plane_workers'] = 2
+	nplanes = ops['nplanes']
+	suite2p.run_s2p(ops=ops)
+
+	outputs_to_check = ['F', 'iscell', 'stat']
+	for i in range(nplanes):
+		assert all(utils.compare_list_of_outputs(
+			outputs_to_check,
+			utils.get_list_of_data(outputs_to_check, ops['data_path'][0].parent.joinpath(f"test_outputs/{nplanes}plane{ops['nchannels']}chan1500/suite2p/plane{i}")),
+			utils.get_list_of_data(outputs_to_check, Path(ops['save_path0']).joinpath(f"suite2p/plane{i}")),
+		))
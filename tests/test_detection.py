@@ -0,0 +1,83 @@
+"""
+Tests for the Suite2p Detection module
+"""
+import numpy as np
+from suite2p.detection import sparsedetect, utils
+
+
+def test_pixel_major_residual_updates_match_frame_major_updates():
+    rng = np.random.default_rng(0)
+    mov = rng.normal(0, 1, (300, 20, 30)).astype(np.float32)
+    movT = sparsedetect.pixel_major(mov)
+    np.testing.assert_array_equal(movT, mov.transpose(1, 2, 0))
+    movT = movT.reshape(-1, 300)
+
+    mov = mov.reshape(300, -1)
+    ipix = rng.choice(600, 50, replace=False)
+    active_frames = np.nonzero(rng.random(300) > 0.8)[0]
+    tproj = rng.normal(0, 1, 300).astype(np.float32)
+    lam = rng.random(50)
+    np.testing.assert_allclose(sparsedetect.active_mean(movT, ipix, active_frames),
+                               mov[np.ix_(active_frames, ipix)].mean(axis=0), rtol=1e-5)
+
+    mov[np.ix_(active_frames, ipix)] -= np.outer(tproj[active_frames], lam)
+    sparsedetect.subtract_outer(movT, ipix, active_frames, tproj, lam)
+    np.testing.assert_array_equal(movT, mov.T)
+
+    Mx = mov[:, ipix]
+    np.testing.assert_allclose(sparsedetect.thresholded_norm(movT, ipix, 0.5),
+                               (Mx**2 * np.float32(Mx > 0.5)).sum(axis=0)**.5, rtol=1e-6)
+
+
+def test_multiscale_pyramid_matches_filtering_each_scale():
+    mov = np.random.default_rng(2).normal(0, 1, (130, 37, 50)).astype(np.float32)
+    movu, max_maps = sparsedetect.multiscale_pyramid(mov, nscales=5, batch_size=50)
+    dmov = mov
+    for movu0, max_map in zip(movu, max_maps):
+        movu_expected = sparsedetect.square_convolution_2d(dmov, 3)
+        np.testing.assert_array_equal(movu0, movu_expected.transpose(1, 2, 0))
+        np.testing.assert_array_equal(max_map, movu_expected.max(axis=0))
+        dmov = 2 * utils.downsample(dmov)
+
+
+def test_tiled_sparsery_finds_cells_across_tiles_once():
+    rng = np.random.default_rng(1)
+    nframes, Ly, Lx, ncells = 1000, 96, 96, 40
+    mov = rng.normal(0, 1, (nframes, Ly, Lx)).astype(np.float32)
+    yy, xx = np.mgrid[:Ly, :Lx]
+    centers = rng.uniform(4, Ly - 4, (ncells, 2))
+    for cy, cx in centers:
+        activity = (rng.random(nframes) < 0.03) * rng.exponential(8, nframes)
+        mov += np.outer(activity, np.exp(-((yy - cy)**2 + (xx - cx)**2) / 6)).reshape(
+            nframes, Ly, Lx).astype(np.float32)
+
+    stats = []
+    for tile_size in [0, 48]:
+        _, stat = sparsedetect.sparsery(mov.copy(), high_pass=100, neuropil_high_pass=25,
+                                        batch_size=500, spatial_scale=1,
+                                        threshold_scaling=1.0, max_iterations=1000,
+                                        tile_size=tile_size, n_workers=1)
+        meds = np.array([s["med"] for s in stat], float)
+        dists = np.sqrt(((centers[:, np.newaxis] - meds)**2).sum(axis=-1))
+        assert (dists.min(axis=1) < 3).mean() > 0.95
+        stats.append(stat)
+
+    # cells in the overlap of two tiles are kept once
+    assert len(stats[1]) <= len(stats[0])
+    pixels = [set(zip(s["ypix"], s["xpix"])) for s in stats[1]]
+    for i, p0 in enumerate(pixels):
+        for p1 in pixels[i + 1:]:
+            assert len(p0 & p1) < 0.5 * len(p0 | p1)
+
+    # as in extract_rois, at most max_iterations ROIs are returned
+    ops, stat = sparsedetect.sparsery(mov.copy(), high_pass=100, neuropil_high_pass=25,
+                                      batch_size=500, spatial_scale=1, threshold_scaling=1.0,
+                                      max_iterations=10, tile_size=48, n_workers=1)
+    assert len(stat) == 10 and ops["Vmax"].shape == (10,)
+    np.testing.assert_array_equal(ops["Vmax"], np.sort(ops["Vmax"])[::-1])
+
+    # the IoU of duplicates is computed from all of their pixels, even if ROIs overlap
+    ypix, xpix = np.mgrid[:4, :8].reshape(2, -1)
+    roi = {"ypix": ypix, "xpix": xpix}
+    overlapping = {"ypix": ypix, "xpix": xpix + 2}
+    assert sparsedetect.duplicate_rois([roi, overlapping], [roi.copy()]) == [(0, 0)]
@@ -223,3 +223,255 @@ def test_get_suite2p_path(input_path, expected_path, success):
     else:
         with pytest.raises(FileNotFoundError):
             get_suite2p_path(Path(input_path))
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_binary_iter_batches_matches_slicing(tmpdir, prefetch):
+    frames = np.random.randint(-1000, 1000, size=(1234, 20, 30)).astype("int16")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename, n_frames=1234) as f:
+        f[:] = frames
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename) as f:
+        batches = [(k, data.copy()) for k, data in f.iter_batches(
+            100, prefetch=prefetch, n_frames=1200, crop=((2, 18), (3, 25)))]
+    assert [k for k, _ in batches] == list(range(0, 1200, 100))
+    np.testing.assert_array_equal(np.concatenate([data for _, data in batches]),
+                                  frames[:1200, 2:18, 3:25])
+
+
+def test_binary_write_behind_matches_sync_write(tmpdir):
+    frames = np.random.uniform(-1000, 40000, size=(250, 20, 30)).astype("float32")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename, n_frames=250) as f:
+        with io.write_behind(f, max_pending=2):
+            for k in range(0, 250, 100):
+                batch = frames[k:k + 100].copy()
+                f[k:k + 100] = batch
+                batch[:] = 0  # buffers can be reused once assigned
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename) as f:
+        np.testing.assert_array_equal(
+            f[:], np.minimum(frames, 2**15 - 2).astype("int16"))
+
+
+@pytest.mark.parametrize("chunk_bytes", [2 * 20 * 30 * 7, 1000])
+def test_chunked_binary_matches_raw_binary(tmpdir, chunk_bytes):
+    frames = np.random.randint(-1000, 1000, size=(123, 20, 30)).astype("int16")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    ops = {"binary_compression": "zlib", "binary_chunk_bytes": chunk_bytes}
+    f = io.chunked.open_binary_for_writing(filename, ops)
+    for k in range(0, 123, 10):
+        f.write(bytearray(frames[k:k + 10]))
+    f.close()
+
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename) as f:
+        assert isinstance(f, io.ChunkedBinaryFile)
+        assert f.shape == (123, 20, 30)
+        np.testing.assert_array_equal(f[:], frames)
+        np.testing.assert_array_equal(f[[5, 77, 3]], frames[[5, 77, 3]])
+        # sampled frames decompress each chunk at most once
+        store = f.file.store
+        decompress, n_calls = store._decompress, []
+        store._decompress = lambda b: n_calls.append(1) or decompress(b)
+        for inds in [[90, 3, 4, 5, 60, 61, 90, 122, 0], np.arange(0, 123, 7)]:
+            store._cache, n_calls[:] = (-1, None), []
+            np.testing.assert_array_equal(f[inds], frames[inds])
+            nbytes = f.file.frame_bytes
+            chunks = {c for i in inds
+                      for c in range(i * nbytes // chunk_bytes,
+                                     ((i + 1) * nbytes - 1) // chunk_bytes + 1)}
+            assert len(n_calls) == len(chunks)
+        store._decompress = decompress
+        np.testing.assert_array_equal(f.file[50, 2:5, 3:9], frames[50, 2:5, 3:9])
+        f[10:60] = frames[10:60] + 1
+    frames[10:60] += 1
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename) as f:
+        np.testing.assert_array_equal(f[:], frames)
+
+
+def test_binary_header_opens_without_shape(tmpdir):
+    frames = np.random.uniform(-10, 10, size=(250, 20, 30)).astype("float32")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename, n_frames=250, dtype="float32",
+                       fs=30.) as f:
+        f[:200] = frames[:200]
+    with io.BinaryFile(filename=filename) as f:
+        assert f.shape == (250, 20, 30) and f.dtype == "float32" and f.fs == 30.
+        np.testing.assert_array_equal(f[:200], frames[:200])
+        # frames in chunks that were never written are flagged
+        bad_frames = f.verify()
+        assert not bad_frames[:200].any() and bad_frames[200:].all()
+
+
+def test_tiff_to_binary_parallel_matches_serial(test_ops):
+    test_ops["nplanes"] = 2
+    save_path0 = Path(test_ops["save_path0"])
+    ops_serial = io.tiff_to_binary({**test_ops, "save_path0": str(save_path0 / "serial")})
+    ops_parallel = io.tiff_to_binary({
+        **test_ops, "save_path0": str(save_path0 / "parallel"), "tiff_workers": 2
+    })
+    assert ops_serial["nframes"] == ops_parallel["nframes"]
+    np.testing.assert_array_equal(ops_serial["frames_per_file"],
+                                  ops_parallel["frames_per_file"])
+    for plane in ["plane0", "plane1"]:
+        serial = save_path0 / "serial" / "suite2p" / plane / "data.bin"
+        parallel = save_path0 / "parallel" / "suite2p" / plane / "data.bin"
+        assert serial.read_bytes() == parallel.read_bytes()
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+@pytest.mark.parametrize("nplanes, nchannels, functional_chan, iplane",
+                         [(1, 1, 1, 0), (3, 2, 2, 1), (2, 2, 1, 1)])
+def test_deinterleave_matches_strided_slicing(nplanes, nchannels, functional_chan, iplane,
+                                              parallel):
+    im = np.random.randint(-1000, 1000, size=(29, 6, 5)).astype(np.int16)
+    frames, counts, mean_imgs = io.utils.deinterleave(im, nplanes, nchannels,
+                                                      functional_chan=functional_chan,
+                                                      iplane=iplane, parallel=parallel)
+    nfunc = functional_chan - 1 if nchannels > 1 else 0
+    for j in range(nplanes):
+        i0 = nchannels * ((iplane + j) % nplanes)
+        for c, ioff in enumerate([nfunc, 1 - nfunc][:frames.shape[0]]):
+            expected = im[i0 + ioff::nplanes * nchannels]
+            assert counts[c, j] == len(expected)
+            np.testing.assert_array_equal(frames[c, j, :counts[c, j]], expected)
+            np.testing.assert_allclose(mean_imgs[c, j], expected.sum(axis=0))
+
+
+def test_bin_movie_bins_good_frames_across_batches(tmpdir):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 1000, (1003, 12, 16)).astype(np.int16)
+    bad_frames = rng.random(1003) < 0.2
+    good = frames[~bad_frames, 2:10, 3:13].astype(np.float32)
+    nbins = len(good) // 7
+    expected = good[:nbins * 7].reshape(nbins, 7, 8, 10).mean(axis=1)
+
+    filename = str(tmpdir.join("data.bin"))
+    with io.BinaryFile(Ly=12, Lx=16, filename=filename, n_frames=1003) as f:
+        f[:] = frames
+        for n_workers in [1, 3]:
+            mov = io.bin_movie(f, 7, y_range=(2, 10), x_range=(3, 13),
+                               bad_frames=bad_frames, batch_size=100,
+                               n_workers=n_workers)
+            np.testing.assert_allclose(mov, expected, rtol=1e-6)
+        mov = f.bin_movie(7, y_range=(2, 10), x_range=(3, 13), bad_frames=bad_frames,
+                          filename=str(tmpdir.join("mov_binned.npy")))
+        assert isinstance(mov, np.memmap)
+        np.testing.assert_allclose(np.load(str(tmpdir.join("mov_binned.npy"))),
+                                   expected, rtol=1e-6)
+
+    # a long run of bad frames is skipped, not read by the task whose bins straddle it
+    class ReadCounter:
+        def __init__(self, frames):
+            self.frames, self.shape, self.nread = frames, frames.shape, 0
+
+        def __getitem__(self, key):
+            data = self.frames[key]
+            self.nread = max(self.nread, len(data))
+            return data
+
+    bad_frames = np.zeros(1003, bool)
+    bad_frames[100:500] = True
+    good = frames[~bad_frames].astype(np.float32)
+    nbins = len(good) // 7
+    f = ReadCounter(frames)
+    mov = io.bin_movie(f, 7, bad_frames=bad_frames, batch_size=100)
+    np.testing.assert_allclose(mov, good[:nbins * 7].reshape(nbins, 7, 12, 16).mean(axis=1),
+                               rtol=1e-6)
+    assert f.nread <= 100
+
+
+def test_chunked_binary_reuses_space_and_survives_a_crash(tmpdir):
+    frames = np.random.randint(-1000, 1000, size=(200, 20, 30)).astype("int16")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    f = io.chunked.open_binary_for_writing(filename, {
+        "binary_compression": "zlib",
+        "binary_chunk_bytes": 2 * 20 * 30 * 2
+    })
+    f.write(frames)
+    f.close()
+    size = Path(filename).stat().st_size
+    # rewriting the frames in place (e.g. registration) does not grow the file
+    for _ in range(5):
+        with io.BinaryFile(Ly=20, Lx=30, filename=filename) as f:
+            for k in range(0, 200, 50):
+                f[k:k + 50] = f[k:k + 50][:, ::-1]
+    assert Path(filename).stat().st_size < 1.3 * size
+
+    # a file that is never closed can be read up to its last commit
+    store = io.chunked.ChunkedStore(filename + "2", codec="zlib", chunk_bytes=2 * 20 * 30,
+                                    Ly=20, Lx=30)
+    store.write(0, frames)
+    n_committed = (io.chunked.ChunkedStore(filename + "2").index[:, 1] > 0).sum()
+    assert n_committed >= 200 - io.chunked.COMMIT_CHUNKS
+    with io.BinaryFile(filename=filename + "2") as f:
+        np.testing.assert_array_equal(f[:n_committed], frames[:n_committed])
+        assert (f.verify() == (np.arange(200) >= n_committed)).all()
+
+
+def test_binary_checksums_are_computed_from_written_batches(tmpdir):
+    frames = np.random.randint(-1000, 1000, size=(250, 20, 30)).astype("int16")
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    with io.BinaryFile(Ly=20, Lx=30, filename=filename, n_frames=250) as f:
+        reread = []
+        chunk_checksum = f._chunk_checksum
+        f._chunk_checksum = lambda ichunk: reread.append(ichunk) or chunk_checksum(ichunk)
+        with io.write_behind(f, max_pending=2):
+            f[:100] = frames[:100]
+            f[100:250] = frames[100:250]
+            np.testing.assert_array_equal(f[:250], frames)
+            f[120:130] = frames[120:130]
+        f.flush()
+        # only the chunk partially written by the last batch is read back
+        assert reread == [1]
+    with io.BinaryFile(filename=filename) as f:
+        assert not f.verify().any()
+
+
+def test_frames_hash_depends_on_the_frames_not_the_file_format(tmpdir):
+    frames = np.random.default_rng(0).integers(-100, 100, (150, 8, 9)).astype(np.int16)
+    filename = str(Path(tmpdir).joinpath("data.bin"))
+    with io.BinaryFile(Ly=8, Lx=9, filename=filename, n_frames=150) as f:
+        f[:] = frames
+    with io.BinaryFile(Ly=8, Lx=9, filename=filename) as f:
+        assert io.frames_hash(f) == io.frames_hash(frames)
+        assert io.frames_hash(f, None) == io.frames_hash(frames)
+    changed = frames.copy()
+    changed[0] += 1
+    assert io.frames_hash(changed) != io.frames_hash(frames)
+    assert io.frames_hash(frames[:-1]) != io.frames_hash(frames)
+
+
+def test_dcimg_to_binary_deinterleaves_planes_and_channels(tmpdir, monkeypatch):
+    from suite2p import default_ops
+    from suite2p.io import dcam
+    # 23 frames of 2 planes x 2 channels, so the planes and channels get different counts
+    im = np.random.default_rng(0).integers(0, 1000, (23, 6, 5)).astype(np.uint16)
+
+    class DCIMGFile:
+        def __init__(self, filename):
+            self.shape = im.shape
+
+        def __getitem__(self, key):
+            return im[key]
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(dcam, "dcimg", type("dcimg", (), {"DCIMGFile": DCIMGFile}),
+                        raising=False)
+    tmpdir.join("movie.dcimg").write("")
+    ops = default_ops()
+    ops.update(data_path=[str(tmpdir)], save_path0=str(tmpdir), input_format="dcimg",
+               nplanes=2, nchannels=2, functional_chan=2, batch_size=10)
+    dcam.dcimg_to_binary(ops)
+    for j in range(2):
+        ops_plane = np.load(str(tmpdir.join("suite2p", "plane%d" % j, "ops.npy")),
+                            allow_pickle=True).item()
+        for ichan, (key, filename) in enumerate([("meanImg", "reg_file"),
+                                                 ("meanImg_chan2", "reg_file_chan2")]):
+            # functional_chan=2 is the second frame of each plane
+            expected = im[2 * j + 1 - ichan::4]
+            frames = np.fromfile(ops_plane[filename], np.int16).reshape(-1, 6, 5)
+            np.testing.assert_array_equal(frames, expected)
+            np.testing.assert_allclose(ops_plane[key], expected.mean(axis=0), rtol=1e-5)
+        assert ops_plane["nframes"] == len(im[2 * j + 1::4])
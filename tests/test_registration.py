@@ -1,3 +1,4 @@
+import pytest
 import numpy as np
 from suite2p.registration import bidiphase, utils
 
@@ -55,4 +56,379 @@ def test_negative_bidiphase_shift_shifts_every_other_line():
 
     shifted = orig.copy()
     bidiphase.shift(shifted, -2)
-    assert np.allclose(shifted, expected)
\ No newline at end of file
+    assert np.allclose(shifted, expected)
+
+def test_subpixel_bidiphase_is_estimated_per_batch():
+    from suite2p import default_ops
+    from suite2p.registration import register
+    rng = np.random.default_rng(0)
+    # sub-pixel offsets interpolate the odd lines, offsets can differ between frames
+    frames = np.tile(np.arange(8, dtype=np.float32) * 10, (2, 4, 1))
+    bidiphase.shift(frames, [0.5, -1])
+    np.testing.assert_allclose(frames[0, 1], [0, 5, 15, 25, 35, 45, 55, 65])
+    np.testing.assert_allclose(frames[1, 1], [10, 20, 30, 40, 50, 60, 70, 70])
+    np.testing.assert_allclose(frames[:, ::2], np.tile(np.arange(8) * 10, (2, 2, 1)))
+
+    # the line offset drifts from 1.4 to 2.6 pixels halfway through the recording
+    yy, xx = np.meshgrid(np.arange(128), np.arange(128), indexing="ij")
+    img = sum(np.exp(-((yy - cy)**2 + (xx - cx)**2) / 8.)
+              for cy, cx in rng.uniform(5, 123, (80, 2))) * 1000
+    mov = np.stack([img + rng.normal(0, 50, img.shape) for _ in range(200)])
+    bidiphase.shift(mov[:100], -1.4)
+    bidiphase.shift(mov[100:], -2.6)
+    assert bidiphase.compute(mov[:100]) == 1
+    assert bidiphase.compute(mov[:100], subpixel=10) == pytest.approx(1.4, abs=0.15)
+    ops = default_ops()
+    ops.update(do_bidiphase=True, bidi_subpixel=True, bidi_per_batch=True, nonrigid=False,
+               batch_size=100, nimg_init=100)
+    register.compute_reference_and_register_frames(mov.astype(np.int16), ops=ops)
+    assert ops["bidiphase_frames"].shape == (200,)
+    np.testing.assert_allclose(ops["bidiphase_frames"][[0, 199]], [1.4, 2.6], atol=0.15)
+
+
+def test_registration_cache_reuses_offsets(tmpdir):
+    from suite2p import default_ops, io
+    from suite2p.registration import register
+    rng = np.random.default_rng(0)
+    base = rng.normal(1000, 200, (84, 100))
+    shifts = rng.integers(-4, 5, (200, 2))
+    mov = np.stack([base[10 + dy:74 + dy, 10 + dx:90 + dx] for dy, dx in shifts])
+    mov = (mov + rng.normal(0, 20, mov.shape)).astype(np.int16)
+    ops = default_ops()
+    ops.update(save_path=str(tmpdir), batch_size=100, block_size=[32, 32], nimg_init=100,
+               reg_cache=True)
+
+    def register_binaries(raw):
+        with io.BinaryFile(64, 80, str(tmpdir.join("raw.bin")), n_frames=200) as f_raw, \
+             io.BinaryFile(64, 80, str(tmpdir.join("reg.bin")), n_frames=200) as f_reg:
+            outputs = register.registration_wrapper(f_reg, f_raw=f_raw if raw else None,
+                                                    ops=dict(ops))
+            return outputs, np.array(f_reg[:])
+
+    for raw in [True, False]:
+        with io.BinaryFile(64, 80, str(tmpdir.join("raw.bin")), n_frames=200) as f:
+            f[:] = mov
+        with io.BinaryFile(64, 80, str(tmpdir.join("reg.bin")), n_frames=200) as f:
+            f[:] = mov if not raw else np.zeros_like(mov)
+        outputs, registered = register_binaries(raw)
+        if raw:
+            # the cached shifts are applied to the raw frames
+            with io.BinaryFile(64, 80, str(tmpdir.join("reg.bin")), n_frames=200) as f:
+                f[:] = np.zeros_like(mov)
+            outputs_cached, registered_cached = register_binaries(raw)
+            np.testing.assert_array_equal(registered_cached, registered)
+        # registered frames are left as they are
+        outputs_cached, registered_cached = register_binaries(raw)
+        np.testing.assert_array_equal(registered_cached, registered)
+        for offsets, offsets_cached in zip(outputs[4], outputs_cached[4]):
+            np.testing.assert_array_equal(offsets, offsets_cached)
+
+
+def test_rigid_shift_frames_and_subpixel_phasecorr():
+    from suite2p.registration import rigid
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 1000, (5, 32, 40)).astype(np.int16)
+    ymax, xmax = rng.integers(-5, 6, 5), rng.integers(-5, 6, 5)
+    shifted = rigid.shift_frames(frames, ymax, xmax)
+    assert shifted.dtype == frames.dtype
+    for frame, frame_shifted, dy, dx in zip(frames, shifted, ymax, xmax):
+        np.testing.assert_array_equal(frame_shifted, rigid.shift_frame(frame, dy, dx))
+
+    # smooth image shifted by a known fractional offset
+    yy, xx = np.meshgrid(np.arange(64), np.arange(64), indexing="ij")
+    refImg = np.exp(-((yy - 30.)**2 + (xx - 34.)**2) / 50.) + np.exp(
+        -((yy - 20.)**2 + (xx - 44.)**2) / 20.)
+    moved = rigid.shift_frames(refImg[np.newaxis].astype(np.float32), [-2.5], [1.5])
+    ymax, xmax, cmax = rigid.phasecorr(
+        data=moved.astype(np.complex64),
+        cfRefImg=rigid.phasecorr_reference(refImg.astype(np.float32), smooth_sigma=1.15),
+        maxregshift=0.1, smooth_sigma_time=0, subpixel=10)
+    assert abs(ymax[0] - 2.5) <= 0.2 and abs(xmax[0] + 1.5) <= 0.2
+    ymax, xmax, cmax = rigid.phasecorr(
+        data=moved.astype(np.complex64),
+        cfRefImg=rigid.phasecorr_reference(refImg.astype(np.float32), smooth_sigma=1.15),
+        maxregshift=0.1, smooth_sigma_time=0)
+    assert ymax.dtype == np.int32 and abs(ymax[0] - 2.5) <= 0.5
+
+
+def test_convolve_reuses_fft_workspace_and_pads_to_reference():
+    from scipy.fft import next_fast_len
+    from suite2p.registration import rigid
+    rng = np.random.default_rng(0)
+    mov = rng.normal(0, 1, (10, 61, 67)).astype(np.complex64)
+    img = rng.normal(0, 1, (61, 67)) + 1j * rng.normal(0, 1, (61, 67))
+    Y = np.fft.fft2(mov)
+    expected = np.real(np.fft.ifft2(Y / (1e-5 + np.abs(Y)) * img))
+    cc = utils.convolve(mov, img.astype(np.complex64))
+    np.testing.assert_allclose(cc, expected, atol=1e-4)
+    # the FFT workspace is reused, but not shared by the results of consecutive calls
+    workspace = utils.fft_workspace(mov.shape, slot=1)
+    cc2 = utils.convolve(mov, img.astype(np.complex64))
+    assert utils.fft_workspace(mov.shape, slot=1) is workspace
+    assert not np.shares_memory(cc2, cc)
+    np.testing.assert_array_equal(cc2, cc)
+    # the cached upsampling matrix cannot be modified by its callers
+    assert not utils.mat_upsample(lpad=3, subpixel=10)[0].flags.writeable
+
+    # frames are zero-padded to the fast FFT size of the reference
+    refImg = rng.normal(0, 1, (61, 67)).astype(np.float32)
+    frames = np.stack([rigid.shift_frame(refImg, dy, dx) for dy, dx in [(2, -3), (-1, 4)]])
+    cfRefImg = rigid.phasecorr_reference(refImg, smooth_sigma=1.15, pad_fft=True)
+    assert cfRefImg.shape == (next_fast_len(61), next_fast_len(67))
+    ymax, xmax, _ = rigid.phasecorr(
+        rigid.apply_masks(frames, *rigid.compute_masks(refImg, maskSlope=3.45)),
+        cfRefImg, maxregshift=0.1, smooth_sigma_time=0)
+    np.testing.assert_array_equal(ymax, [-2, 1])
+    np.testing.assert_array_equal(xmax, [3, -4])
+
+
+def test_fft_backends_give_the_same_convolution():
+    rng = np.random.default_rng(0)
+    mov = rng.normal(0, 1, (4, 48, 50)).astype(np.float32)
+    img = (rng.normal(0, 1, (48, 50)) + 1j * rng.normal(0, 1, (48, 50))).astype(np.complex64)
+    backend = utils.get_fft_backend()
+    try:
+        expected = utils.convolve(mov, img).copy()
+        expected_bidiphase = bidiphase.compute(mov, subpixel=10)
+        for name in utils.FFT_BACKENDS:
+            assert utils.set_fft_backend(name, nthreads=2) == name
+            np.testing.assert_allclose(utils.convolve(mov, img), expected, atol=1e-4)
+            np.testing.assert_allclose(utils.ifft(utils.fft(mov)), mov, atol=1e-4)
+            assert bidiphase.compute(mov, subpixel=10) == expected_bidiphase
+        timings = utils.benchmark_fft_backends((48, 50), nrep=1)
+        assert set(timings) == set(utils.FFT_BACKENDS)
+        assert utils.set_fft_backend("auto", shape=(48, 50)) == min(timings, key=timings.get)
+        with pytest.raises(ValueError):
+            utils.set_fft_backend("cufft")
+    finally:
+        utils.set_fft_backend(backend)
+
+
+def test_nonrigid_phasecorr_finds_block_shifts_for_all_frames():
+    from suite2p.registration import nonrigid
+    rng = np.random.default_rng(0)
+    refImg = rng.normal(0, 1, (128, 160)).astype(np.float32)
+    shifts = [(2, -1), (-3, 0), (0, 4)]
+    frames = np.stack([np.roll(refImg, shift, axis=(0, 1)) for shift in shifts])
+    yblock, xblock, _, _, NRsm = nonrigid.make_blocks(128, 160, block_size=(64, 64))
+    maskMul, maskOffset, cfRefImg = nonrigid.phasecorr_reference(
+        refImg, maskSlope=3.45, smooth_sigma=1.15, yblock=yblock, xblock=xblock)
+    ymax1, xmax1, cmax1 = nonrigid.phasecorr(
+        frames, maskMul.squeeze(), maskOffset.squeeze(), cfRefImg.squeeze(),
+        snr_thresh=1.2, NRsm=NRsm, xblock=xblock, yblock=yblock, maxregshiftNR=5)
+    assert ymax1.shape == xmax1.shape == cmax1.shape == (len(shifts), len(yblock))
+    for ym, xm, (dy, dx) in zip(ymax1, xmax1, shifts):
+        np.testing.assert_allclose(ym, dy, atol=0.2)
+        np.testing.assert_allclose(xm, dx, atol=0.2)
+
+
+def test_transform_data_applies_rigid_and_block_shifts_in_one_pass():
+    from suite2p.registration import nonrigid, rigid
+    rng = np.random.default_rng(0)
+    nimg, Ly, Lx = 4, 96, 112
+    data = rng.normal(1000, 100, (nimg, Ly, Lx)).astype(np.float32)
+    yblock, xblock, nblocks, _, _ = nonrigid.make_blocks(Ly, Lx, block_size=(32, 32))
+    ymax1 = rng.normal(0, 2, (nimg, len(yblock))).astype(np.float32)
+    xmax1 = rng.normal(0, 2, (nimg, len(yblock))).astype(np.float32)
+    ymax, xmax = rng.integers(-5, 6, nimg), rng.integers(-5, 6, nimg)
+
+    # two passes: rigid shift, then shift by the upsampled block shifts
+    yup, xup = nonrigid.upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1,
+                                              xmax1)
+    mshx, mshy = np.meshgrid(np.arange(Lx, dtype=np.float32),
+                             np.arange(Ly, dtype=np.float32))
+    expected = np.zeros_like(data)
+    nonrigid.shift_coordinates(rigid.shift_frames(data, ymax, xmax), yup, xup, mshy, mshx,
+                               expected)
+
+    Y = nonrigid.transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, ymax=ymax,
+                                xmax=xmax)
+    np.testing.assert_array_equal(Y, expected)
+
+
+def test_phasecorr_multi_matches_phasecorr_for_each_reference():
+    from suite2p.registration import rigid
+    rng = np.random.default_rng(0)
+    refs = [rng.normal(1000, 200, (96, 112)).astype(np.float32) for _ in range(3)]
+    zs, shifts = [2, 0, 1, 2], [(3, -2), (0, 1), (-4, 0), (1, 1)]
+    frames = np.stack([np.roll(refs[z], s, axis=(0, 1)) for z, s in zip(zs, shifts)])
+    frames = (frames + rng.normal(0, 50, frames.shape)).astype(np.int16)
+    masks = [rigid.compute_masks(ref, maskSlope=3.45) for ref in refs]
+    cfRefImg = [rigid.phasecorr_reference(ref, smooth_sigma=1.15) for ref in refs]
+
+    ymax, xmax, cmax = rigid.phasecorr_multi(frames, [m[0] for m in masks],
+                                             [m[1] for m in masks], cfRefImg,
+                                             maxregshift=0.1, smooth_sigma_time=0)
+    assert ymax.shape == xmax.shape == cmax.shape == (len(refs), len(frames))
+    for z in range(len(refs)):
+        ymax_z, xmax_z, cmax_z = rigid.phasecorr(rigid.apply_masks(frames, *masks[z]),
+                                                 cfRefImg[z], maxregshift=0.1,
+                                                 smooth_sigma_time=0)
+        np.testing.assert_array_equal(ymax[z], ymax_z)
+        np.testing.assert_array_equal(xmax[z], xmax_z)
+        np.testing.assert_allclose(cmax[z], cmax_z, rtol=1e-4)
+    t = np.arange(len(frames))
+    zpos = cmax.argmax(axis=0)
+    np.testing.assert_array_equal(zpos, zs)
+    np.testing.assert_array_equal(ymax[zpos, t], [s[0] for s in shifts])
+    np.testing.assert_array_equal(xmax[zpos, t], [s[1] for s in shifts])
+
+
+def test_register_stack_aligns_planes_and_compute_zpos_finds_planes(tmpdir):
+    from scipy.ndimage import gaussian_filter
+    from suite2p import default_ops, io
+    from suite2p.registration import register_stack, compute_zpos
+    rng = np.random.default_rng(0)
+    nplanes, Ly, Lx = 7, 80, 96
+    # planes share structure that changes slowly with depth
+    shared = gaussian_filter(rng.normal(0, 1, (Ly, Lx)), 2)
+    planes = np.stack([
+        1000 + 1500 * shared + 300 * gaussian_filter(rng.normal(0, 1, (Ly, Lx)), 1.5)
+        for _ in range(nplanes)
+    ]).astype(np.float32)
+    dy, dx = rng.integers(-4, 5, nplanes), rng.integers(-4, 5, nplanes)
+    Z = np.stack([np.roll(p, s, axis=(0, 1)) for p, s in zip(planes, zip(dy, dx))])
+
+    ops = default_ops()
+    ops["batch_size"] = 3
+    Zreg, yoff, xoff, corrXY = register_stack(Z, ops)
+    assert Zreg.shape == Z.shape and yoff[nplanes // 2] == xoff[nplanes // 2] == 0
+    np.testing.assert_array_equal(dy - yoff, dy[nplanes // 2])
+    np.testing.assert_array_equal(dx - xoff, dx[nplanes // 2])
+
+    zpos = np.repeat(np.arange(nplanes), 20)
+    with io.BinaryFile(Ly, Lx, str(tmpdir.join("reg.bin")), n_frames=len(zpos)) as f:
+        f[:] = (planes[zpos] + rng.normal(0, 50, (len(zpos), Ly, Lx))).astype(np.int16)
+    ops.update(Ly=Ly, Lx=Lx, nframes=len(zpos), batch_size=32)
+    ops, zcorr = compute_zpos(planes, ops, reg_file=str(tmpdir.join("reg.bin")))
+    assert zcorr.shape == (nplanes, len(zpos))
+    np.testing.assert_array_equal(ops["zpos"], zpos)
+
+
+def test_new_frame_reader_reads_tiff_pages_as_they_are_written(tmpdir):
+    from tifffile import TiffWriter
+    from suite2p.registration.online import NewFrameReader
+    frames = np.random.default_rng(0).integers(0, 1000, (6, 20, 24)).astype(np.int16)
+    full = str(tmpdir.join("full.tif"))
+    with TiffWriter(full) as tif:
+        for frame in frames:
+            tif.write(frame, contiguous=False)
+    data = open(full, "rb").read()
+
+    # the file is written in pieces, partially written pages are read once complete
+    filename = str(tmpdir.join("live.tif"))
+    reader = NewFrameReader(filename, 20, 24)
+    read = []
+    for end in list(range(0, len(data), 97)) + [len(data)]:
+        with open(filename, "wb") as f:
+            f.write(data[:end])
+        read.append(reader.read())
+    np.testing.assert_array_equal(np.concatenate(read), frames)
+    assert reader.nread == len(frames)
+    assert len(reader.read()) == 0
+
+    # errors other than incomplete pages are raised
+    with pytest.raises(ValueError):
+        NewFrameReader(full, 10, 24).read()
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_online_registration_matches_offline_registration(tmpdir, compression):
+    from suite2p import default_ops, io
+    from suite2p.registration import OnlineRegistration, register, utils
+    rng = np.random.default_rng(0)
+    base = rng.normal(1000, 200, (84, 100))
+    shifts = rng.integers(-3, 4, (250, 2))
+    mov = np.stack([base[10 + dy:74 + dy, 10 + dx:90 + dx] for dy, dx in shifts])
+    mov = (mov + rng.normal(0, 20, mov.shape)).astype(np.int16)
+    ops = default_ops()
+    ops.update(nimg_init=100, batch_size=64, block_size=[32, 32], fft_backend="scipy",
+               binary_compression=compression)
+
+    filename = str(tmpdir.join("data.bin"))
+    fft_backend = utils.get_fft_backend()
+    with OnlineRegistration(64, 80, ops, filename=filename) as reg:
+        # no frames are registered until the reference image is computed
+        assert len(reg.push(mov[:60])) == 0 and not reg.initialized
+        registered = [reg.push(mov[k:k + 30]) for k in range(60, 250, 30)]
+    registered = np.concatenate(registered)
+    assert registered.shape == mov.shape and reg.latency.shape == (len(mov),)
+    assert utils.get_fft_backend() == fft_backend
+
+    frames, ymax, xmax, _, ymax1, xmax1, _, _ = register.register_frames(
+        reg.refAndMasks, mov.copy(), rmin=reg.rmin, rmax=reg.rmax, ops=ops)
+    outputs = reg.registration_outputs()
+    np.testing.assert_array_equal(outputs[4][0], ymax)
+    np.testing.assert_array_equal(outputs[4][1], xmax)
+    np.testing.assert_allclose(outputs[5][0], ymax1, atol=1e-5)
+    np.testing.assert_allclose(registered, frames, atol=1e-3)
+    with io.BinaryFile(Ly=64, Lx=80, filename=filename) as f:
+        assert f.shape == mov.shape
+        assert isinstance(f, io.ChunkedBinaryFile) == (compression is not None)
+        np.testing.assert_array_equal(f[:], registered.astype(np.int16))
+        assert not f.verify().any()
+
+
+def test_compute_reference_aligns_frames_with_cached_ffts():
+    from suite2p import default_ops
+    from suite2p.registration import register, rigid
+    rng = np.random.default_rng(0)
+    base = rng.normal(1000, 300, (100, 120))
+    shifts = rng.integers(-6, 7, (200, 2))
+    frames = np.stack([base[10 + dy:90 + dy, 10 + dx:110 + dx] for dy, dx in shifts])
+    frames = (frames + rng.normal(0, 300, frames.shape)).astype(np.int16)
+    for pad_fft in [False, True]:
+        ops = default_ops()
+        ops["pad_fft"] = pad_fft
+        refImg = register.compute_reference(frames, ops=ops)
+        assert refImg.shape == (80, 100) and refImg.dtype == np.int16
+        ymax, xmax, _ = rigid.phasecorr(
+            rigid.apply_masks(frames, *rigid.compute_masks(refImg, maskSlope=3.45)),
+            rigid.phasecorr_reference(refImg, smooth_sigma=1.15), maxregshift=0.1,
+            smooth_sigma_time=0)
+        # all frames are aligned to the same position of the reference image
+        offsets = shifts + np.stack((ymax, xmax), axis=1)
+        assert (offsets == offsets[0]).all() and np.abs(offsets[0]).max() <= 1
+
+
+def test_batched_pc_metrics_match_pcs_of_frames_in_memory():
+    from suite2p.registration import metrics
+    rng = np.random.default_rng(0)
+    # movie with 5 components of decreasing variance and noise
+    comps = rng.normal(0, 1, (5, 40 * 50))
+    weights = rng.normal(0, 1, (600, 5)) * np.array([50, 40, 30, 20, 10])
+    mov = 1000 + weights @ comps + rng.normal(0, 1, (600, 40 * 50))
+    mov = mov.reshape(600, 40, 50).astype(np.float32)
+    inds = np.arange(0, 600, 2)
+
+    pclow, pchigh, w, v = metrics.pclowhigh(mov[inds].copy(), nlowhigh=20, nPC=5,
+                                            random_state=0)
+    pclow_b, pchigh_b, w_b, v_b = metrics.pclowhigh_batched(
+        mov, inds, nlowhigh=20, nPC=5, random_state=0, batch_size=64)
+    np.testing.assert_allclose(w_b, w, rtol=1e-3)
+    np.testing.assert_allclose(np.abs(v_b), np.abs(v), atol=1e-3)
+    # the PCs of the in-memory frames may have the opposite sign
+    sign = np.sign((v * v_b).sum(axis=0))
+    for k in range(5):
+        low, high = (pclow[k], pchigh[k]) if sign[k] > 0 else (pchigh[k], pclow[k])
+        np.testing.assert_allclose(pclow_b[k], low, atol=1e-2)
+        np.testing.assert_allclose(pchigh_b[k], high, atol=1e-2)
+
+
+def test_local_corr_is_mean_correlation_with_neighbors():
+    from suite2p.registration import metrics
+    rng = np.random.default_rng(0)
+    mov = rng.normal(0, 1, (200, 12, 15)).astype(np.float32)
+    mov[:, :, 1:] += mov[:, :, :-1]
+    img_corr = metrics.local_corr(mov, 200)
+
+    padded = np.pad(mov, ((0, 0), (1, 1), (1, 1)), constant_values=np.nan)
+    expected = np.zeros((12, 15))
+    for y in range(12):
+        for x in range(15):
+            corrs = [np.corrcoef(mov[:, y, x], padded[:, y + 1 + dy, x + 1 + dx])[0, 1]
+                     for dy in [-1, 0, 1] for dx in [-1, 0, 1]
+                     if (dy != 0 or dx != 0) and not np.isnan(padded[0, y + 1 + dy,
+                                                                      x + 1 + dx])]
+            expected[y, x] = np.mean(corrs)
+    np.testing.assert_allclose(img_corr, expected, atol=1e-5)